@@ -4,10 +4,22 @@ table for each element
 """
 ##### Imports
 import os
+import tempfile
+import time
 
+import pandas as pd
+
+import factools.columnar
 import factools.fileimport
 import factools.reconstruction
 import factools.dr
+import factools.incremental
+import factools.instrument
+import factools.merge
+import factools.outofcore
+import factools.prefetch
+import factools.store
+import factools.strengthindex
 
 ##### Constants
 ELEMENT_Z = {"H":1, "He":2, "Li":3, "Be":4, "B":5, "C":6, "N":7, "O":8, "F":9, "Ne":10, "Na":11,
@@ -29,7 +41,23 @@ CHARGE_STATE = "CHARGE_STATE"
 RAWPATH = "./KLL/" # Folder to scan for raw data
 OUTPATH = "./KLL/out/" # Folder to put the output data
 OUTPOSTFIX = "_KLL" # Postfix for the filename --> element + postfix +.csv
+WRITE_INDEX = False # Save a cumulative strength index (.idx.npz) next to each element table
+EXPORT_COLUMNAR = False # Also save each element table as memory mappable binary file (.fcol)
+SPILL = False # Keep the per stub tables in temporary files instead of memory until they are merged
+INCREMENTAL = False # Only reprocess stubs whose input files changed since the last run
+WATCH = False # Keep running and process newly finished FAC jobs as they appear (needs INCREMENTAL)
+WATCH_INTERVAL = 60 # Seconds between two scans of RAWPATH in watch mode
+WATCH_SETTLE = 30 # Seconds a stub's files must be unmodified before they are considered finished
+STOREPATH = None # If set, the tables are also added to a partitioned store in this folder
+CHANNEL = "KLL" # Channel name under which the tables are filed in the store
+WORKERS = None # Processes used for the DR table of a single stub (None: serial), often slower
+               # than serial, check with benchmarks/run_benchmarks.py --check-workers first
+MEMORY_BUDGET = None # If set (MB), ai / tr files are processed out-of-core within this budget
+COMPACT = False # Read the FAC files with float32 / small int columns (less memory, see fileimport)
+TRANSIENT_NAMES = False # Add the transient level names to the tables (key for factools.tablediff)
+PREFETCH = 2 # Number of stubs whose files are read ahead in background threads (0: off)
 VERBOSE = True
+INSTRUMENT = False # Record per stage timings and memory, written to OUTPATH/pipeline_stats.json
 
 ##### Helper Methods ----- These may need to be adjusted depending on filenaming conventions
 def base_element(fileNameStub): # The element representing the ionic core
@@ -43,74 +71,275 @@ def remaining_electrons(fileNameStub): # The charge state identification
     temp = temp.split(".")[0]
     return ELEMENT_Z[temp.capitalize()]
 
-##### Main Script
-# Collect a list of all filename stubs, based on all ai files in directory
-FILES = [f[:-3] for f in os.listdir(RAWPATH) if f[-3:] == ".ai"] # Get the fname-stub for all cases
-
-# Sort them by the element they belong to
-print("Entering directory:", RAWPATH)
-FILES_BY_ELEMENT = {}
-for f in FILES:
-    element = base_element(f)
-    if element not in FILES_BY_ELEMENT:
-        FILES_BY_ELEMENT[element] = [f,]
-    else:
-        FILES_BY_ELEMENT[element].append(f)
-
-print("Found the following data sets:")
-for element in FILES_BY_ELEMENT:
-    print(element, "---", FILES_BY_ELEMENT[element])
-
-# Element by element, go through all related charge states/files
-count_attempt = 0
-count_success = 0
-fails = []
-for element, element_files in FILES_BY_ELEMENT.items():
-    print("Now processing element:", element)
-    element_df = None
+##### Processing Methods
+SORT_KEYS = [CHARGE_STATE, factools.dr.DE_AI]
+SORT_KEY_TYPES = [int, float]
+
+class StubError(Exception):
+    """ Raised if a filename stub cannot be processed, the message names the failed step """
+
+def stub_inputs(f):
+    """ The FAC files belonging to a filename stub """
+    return [RAWPATH + f + ".lev", RAWPATH + f + ".tr", RAWPATH + f + ".ai"]
+
+def scan_stubs(settle=0):
+    """
+    Collects all filename stubs in RAWPATH (based on the ai files) sorted by element, stubs with
+    missing files or files modified less than settle seconds ago are skipped
+    """
+    files_by_element = {}
+    now = time.time()
+    for f in sorted(f[:-3] for f in os.listdir(RAWPATH) if f[-3:] == ".ai"):
+        inputs = stub_inputs(f)
+        if not all(os.path.exists(i) for i in inputs):
+            continue
+        if settle and any(now - os.path.getmtime(i) < settle for i in inputs):
+            continue
+        files_by_element.setdefault(base_element(f), []).append(f)
+    return files_by_element
+
+def fac_version(f):
+    """ The FAC version string of a stub (first line of its lev file) """
+    with open(stub_inputs(f)[0]) as fobj:
+        return fobj.readline().strip()
+
+def read_stub_files(f):
+    """
+    Reads the raw contents of the files of a stub that are parsed in memory (runs in a prefetch
+    thread), in out-of-core mode the ai / tr files are streamed and not read ahead
+    """
+    (lev_file, tr_file, ai_file) = stub_inputs(f)
+    if MEMORY_BUDGET is None:
+        return factools.prefetch.read_text_files([lev_file, tr_file, ai_file])
+    return factools.prefetch.read_text_files([lev_file])
+
+def process_stub(element, f, files=None):
+    """
+    Reads the FAC files of a stub and returns its recombination table including the charge state
+    files - the prefetched file contents (see read_stub_files), read from disk if not given
+    """
+    (lev_file, tr_file, ai_file) = stub_inputs(f)
+    files = files or {}
+    # Read FAC Files
+    try:
+        if MEMORY_BUDGET is None:
+            (_, ai_df) = factools.fileimport.read_ai(files.get(ai_file, ai_file), compact=COMPACT)
+            (_, tr_df) = factools.fileimport.read_tr(files.get(tr_file, tr_file), compact=COMPACT)
+        (_, lev_df) = factools.fileimport.read_lev(files.get(lev_file, lev_file),
+                                                   compact=COMPACT)
+    except Exception:
+        raise StubError("FileError")
+
+    # Reconstruct the full level names (NECESSARY STEP)
+    try:
+        lev_df = factools.reconstruction.amend_level_dataframe(lev_df, verbose=VERBOSE,
+                                                               categorical=True)
+    except Exception:
+        raise StubError("ReconstructionError")
+
+    # Assemble the data for this element-charge state combination
+    try:
+        if MEMORY_BUDGET is None:
+            df = factools.dr.dr_recombination_table(lev_df, ai_df, tr_df, verbose=VERBOSE,
+                                                    categorical=True, workers=WORKERS,
+                                                    transient_names=TRANSIENT_NAMES)
+        else:
+            # The recombination table itself is small, only the ai / tr files are streamed
+            (fd, tmp_file) = tempfile.mkstemp(suffix=".csv")
+            os.close(fd)
+            try:
+                factools.outofcore.dr_recombination_table_ooc(lev_df, ai_file, tr_file, tmp_file,
+                                                              memory_budget=MEMORY_BUDGET,
+                                                              compact=COMPACT,
+                                                              transient_names=TRANSIENT_NAMES)
+                df = pd.read_csv(tmp_file, float_precision="round_trip")
+            finally:
+                os.remove(tmp_file)
+    except Exception:
+        raise StubError("DRError")
+
+    df[CHARGE_STATE] = ELEMENT_Z[element] - remaining_electrons(f)
+    return df
+
+def table_dtypes(columns):
+    """
+    Dtype of every column of the element table in the columnar export, the merged csv fields are
+    cast to these, so the file only depends on the settings and not on which stubs were reprocessed
+    """
+    labels = (factools.dr.RECOMB_TYPE, factools.dr.RECOMB_NAME, factools.dr.TRANS_NAME)
+    dtypes = {}
+    for col in columns:
+        if col in labels:
+            dtypes[col] = "category"
+        elif col == CHARGE_STATE:
+            dtypes[col] = "int64"
+        elif col == factools.dr.DE_AI and COMPACT:
+            dtypes[col] = "float32"
+        else:
+            dtypes[col] = "float64"
+    return dtypes
+
+def side_outputs(element):
+    """ The enabled outputs written next to the element table """
+    stub = OUTPATH + element + OUTPOSTFIX
+    files = []
+    if WRITE_INDEX:
+        files.append(stub + ".idx.npz")
+    if EXPORT_COLUMNAR:
+        files.append(stub + factools.columnar.FILE_EXTENSION)
+    return files
+
+def build_element(element, element_files, stats, fails):
+    """
+    Processes all stubs of an element and writes the element table, in incremental mode only
+    stubs with changed inputs are processed and the element table is only rewritten if needed
+    """
     out_file = OUTPATH + element + OUTPOSTFIX + ".csv"
+    if INCREMENTAL:
+        manifest = factools.incremental.Manifest.load(out_file + ".manifest.json")
+        result_dir = OUTPATH + ".stubs/" + element + OUTPOSTFIX + "/"
+        if not os.path.exists(result_dir):
+            os.makedirs(result_dir)
+        # Forget stubs whose files have disappeared. Stubs that were skipped because their files
+        # are still being written (watch mode) keep their last result until they have settled
+        changed = False
+        unsettled = []
+        for f in manifest.stubs:
+            if f in element_files:
+                continue
+            if not all(os.path.exists(p) for p in stub_inputs(f)):
+                manifest.remove(f)
+                changed = True
+            elif os.path.exists(manifest.result(f)):
+                unsettled.append(f)
+        element_files = sorted(element_files + unsettled)
+    spill_dir = tempfile.mkdtemp() if SPILL and not INCREMENTAL else None
+
+    current = set(f for f in element_files
+                  if INCREMENTAL and (f in unsettled or manifest.is_current(f, stub_inputs(f))))
+    # The files of the next stubs are read while the current one is processed
+    todo = [f for f in element_files if f not in current]
+    if PREFETCH:
+        loaded = factools.prefetch.prefetch(todo, read_stub_files, depth=PREFETCH)
+    else:
+        loaded = ((f, None) for f in todo)
 
+    runs = []
     for f in element_files:
-        count_attempt += 1
+        if f in current:
+            runs.append(factools.merge.Run.from_file(manifest.result(f)))
+            continue
+        (_, future) = next(loaded)
+        stats["attempt"] += 1
         print("Filestub:", f)
-        # Read FAC Files
-        lev_file = RAWPATH + f + ".lev"
-        tr_file = RAWPATH + f + ".tr"
-        ai_file = RAWPATH + f + ".ai"
         try:
-            (_, ai_df) = factools.fileimport.read_ai(ai_file)
-            (_, tr_df) = factools.fileimport.read_tr(tr_file)
-            (_, lev_df) = factools.fileimport.read_lev(lev_file)
-        except:
-            fails.append((element, f, "FileError"))
+            try:
+                files = future.result() if future is not None else None
+            except Exception:
+                raise StubError("FileError")
+            with factools.instrument.current_file(f):
+                df = process_stub(element, f, files)
+        except StubError as err:
+            fails.append((element, f, str(err)))
+            if INCREMENTAL and f in manifest.stubs:
+                # The persisted result belongs to the old inputs, the stub must not silently keep
+                # (or lose) its rows in the element table
+                manifest.remove(f)
+                changed = True
             continue
+        stats["success"] += 1
 
-        # Reconstruct the full level names (NECESSARY STEP)
-        try:
-            lev_df = factools.reconstruction.amend_level_dataframe(lev_df, verbose=VERBOSE)
-        except:
-            fails.append((element, f, "ReconstructionError"))
-            continue
+        if STOREPATH is not None:
+            STORE.append(df, CHANNEL, ELEMENT_Z[element])
+        # Each table is already sorted by energy and has a single charge state, so the element
+        # table is produced by merging the sorted runs instead of sorting everything at once
+        if INCREMENTAL:
+            result = result_dir + f + ".csv"
+            runs.append(factools.merge.write_run(df, SORT_KEYS, path=result))
+            manifest.update(f, stub_inputs(f), result)
+            changed = True
+        else:
+            runs.append(factools.merge.write_run(df, SORT_KEYS, spill_dir))
 
-        # Assemble the data for this element-charge state combination
-        try:
-            df = factools.dr.dr_recombination_table(lev_df, ai_df, tr_df, verbose=VERBOSE)
-        except:
-            fails.append((element, f, "DRError"))
-            continue
+    if INCREMENTAL:
+        manifest.save()
+        # Side outputs enabled since the last run (or deleted) are written by a new merge
+        required = [out_file] + (side_outputs(element) if runs else [])
+        if not changed and all(os.path.exists(p) for p in required):
+            print("Element", element, "is up to date")
+            return
+    sinks = []
+    if WRITE_INDEX and runs:
+        builder = factools.strengthindex.IndexBuilder()
+        sinks.append(builder.append)
+    writer = None
+    if EXPORT_COLUMNAR and runs:
+        # Filled from the merged rows, so the memory stays that of a chunk of rows
+        col_file = OUTPATH + element + OUTPOSTFIX + factools.columnar.FILE_EXTENSION
+        versions = sorted(set(fac_version(f) for f in element_files
+                              if os.path.exists(stub_inputs(f)[0])))
+        metadata = {"element":element, "Z":ELEMENT_Z[element], "channel":CHANNEL,
+                    "fac_version":versions[0] if len(versions) == 1 else versions}
+        writer = factools.columnar.ColumnarWriter(col_file, table_dtypes(runs[0].columns),
+                                                  metadata)
+        sinks.append(writer.append)
+    try:
+        with factools.instrument.stage("assemble.merge", out_file) as st:
+            st.add_rows(factools.merge.merge_runs(runs, out_file, SORT_KEYS, SORT_KEY_TYPES,
+                                                  discard=not INCREMENTAL, sinks=sinks))
+    except BaseException:
+        if writer is not None:
+            writer.discard()
+        raise
+    if writer is not None:
+        with factools.instrument.stage("assemble.export_columnar", col_file) as st:
+            writer.close()
+            st.add_rows(writer.rows)
+    if spill_dir is not None:
+        os.rmdir(spill_dir)
+    if WRITE_INDEX and runs:
+        builder.build().save(OUTPATH + element + OUTPOSTFIX + ".idx.npz")
 
-        df[CHARGE_STATE] = ELEMENT_Z[element] - remaining_electrons(f)
-        if element_df is None:
-            element_df = df
-        else:
-            element_df = element_df.append(df, ignore_index=True)
-        count_success += 1
+def run(settle=0):
+    """ Processes everything in RAWPATH once """
+    print("Entering directory:", RAWPATH)
+    files_by_element = scan_stubs(settle)
+    print("Found the following data sets:")
+    for element in files_by_element:
+        print(element, "---", files_by_element[element])
 
-    element_df.sort_values([CHARGE_STATE, factools.dr.DE_AI], inplace=True)
-    element_df.to_csv(out_file, index=False)
+    # Element by element, go through all related charge states/files
+    stats = {"attempt":0, "success":0}
+    fails = []
+    for element, element_files in files_by_element.items():
+        print("Now processing element:", element)
+        build_element(element, element_files, stats, fails)
+
+    print("Done! Successfully processed", stats["success"], "of", stats["attempt"], "data sets:")
+    if fails:
+        print("Failed cases:")
+        for fail in fails:
+            print(fail)
+    if INSTRUMENT:
+        factools.instrument.write_summary(OUTPATH + "pipeline_stats.json")
+
+##### Main Script
+if WATCH and not INCREMENTAL:
+    # Without the manifests every scan would reprocess all stubs
+    raise SystemExit("WATCH needs INCREMENTAL = True")
+if INSTRUMENT:
+    factools.instrument.enable()
+if STOREPATH is not None:
+    STORE = factools.store.RecombinationStore(STOREPATH)
 
-print("Done! Successfully processed" , count_success, "of", count_attempt, "data sets:")
-if fails:
-    print("Failed cases:")
-    for fail in fails:
-        print(fail)
+if WATCH:
+    # Rescan periodically, the manifests make sure that only new or changed stubs are processed
+    print("Watching", RAWPATH, "for finished FAC jobs, stop with Ctrl+C")
+    try:
+        while True:
+            run(WATCH_SETTLE)
+            time.sleep(WATCH_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+else:
+    run()
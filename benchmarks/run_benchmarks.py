@@ -0,0 +1,348 @@
+"""
+Benchmark suite for the factools processing pipeline
+
+Synthetic FAC files of increasing size (number of radiative transitions, with half as many
+autoionisation transitions) are generated with factools.synthetic and the pipeline stages
+parse, reconstruct, transition_table and recombination_table are timed on them. Every measurement
+runs in a fresh interpreter that loads the inputs of the stage from a pickle cache (instead of
+running the previous stages) and resets the peak RSS before the stage starts (Linux), so the
+recorded peak memory is that of the stage with its inputs loaded.
+
+Usage:
+python benchmarks/run_benchmarks.py                     run and compare against baseline.json
+python benchmarks/run_benchmarks.py --save-baseline     run and store the results as baseline
+python benchmarks/run_benchmarks.py --sizes 1000 10000  run only some sizes
+python benchmarks/run_benchmarks.py --check-compact     check the accuracy of the compact mode
+python benchmarks/run_benchmarks.py --check-import      check the import time of the light modules
+python benchmarks/run_benchmarks.py --check-workers 2 4 compare workers= with the serial tables
+"""
+##### Imports
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+##### Setup Variables
+STAGES = ["parse", "reconstruct", "transition_table", "recombination_table"]
+SIZES = [1000, 10000, 100000, 1000000]
+BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+TOLERANCE = 1.3 # Ratio to the baseline above which a measurement counts as a regression
+TIMEOUT = 3600 # Seconds after which a measurement is aborted, larger sizes are skipped then
+LIGHT_MODULES = ["factools.reconstruction", "factools.dr"] # Have to import without numpy / pandas
+IMPORT_BUDGET = 150 # ms, import time of LIGHT_MODULES in a fresh interpreter
+
+##### Single measurement (runs in a subprocess)
+def _rss_mb(field):
+    """ VmRSS (current) or VmHWM (peak) of this process in MB, None if /proc is not available """
+    try:
+        with open("/proc/self/status") as fobj:
+            for line in fobj:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def _reset_peak_rss():
+    """ Resets the peak RSS (VmHWM) of this process, returns False where that is not supported """
+    try:
+        with open("/proc/self/clear_refs", "w") as fobj:
+            fobj.write("5")
+    except OSError:
+        return False
+    return _rss_mb("VmHWM") is not None
+
+def _peak_rss_mb():
+    """ Peak resident set size of this process in MB """
+    peak = _rss_mb("VmHWM")
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return peak
+
+def _cached_inputs(stub, name, compute):
+    """
+    Inputs of a stage, computed once and pickled next to the synthetic files (recomputed if the
+    synthetic files are newer)
+    """
+    import pickle
+    cache = "%s.%s.pkl" % (stub, name)
+    sources = [stub + ext for ext in (".lev", ".ai", ".tr")]
+    if (not os.path.exists(cache)
+            or os.path.getmtime(cache) < max(os.path.getmtime(f) for f in sources)):
+        with open(cache + ".tmp", "wb") as fobj:
+            pickle.dump(compute(), fobj, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(cache + ".tmp", cache)
+    with open(cache, "rb") as fobj:
+        return pickle.load(fobj)
+
+def measure(stage, size, datadir):
+    """
+    Loads the inputs of a stage (from a pickle cache, not by running the previous stages), resets
+    the peak RSS and times the stage itself
+    Returns a dict with time (s), rows (output rows), input_rss_mb (RSS with the inputs loaded),
+    peak_rss_mb (peak RSS during the stage, including the inputs) and peak_reset (whether the peak
+    could be reset, otherwise peak_rss_mb also covers loading the inputs)
+    """
+    import factools.fileimport
+    import factools.reconstruction
+    import factools.dr
+    import factools.synthetic
+
+    stub = os.path.join(datadir, "synthetic_%d" % size)
+    if not os.path.exists(stub + ".tr"):
+        factools.synthetic.generate_fac_files(stub, size // 2, size, nblocks=4)
+
+    def parse():
+        (_, lev_df) = factools.fileimport.read_lev(stub + ".lev")
+        (_, ai_df) = factools.fileimport.read_ai(stub + ".ai")
+        (_, tr_df) = factools.fileimport.read_tr(stub + ".tr")
+        return (lev_df, ai_df, tr_df)
+
+    def amended():
+        (lev_df, ai_df, tr_df) = _cached_inputs(stub, "parsed", parse)
+        return (factools.reconstruction.amend_level_dataframe(lev_df), ai_df, tr_df)
+
+    if stage == "reconstruct":
+        (lev_df, _, _) = _cached_inputs(stub, "parsed", parse)
+    elif stage != "parse":
+        (lev_df, ai_df, tr_df) = _cached_inputs(stub, "amended", amended)
+    input_rss = _rss_mb("VmRSS")
+    peak_reset = _reset_peak_rss()
+
+    start = time.perf_counter()
+    if stage == "parse":
+        rows = sum(len(df) for df in parse())
+    elif stage == "reconstruct":
+        rows = len(factools.reconstruction.amend_level_dataframe(lev_df))
+    elif stage == "transition_table":
+        rows = len(factools.dr.dr_transition_table(lev_df, ai_df, tr_df))
+    else:
+        rows = len(factools.dr.dr_recombination_table(lev_df, ai_df, tr_df))
+    elapsed = time.perf_counter() - start
+    return {"time":elapsed, "rows":rows, "input_rss_mb":input_rss, "peak_rss_mb":_peak_rss_mb(),
+            "peak_reset":peak_reset}
+
+##### Compact mode accuracy
+def check_compact(size, datadir):
+    """
+    Compares the tables computed from compact (float32) and full inputs of a synthetic data set
+    Returns the largest relative deviation of the transition strengths and of the summed
+    recombination strengths per (initial, transient) group, in units of factools.dr.COMPACT_RTOL
+    """
+    import numpy as np
+    import factools.fileimport
+    import factools.reconstruction
+    import factools.dr
+    import factools.synthetic
+    dr = factools.dr
+
+    stub = os.path.join(datadir, "synthetic_%d" % size)
+    if not os.path.exists(stub + ".tr"):
+        factools.synthetic.generate_fac_files(stub, size // 2, size, nblocks=4)
+
+    tables = {}
+    for compact in (False, True):
+        (_, lev_df) = factools.fileimport.read_lev(stub + ".lev", compact=compact)
+        (_, ai_df) = factools.fileimport.read_ai(stub + ".ai", compact=compact)
+        (_, tr_df) = factools.fileimport.read_tr(stub + ".tr", compact=compact)
+        lev_df = factools.reconstruction.amend_level_dataframe(lev_df, categorical=True)
+        df = dr.dr_transition_table(lev_df, ai_df, tr_df)
+        df.sort_values([dr.INIT_ILEV, dr.TRANS_ILEV, dr.FINAL_ILEV], kind="mergesort",
+                       inplace=True)
+        tables[compact] = df
+
+    def max_deviation(full, compact):
+        full = np.asarray(full, dtype=np.float64)
+        compact = np.asarray(compact, dtype=np.float64)
+        mask = full != 0
+        if not mask.any():
+            return 0.0
+        return float(np.max(np.abs(compact[mask] - full[mask]) / np.abs(full[mask])))
+
+    (full, compact) = (tables[False], tables[True])
+    if len(full) != len(compact):
+        raise RuntimeError("Compact and full transition tables differ in length")
+    trans_dev = max_deviation(full[dr.TRANSITION_STRENGTH], compact[dr.TRANSITION_STRENGTH])
+    keys = [dr.INIT_ILEV, dr.TRANS_ILEV]
+    recomb_dev = max_deviation(
+        full.groupby(keys)[dr.TRANSITION_STRENGTH].sum(),
+        compact[dr.TRANSITION_STRENGTH].astype(np.float64).groupby(
+            [compact[k] for k in keys]).sum())
+    return {"transition":trans_dev / dr.COMPACT_RTOL, "recombination":recomb_dev / dr.COMPACT_RTOL}
+
+##### Parallel tables
+def check_workers(size, datadir, workers):
+    """
+    Computes the transition and recombination tables of a synthetic data set serially and with
+    each number of workers, also for the same set without radiative transitions (nothing joins)
+    Returns a list of (case, workers, identical to the serial tables, time (s)), workers None is
+    the serial run
+    """
+    import factools.fileimport
+    import factools.reconstruction
+    import factools.dr
+    import factools.synthetic
+    dr = factools.dr
+
+    stub = os.path.join(datadir, "synthetic_%d" % size)
+    if not os.path.exists(stub + ".tr"):
+        factools.synthetic.generate_fac_files(stub, size // 2, size, nblocks=4)
+    (_, lev_df) = factools.fileimport.read_lev(stub + ".lev")
+    (_, ai_df) = factools.fileimport.read_ai(stub + ".ai")
+    (_, tr_df) = factools.fileimport.read_tr(stub + ".tr")
+    lev_df = factools.reconstruction.amend_level_dataframe(lev_df, categorical=True)
+
+    results = []
+    for (case, tr) in (("full", tr_df), ("empty tr", tr_df.iloc[:0])):
+        reference = None
+        for n in [None] + list(workers):
+            start = time.perf_counter()
+            tables = (dr.dr_transition_table(lev_df, ai_df, tr, workers=n),
+                      dr.dr_recombination_table(lev_df, ai_df, tr, workers=n))
+            elapsed = time.perf_counter() - start
+            if reference is None:
+                reference = tables
+            same = all(table.equals(ref) for (table, ref) in zip(tables, reference))
+            results.append((case, n, same, elapsed))
+    return results
+
+##### Import time
+def check_import_time(repeat=5):
+    """
+    Imports LIGHT_MODULES in fresh interpreters
+    Returns the best import time (ms) and the heavy modules that got imported along
+    """
+    code = ("import sys, time\n"
+            "t0 = time.perf_counter()\n"
+            "%s\n"
+            "t1 = time.perf_counter()\n"
+            "print((t1 - t0) * 1000, ' '.join(m for m in ('numpy', 'pandas') if m in sys.modules))"
+            % "\n".join("import " + module for module in LIGHT_MODULES))
+    best = float("inf")
+    heavy = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, check=True,
+                             cwd=ROOT)
+        fields = out.stdout.decode().split()
+        best = min(best, float(fields[0]))
+        heavy = fields[1:]
+    return (best, heavy)
+
+##### Driver
+def run_all(stages, sizes, datadir, timeout):
+    """ Runs every stage for every size in a subprocess, returns results[stage][size] """
+    results = {}
+    for stage in stages:
+        results[stage] = {}
+        for size in sizes:
+            cmd = [sys.executable, os.path.abspath(__file__), "--single", stage, str(size),
+                   "--datadir", datadir]
+            try:
+                out = subprocess.run(cmd, stdout=subprocess.PIPE, check=True, timeout=timeout)
+            except subprocess.TimeoutExpired:
+                print("%-20s %9d  timed out after %d s, skipping larger sizes" %
+                      (stage, size, timeout))
+                break
+            res = json.loads(out.stdout.decode().strip().splitlines()[-1])
+            results[stage][str(size)] = res
+            inputs = "%9.1f MB" % res["input_rss_mb"] if res["input_rss_mb"] is not None else "n/a"
+            print("%-20s %9d  %10.3f s  %9.1f MB  (inputs %s)  %9d rows" %
+                  (stage, size, res["time"], res["peak_rss_mb"], inputs, res["rows"]))
+    return results
+
+def compare(results, baseline, tolerance):
+    """ Prints the ratios to the baseline and returns the list of regressions """
+    regressions = []
+    print("\nComparison with baseline (ratio new / baseline):")
+    for stage, by_size in results.items():
+        for size, res in by_size.items():
+            base = baseline.get(stage, {}).get(size)
+            if base is None:
+                continue
+            t_ratio = res["time"] / base["time"] if base["time"] else float("inf")
+            m_ratio = res["peak_rss_mb"] / base["peak_rss_mb"]
+            flag = ""
+            if t_ratio > tolerance or m_ratio > tolerance:
+                flag = "  <-- REGRESSION"
+                regressions.append((stage, size, t_ratio, m_ratio))
+            print("%-20s %9s  time x%6.2f  memory x%6.2f%s" % (stage, size, t_ratio, m_ratio,
+                                                               flag))
+    return regressions
+
+def main():
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES)
+    parser.add_argument("--sizes", nargs="+", type=int, default=SIZES)
+    parser.add_argument("--datadir", default=os.path.join(tempfile.gettempdir(),
+                                                          "factools_benchmarks"))
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument("--timeout", type=float, default=TIMEOUT)
+    parser.add_argument("--check-compact", action="store_true")
+    parser.add_argument("--check-import", action="store_true")
+    parser.add_argument("--check-workers", nargs="+", type=int, metavar="WORKERS")
+    parser.add_argument("--single", nargs=2, metavar=("STAGE", "SIZE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.datadir):
+        os.makedirs(args.datadir)
+
+    if args.single:
+        print(json.dumps(measure(args.single[0], int(args.single[1]), args.datadir)))
+        return 0
+
+    if args.check_compact:
+        failed = False
+        for size in args.sizes:
+            dev = check_compact(size, args.datadir)
+            ok = max(dev.values()) <= 1
+            failed = failed or not ok
+            print("compact %9d  transition %6.3f  recombination %6.3f  (x COMPACT_RTOL)  %s" %
+                  (size, dev["transition"], dev["recombination"], "OK" if ok else "FAILED"))
+        return 1 if failed else 0
+
+    if args.check_workers:
+        failed = False
+        for size in args.sizes:
+            for (case, workers, same, elapsed) in check_workers(size, args.datadir,
+                                                                args.check_workers):
+                failed = failed or not same
+                print("workers %9d  %-8s  %-6s  %8.3f s  %s" %
+                      (size, case, workers or "serial", elapsed, "OK" if same else "FAILED"))
+        return 1 if failed else 0
+
+    if args.check_import:
+        (time_ms, heavy) = check_import_time()
+        ok = time_ms <= IMPORT_BUDGET and not heavy
+        print("import %s  %6.1f ms (budget %d ms)  heavy modules: %s  %s" %
+              (", ".join(LIGHT_MODULES), time_ms, IMPORT_BUDGET, ", ".join(heavy) or "none",
+               "OK" if ok else "FAILED"))
+        return 0 if ok else 1
+
+    results = run_all(args.stages, args.sizes, args.datadir, args.timeout)
+    if args.save_baseline:
+        with open(args.baseline, "w") as fobj:
+            json.dump(results, fobj, indent=1)
+        print("Baseline saved to", args.baseline)
+        return 0
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fobj:
+            baseline = json.load(fobj)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    else:
+        print("No baseline found at", args.baseline)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,6 +5,14 @@ Can only be run in python 2.7 due to pfac
 """
 import os
 from pfac import fac
+from factools import aiselect
+from factools import drconfig
+from factools import potcache
+
+# Group the radial potential is optimized on
+OPTIMIZE_GROUP = "final"
+# Group with the ground configuration of the recombined ion, optimized on with shared_potential
+SHARED_GROUP = "potential"
 
 def run_for_all_elements():
     """
@@ -25,16 +33,140 @@ def run_for_all_elements():
         compute_klm(z, path=klm_path)
 
 
-def compute_dr(z, dr_type, path=""):
+class _ConfigRecorder(object):
+    """
+    Context manager recording the fac.Closed / fac.Config calls made inside it (by a dr_type
+    function), as (function name, args, kwargs)
+    forward - also pass the calls on to fac (otherwise they are only recorded)
+    """
+    def __init__(self, forward=True):
+        self.calls = []
+        self.forward = forward
+        self._originals = {}
+
+    def __enter__(self):
+        for name in ("Closed", "Config"):
+            self._originals[name] = getattr(fac, name)
+            setattr(fac, name, self._recording(name))
+        return self
+
+    def __exit__(self, *exc):
+        for (name, function) in self._originals.items():
+            setattr(fac, name, function)
+        return False
+
+    def _recording(self, name):
+        original = getattr(fac, name)
+        def function(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            if self.forward:
+                return original(*args, **kwargs)
+            return None
+        return function
+
+def potential_cache_supported():
+    """ True if this pfac version can save and restore potentials """
+    return hasattr(fac, "SavePotential") and hasattr(fac, "RestorePotential")
+
+def fac_version():
+    """
+    Version string of the pfac build, or None if this build does not report it
+    """
+    for name in ("__version__", "VERSION"):
+        version = getattr(fac, name, None)
+        if version:
+            return str(version)
+    if callable(getattr(fac, "Version", None)):
+        version = fac.Version()
+        if version:
+            return str(version)
+    return None
+
+def _shared_group(calls):
+    """
+    Adds the ground configuration of the recombined ion (the ion of the final group) as group
+    SHARED_GROUP, returns its number of electrons or None if it does not fit the closed shells
+    of the dr_type
+    """
+    nele = potcache.group_electrons(calls, OPTIMIZE_GROUP)
+    config = potcache.open_subshells(drconfig.ground_configuration(nele),
+                                     potcache.closed_subshells(calls))
+    if not config:
+        return None
+    fac.Config(config, group=SHARED_GROUP)
+    return nele
+
+def _optimize_radial(z, calls, potential_cache, shared_potential=False):
+    """
+    Optimizes the radial potential, or restores it from potential_cache (folder) if a potential
+    for the same element, FAC version and optimization group was saved before (see
+    factools.potcache)
+    Without a known FAC version nothing is cached, a potential of another build could be restored.
+    """
+    group = OPTIMIZE_GROUP
+    if shared_potential:
+        nele = _shared_group(calls)
+        if nele is None:
+            print("The closed shells do not fit the ground configuration, optimizing on "
+                  + OPTIMIZE_GROUP)
+        else:
+            group = SHARED_GROUP
+    if potential_cache is None or not potential_cache_supported():
+        fac.OptimizeRadial([group])
+        return
+    version = fac_version()
+    if version is None:
+        print("Unknown FAC version, the potential is not cached")
+        fac.OptimizeRadial([group])
+        return
+    if group == SHARED_GROUP:
+        key = potcache.ground_key(z, nele, version)
+    else:
+        (nele, key) = potcache.cache_key(z, calls, group, version)
+    f_pot = potcache.potential_file(potential_cache, z, nele, key)
+    if os.path.exists(f_pot):
+        fac.RestorePotential(f_pot)
+        print("Restored potential " + f_pot)
+        return
+    fac.OptimizeRadial([group])
+    if not os.path.exists(potential_cache):
+        try:
+            os.makedirs(potential_cache)
+        except OSError:
+            # Created by another worker in the meantime
+            pass
+    # Write and rename, so parallel workers never restore a partially written file
+    f_tmp = "%s.%d.tmp" % (f_pot, os.getpid())
+    fac.SavePotential(f_tmp)
+    os.rename(f_tmp, f_pot)
+
+def compute_dr(z, dr_type, path="", outputs=None, select=None, potential_cache=None,
+               shared_potential=False):
     """
     Main routine, computes DR for given element and recombination process
+    Returns the filename stub of the written .lev, .tr and .ai files
+    outputs - dict with the targets of the ASCII tables ("lev", "tr", "ai"), e.g. named pipes
+              (see factools.pipeline), defaults to the files stub.lev, stub.tr and stub.ai
+    select - if set, the AI table is computed first and radiative transitions are only computed
+             for transient levels whose capture strength from the ground state is at least
+             select times the strongest one (see factools.aiselect), e.g. 1e-4
+    potential_cache - folder in which optimized potentials are saved and from which they are
+                      restored for later jobs with the same element and optimization group
+                      (needs a pfac that reports its version and has SavePotential /
+                      RestorePotential, otherwise ignored), by default only reruns of the same
+                      dr_type share a potential
+    shared_potential - optimize on the ground configuration of the recombined ion instead of the
+                       final group, the same for all channels of an ion, so that e.g. KLL, KLM
+                       and LMM share one potential through potential_cache (the levels differ
+                       from those optimized on the final group, see validate_potential_cache)
     """
     elem = fac.ATOMICSYMBOL[z]
     # Initialise
     fac.Reinit()
     fac.SetAtom(elem)
     # Execute problem specific configuration
-    type_name = dr_type()
+    with _ConfigRecorder() as recorder:
+        type_name = dr_type()
     # Generate filenames
     f_stub = path + elem + "_" + type_name
     f_lev = f_stub + ".lev"
@@ -43,11 +175,13 @@ def compute_dr(z, dr_type, path=""):
     f_tr_b = f_tr + ".b" # temp binary
     f_ai = f_stub + ".ai"
     f_ai_b = f_ai + ".b" # temp binary
+    if outputs is not None:
+        (f_lev, f_tr, f_ai) = (outputs["lev"], outputs["tr"], outputs["ai"])
     # Start solving
     fac.ConfigEnergy(0)
     # According to the manual we should Optimize on the recombined ion
     # (have seen other things out in the wild)
-    fac.OptimizeRadial(["final"])
+    _optimize_radial(z, recorder.calls, potential_cache, shared_potential)
     fac.ConfigEnergy(1)
     # Compute structure and energy levels
     fac.Structure(f_lev_b, ["initial", "transient", "final"])
@@ -56,18 +190,66 @@ def compute_dr(z, dr_type, path=""):
     # Compute the transisiton table for radiative decay
     # Transition Table defaults to m=0 since FAC1.0.7 (not in current docs)
     # which computes all multipoles according to new (unreleased) docs
-    fac.TransitionTable(f_tr_b, ["final"], ["transient"])
-    fac.PrintTable(f_tr_b, f_tr, 1)
-    # Compute the Autoionisation table
-    fac.AITable(f_ai_b, ["transient"], ["initial"])
-    fac.PrintTable(f_ai_b, f_ai, 1)
+    temp_files = [f_lev_b, f_tr_b, f_ai_b]
+    if select is None:
+        fac.TransitionTable(f_tr_b, ["final"], ["transient"])
+        fac.PrintTable(f_tr_b, f_tr, 1)
+        # Compute the Autoionisation table
+        fac.AITable(f_ai_b, ["transient"], ["initial"])
+        fac.PrintTable(f_ai_b, f_ai, 1)
+    else:
+        # Autoionisation first, it decides which transient levels need radiative data
+        fac.AITable(f_ai_b, ["transient"], ["initial"])
+        # The ai output may be a pipe, which cannot be read back
+        f_ai_txt = f_ai if outputs is None else f_ai_b + ".txt"
+        fac.PrintTable(f_ai_b, f_ai_txt, 1)
+        strengths = aiselect.capture_strengths(f_ai_txt)
+        (upper, dropped) = aiselect.select_levels(strengths, select)
+        print("Selected %d of %d transient levels, dropped capture strength fraction: %.3e"
+              % (len(upper), len(strengths), dropped))
+        fac.TransitionTable(f_tr_b, ["final"], upper if upper else ["transient"])
+        fac.PrintTable(f_tr_b, f_tr, 1)
+        if outputs is not None:
+            fac.PrintTable(f_ai_b, f_ai, 1)
+            temp_files.append(f_ai_txt)
     # Clean up
-    for f in [f_lev_b, f_tr_b, f_ai_b]:
+    for f in temp_files:
         try:
             os.remove(f)
         except OSError as e:  ## if failed, report it back to the user ##
             print("Error: %s - %s." % (e.filename, e.strerror))
     print("Element:" + elem + " DR: " + type_name + " done.")
+    return f_stub
+
+def validate_potential_cache(z, dr_type, path, potential_cache, shared_potential=False):
+    """
+    Computes a DR type once with a freshly optimized potential and once with the potential
+    restored from potential_cache, and compares the level energies (factools.potcache)
+    The reference is always optimized on the final group, so with shared_potential the result
+    shows the deviation caused by sharing the ground configuration potential between channels.
+    The results are written to path + "optimized/" and path + "restored/"
+    Returns the comparison dict
+    """
+    if not potential_cache_supported():
+        raise RuntimeError("This pfac version cannot save and restore potentials")
+    if fac_version() is None:
+        raise RuntimeError("This pfac version does not report its version, nothing is cached")
+    ref_path = path + "optimized/"
+    reuse_path = path + "restored/"
+    for folder in (ref_path, reuse_path):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+    ref_stub = compute_dr(z, dr_type, ref_path)
+    # The first cached run saves the potential if it is not cached yet, the second restores it
+    compute_dr(z, dr_type, reuse_path, potential_cache=potential_cache,
+               shared_potential=shared_potential)
+    reuse_stub = compute_dr(z, dr_type, reuse_path, potential_cache=potential_cache,
+                            shared_potential=shared_potential)
+    result = potcache.compare_levels(reuse_stub + ".lev", ref_stub + ".lev")
+    print("Potential reuse for " + fac.ATOMICSYMBOL[z] + ": %(levels)d levels, same levels: "
+          "%(same_levels)s, max. deviation %(max_abs_dev).3e eV (excitation energies "
+          "%(max_excitation_dev).3e eV)" % result)
+    return result
 
 def compute_kll(z, path=""):
     """
@@ -169,6 +351,25 @@ def compute_lmm(z, path=""):
     if z > 28:
         compute_dr(z, lmm_ni, path)
 
+###### Generic Settings
+def dr_type_for(channel, nele, prune=False):
+    """
+    Electron config for any DR channel (e.g. "KLL", "LMN") and isoelectronic sequence (number of
+    electrons of the initial ion), derived by factools.drconfig
+    dr_type_for("KLL", 3) sets up the same groups as kll_li (see check_dr_types for the others)
+    prune - drop configurations that cannot be reached from the ground state (see drconfig)
+    Returns a function that can be passed to compute_dr
+    """
+    channel = drconfig.dr_channel(channel, nele, prune=prune)
+    def dr_type():
+        if channel.closed:
+            fac.Closed(channel.closed)
+        fac.Config(*channel.initial, group="initial")
+        fac.Config(*channel.transient, group="transient")
+        fac.Config(*channel.final, group="final")
+        return channel.name
+    return dr_type
+
 ###### KLL Settings
 def kll_he():
     """Electron config for KLL DR with he-like initial state"""
@@ -540,4 +741,61 @@ def lmm_ni():
     fac.Config('2*7 3*18', group="transient")
     fac.Config('2*8 3*17', group="final")
     return "LMM-Ni"
-    
\ No newline at end of file
+
+###### Consistency check of the generic settings
+HAND_WRITTEN = ([("KLL", nele, dr_type) for (nele, dr_type) in
+                 enumerate([kll_he, kll_li, kll_be, kll_b, kll_c, kll_n, kll_o], 2)]
+                + [("KLM", nele, dr_type) for (nele, dr_type) in
+                   enumerate([klm_he, klm_li, klm_be, klm_b, klm_c, klm_n, klm_o, klm_f], 2)]
+                + [("LMM", nele, dr_type) for (nele, dr_type) in
+                   enumerate([lmm_li, lmm_be, lmm_b, lmm_c, lmm_n, lmm_o, lmm_f, lmm_ne, lmm_na,
+                              lmm_mg, lmm_al, lmm_si, lmm_p, lmm_s, lmm_cl, lmm_ar, lmm_k, lmm_ca,
+                              lmm_sc, lmm_ti, lmm_v, lmm_cr, lmm_mn, lmm_fe, lmm_co, lmm_ni], 3)])
+
+def _recorded_groups(dr_type):
+    """ Closed subshells and expanded configurations per group set up by a dr_type function """
+    with _ConfigRecorder(forward=False) as recorder:
+        dr_type()
+    closed = set()
+    groups = {}
+    for (name, args, kwargs) in recorder.calls:
+        if name == "Closed":
+            closed.update(key for arg in args for key in drconfig.parse_configuration(arg))
+        else:
+            configs = groups.setdefault(kwargs["group"], set())
+            for arg in args:
+                configs.update(frozenset(c.items()) for c in drconfig.expand_configuration(arg))
+    return (closed, groups)
+
+def check_dr_types(verbose=True):
+    """
+    Compares the groups derived by dr_type_for with the hand written dr_type functions, by their
+    closed subshells and the subshell configurations of every group. The derived initial group is
+    the complex of the channel shells, which equals the hand written KLL / KLM groups and contains
+    the ground configuration of the hand written LMM groups plus the excited initial levels of
+    the complex; "initial superset" marks these.
+    Returns a list of (type name, difference) for every real mismatch
+    """
+    mismatches = []
+    for (channel, nele, dr_type) in HAND_WRITTEN:
+        (closed, groups) = _recorded_groups(dr_type)
+        (closed_gen, groups_gen) = _recorded_groups(dr_type_for(channel, nele))
+        name = "%s-%s" % (channel, drconfig.ATOMICSYMBOL[nele])
+        problems = []
+        if closed != closed_gen:
+            problems.append("closed")
+        for group in ("transient", "final"):
+            if groups.get(group) != groups_gen.get(group):
+                problems.append(group)
+        note = ""
+        if groups.get("initial") != groups_gen.get("initial"):
+            if groups.get("initial", set()) <= groups_gen.get("initial", set()):
+                note = "initial superset"
+            else:
+                problems.append("initial")
+        if problems:
+            mismatches.append((name, ", ".join(problems)))
+        if verbose:
+            print("%-8s %s %s" % (name, "MISMATCH " + ", ".join(problems) if problems else "OK",
+                                  note))
+    return mismatches
@@ -1,3 +1,5 @@
 """
 init file for a collection of tools and scripts for FAC result processing
-"""
\ No newline at end of file
+"""
+
+__version__ = "0.2.2"
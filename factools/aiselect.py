@@ -0,0 +1,45 @@
+"""
+Selection of the transient levels that matter for DR, based on the autoionisation table
+
+Many doubly excited levels have a negligible dielectronic capture strength from the ground state
+of the initial ion, computing their radiative decays is wasted work. compute_dr(select=...) in
+fac_dr runs AITable first, uses select_levels to pick the levels above a relative DC strength
+threshold and only computes the radiative transitions of these.
+
+Only depends on the standard library and also runs under python 2.7 (inside pfac).
+"""
+
+def capture_strengths(ai_file):
+    """
+    Reads a FAC ASCII ai file and returns a dict BOUND_ILEV -> summed DC_STRENGTH of the
+    transitions from the ground state (lowest FREE_ILEV, as in dr.filter_ground_state)
+    """
+    rows = []
+    with open(ai_file) as fobj:
+        for line in fobj:
+            fields = line.split()
+            # Transition rows are the only lines with 7 fields (header lines contain a "=")
+            if len(fields) == 7 and "=" not in line:
+                rows.append((int(fields[0]), int(fields[2]), float(fields[6])))
+    strengths = {}
+    if not rows:
+        return strengths
+    ground = min(free for (_, free, _) in rows)
+    for (bound, free, strength) in rows:
+        if free == ground:
+            strengths[bound] = strengths.get(bound, 0.0) + strength
+    return strengths
+
+def select_levels(strengths, threshold):
+    """
+    Selects the levels whose capture strength is at least threshold times the strongest one
+    strengths - dict level -> strength (see capture_strengths)
+    Returns (sorted list of selected levels, fraction of the total strength that is dropped)
+    """
+    if not strengths:
+        return ([], 0.0)
+    limit = threshold * max(strengths.values())
+    selected = sorted(lev for (lev, strength) in strengths.items() if strength >= limit)
+    total = sum(strengths.values())
+    dropped = total - sum(strengths[lev] for lev in selected)
+    return (selected, dropped / total if total > 0 else 0.0)
@@ -0,0 +1,157 @@
+"""
+Charge state balance of an element in an EBIT, solved for many electron beam energies at once
+
+The charge states q = 0 ... Z of an element form a chain, in which ionisation moves ions from q
+to q + 1 and recombination from q to q - 1:
+dn_q/dt = I_(q-1) n_(q-1) - (I_q + R_q) n_q + R_(q+1) n_(q+1)
+The rates are given as arrays of shape (Z + 1, number of beam energies), all beam energies are
+solved together with numpy operations along the charge state axis. The DR contribution to R_q is
+computed from the element tables (CHARGE_STATE is the charge of the recombining ion) and the
+synthesized cross sections (factools.spectrum), ionisation and other recombination rates
+(radiative recombination, charge exchange) have to be supplied.
+
+Usage:
+grid = np.arange(2000, 3000, 0.5)
+rec = dr_rates(element_df, 26, grid, fwhm=10, current_density=200) + other_rec
+pop = steady_state(ionisation, rec)            # shape (27, len(grid)), columns sum to 1
+pops = evolve(n0, ionisation, rec, [0, 1e-3, 1e-2])
+"""
+
+import numpy as np
+
+from factools.dr import DE_AI, RECOMB_STRENGTH
+from factools.spectrum import synthesize_spectrum
+
+CHARGE_STATE = "CHARGE_STATE"
+ELEMENTARY_CHARGE = 1.602176634e-19 # C
+STRENGTH_UNIT = 1e-20 # cm^2 (eV), unit of FAC's strengths and the synthesized cross sections
+
+def dr_cross_sections(element_df, z, grid, fwhm):
+    """
+    DR cross sections (cm^2) of every charge state 0 ... z on a uniform beam energy grid (eV)
+    element_df - recombination table with a CHARGE_STATE column (as written by
+                 assemble-recomb-tables.py)
+    fwhm - gaussian FWHM of the electron beam (eV)
+    Returns an array of shape (z + 1, len(grid))
+    """
+    sigma = np.zeros((z + 1, len(grid)))
+    for (q, group) in element_df.groupby(CHARGE_STATE):
+        if not 0 <= q <= z:
+            raise ValueError("Charge state %d is out of range for Z = %d" % (q, z))
+        sigma[q] = synthesize_spectrum(grid, group[DE_AI].values, group[RECOMB_STRENGTH].values,
+                                       fwhm)
+    return sigma * STRENGTH_UNIT
+
+def dr_rates(element_df, z, grid, fwhm, current_density):
+    """
+    DR rates (1/s) of every charge state for a beam of current_density (A/cm^2), see
+    dr_cross_sections
+    """
+    return dr_cross_sections(element_df, z, grid, fwhm) * (current_density / ELEMENTARY_CHARGE)
+
+def _chain_rates(ionisation, recombination):
+    """
+    Broadcasts the rates to a common shape (charge states, beam energies) and removes the rates
+    leading out of the chain (ionisation of the bare ion, recombination of the neutral atom)
+    """
+    ionisation = np.asarray(ionisation, dtype=float)
+    recombination = np.asarray(recombination, dtype=float)
+    if ionisation.ndim == 1:
+        ionisation = ionisation[:, None]
+    if recombination.ndim == 1:
+        recombination = recombination[:, None]
+    (ionisation, recombination) = np.broadcast_arrays(ionisation, recombination)
+    if np.any(ionisation < 0) or np.any(recombination < 0):
+        raise ValueError("Rates must not be negative")
+    ionisation = ionisation.copy()
+    recombination = recombination.copy()
+    ionisation[-1] = 0.0
+    recombination[0] = 0.0
+    return (ionisation, recombination)
+
+def steady_state(ionisation, recombination):
+    """
+    Equilibrium charge state distribution for every beam energy
+    In a chain the net flow between neighbouring charge states vanishes in equilibrium, so
+    n_(q+1) / n_q = I_q / R_(q+1). The ratios are accumulated in the log domain, which avoids
+    over- and underflow for the large dynamic range of the populations.
+    ionisation, recombination - rates (1/s) of shape (Z + 1, n_energies) or (Z + 1,)
+    Returns the populations normalised to 1, shape (Z + 1, n_energies)
+    """
+    (ionisation, recombination) = _chain_rates(ionisation, recombination)
+    with np.errstate(divide="ignore"):
+        # A vanishing recombination rate makes the next state absorbing, which the smallest
+        # positive float reproduces without producing inf - inf
+        log_ratio = (np.log(ionisation[:-1])
+                     - np.log(np.maximum(recombination[1:], np.finfo(float).tiny)))
+    log_n = np.zeros(ionisation.shape)
+    log_n[1:] = np.cumsum(log_ratio, axis=0)
+    log_n -= log_n.max(axis=0)
+    pop = np.exp(log_n)
+    return pop / pop.sum(axis=0)
+
+def _thomas_factor(lower, diag, upper):
+    """
+    LU factorisation of a batch of tridiagonal matrices (Thomas algorithm without pivoting, which
+    is stable for the diagonally dominant matrices of implicit time steps)
+    lower[i], diag[i], upper[i] - entries (i, i - 1), (i, i), (i, i + 1), shape (n, batch)
+    """
+    n = diag.shape[0]
+    upper_mod = np.zeros(diag.shape)
+    denom = np.empty(diag.shape)
+    denom[0] = diag[0]
+    for i in range(1, n):
+        upper_mod[i - 1] = upper[i - 1] / denom[i - 1]
+        denom[i] = diag[i] - lower[i] * upper_mod[i - 1]
+    return (lower, upper_mod, denom)
+
+def _thomas_solve(factors, rhs):
+    """ Solves a batch of tridiagonal systems factorised by _thomas_factor """
+    (lower, upper_mod, denom) = factors
+    n = rhs.shape[0]
+    x = np.empty(rhs.shape)
+    x[0] = rhs[0] / denom[0]
+    for i in range(1, n):
+        x[i] = (rhs[i] - lower[i] * x[i - 1]) / denom[i]
+    for i in range(n - 2, -1, -1):
+        x[i] -= upper_mod[i] * x[i + 1]
+    return x
+
+def evolve(n0, ionisation, recombination, times, substeps=10):
+    """
+    Time dependent charge state distributions for every beam energy
+    The rate equations are integrated with implicit (backward) Euler steps, which are stable for
+    any step size and conserve the total population. Every step solves one tridiagonal system per
+    beam energy, the factorisation is shared by all steps of the same length.
+    n0 - initial populations, shape (Z + 1, n_energies) or (Z + 1,)
+    ionisation, recombination - rates (1/s), see steady_state
+    times - increasing output times (s), the first one is the time of n0
+    substeps - implicit Euler steps between two output times
+    Returns the populations at the output times, shape (len(times), Z + 1, n_energies)
+    """
+    (ionisation, recombination) = _chain_rates(ionisation, recombination)
+    n = np.asarray(n0, dtype=float)
+    if n.ndim == 1:
+        n = n[:, None]
+    n = np.broadcast_to(n, ionisation.shape).copy()
+    times = np.asarray(times, dtype=float)
+    if np.any(np.diff(times) < 0):
+        raise ValueError("times need to be increasing")
+    result = np.empty((len(times),) + n.shape)
+    result[0] = n
+    factors = {}
+    for (k, dt) in enumerate(np.diff(times)):
+        step = dt / substeps
+        if step > 0:
+            if step not in factors:
+                # (1 - step * A) n_new = n_old
+                lower = np.zeros(n.shape)
+                upper = np.zeros(n.shape)
+                lower[1:] = -step * ionisation[:-1]
+                upper[:-1] = -step * recombination[1:]
+                diag = 1 + step * (ionisation + recombination)
+                factors[step] = _thomas_factor(lower, diag, upper)
+            for _ in range(substeps):
+                n = _thomas_solve(factors[step], n)
+        result[k + 1] = n
+    return result
@@ -0,0 +1,297 @@
+"""
+Columnar binary files for transition and recombination tables, which consumers can memory map
+instead of parsing csv
+
+Layout (all integers little endian):
+bytes 0-7     MAGIC
+bytes 8-15    uint64, length of the json header in bytes
+header        utf-8 json: {"version", "rows", "metadata", "columns"}
+data          starts at the first multiple of ALIGNMENT after the header
+
+Every column entry has a "name" and a "kind". Arrays are described by {"dtype" (numpy dtype
+string, e.g. "<f8"), "offset" (bytes from the start of the data section, always a multiple of
+ALIGNMENT), "count"}.
+numeric    - "array": the values
+category   - dictionary encoded (strings and categoricals), "codes": integer codes (-1 = missing),
+             "ordered", "categories": the distinct values, either {"kind":"numeric", "array"} or
+             {"kind":"str", "offsets", "data"} with int64 offsets (count + 1 entries) into the
+             utf-8 bytes of data
+The metadata holds e.g. element, Z, channel and the FAC version of the inputs.
+
+The same column encoding is used for tables in shared memory (factools.sharedtable).
+
+Tables that do not fit into memory are written chunk by chunk with ColumnarWriter, which spills
+every column to a temporary file and only keeps the distinct values of the category columns.
+
+Usage:
+write_columnar(df, "K_KLL.fcol", metadata={"element":"K", "Z":19, "channel":"KLL"})
+(metadata, df) = read_columnar("K_KLL.fcol")       # numeric columns are read only memory maps
+
+with ColumnarWriter("K_KLL.fcol", {"DELTA_E_AI":"float64", "RECOMB_TYPE":"category"}) as writer:
+    for chunk in chunks:                            # DataFrames or dicts of columns
+        writer.append(chunk)
+"""
+
+import json
+import os
+import shutil
+import struct
+
+import numpy as np
+import pandas as pd
+
+MAGIC = b"FACTCOL\x00"
+FORMAT_VERSION = 1
+PREAMBLE = struct.Struct("<8sQ")
+ALIGNMENT = 64 # bytes, every array starts at a multiple of this
+NUMERIC_KINDS = "biufc"
+FILE_EXTENSION = ".fcol"
+CODE_DTYPE = np.dtype("<i4") # codes of the category columns written by ColumnarWriter
+
+def aligned(offset):
+    """ Rounds offset up to the next multiple of ALIGNMENT """
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+class ColumnLayout:
+    """ Collects the arrays of a table and assigns their (aligned) offsets """
+    def __init__(self):
+        self.size = 0
+        self.arrays = []
+
+    def add(self, array):
+        """ Adds an array, returns its entry (dtype, offset, count) """
+        array = np.ascontiguousarray(array)
+        offset = aligned(self.size)
+        self.arrays.append((offset, array))
+        self.size = offset + array.nbytes
+        return {"dtype":array.dtype.str, "offset":offset, "count":len(array)}
+
+    def add_file(self, path, dtype, count):
+        """
+        Adds an array stored as raw values in a file, returns its entry
+        Only write_stream can write these, the file is read when the data is written
+        """
+        dtype = np.dtype(dtype)
+        offset = aligned(self.size)
+        self.arrays.append((offset, path))
+        self.size = offset + dtype.itemsize * count
+        return {"dtype":dtype.str, "offset":offset, "count":count}
+
+    def add_values(self, values):
+        """ Adds the distinct values of a categorical, strings as offsets / utf-8 data """
+        values = np.asarray(values)
+        if values.dtype.kind in NUMERIC_KINDS:
+            return {"kind":"numeric", "array":self.add(values)}
+        if not all(isinstance(v, str) for v in values):
+            raise TypeError("Only numeric and string values can be stored")
+        data = [v.encode("utf-8") for v in values]
+        offsets = np.zeros(len(data) + 1, dtype=np.int64)
+        np.cumsum([len(d) for d in data], out=offsets[1:])
+        return {"kind":"str", "offsets":self.add(offsets),
+                "data":self.add(np.frombuffer(b"".join(data), dtype=np.uint8))}
+
+    def add_column(self, name, series):
+        """ Adds a column and returns its entry """
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            cat = series.cat
+        elif series.dtype == object:
+            # Strings are interned into a categorical, every distinct value is stored once
+            cat = series.astype("category").cat
+        else:
+            values = series.to_numpy()
+            if values.dtype.kind not in NUMERIC_KINDS:
+                raise TypeError("Column %s of dtype %s cannot be stored" % (name, series.dtype))
+            return {"name":name, "kind":"numeric", "array":self.add(values)}
+        return {"name":name, "kind":"category", "ordered":bool(cat.ordered),
+                "codes":self.add(cat.codes.to_numpy()),
+                "categories":self.add_values(cat.categories.to_numpy())}
+
+    def write_to(self, buf):
+        """ Copies the arrays into buf (a uint8 array of at least size bytes) """
+        for (offset, array) in self.arrays:
+            buf[offset:offset + array.nbytes] = array.view(np.uint8)
+
+    def write_stream(self, fobj):
+        """ Writes the arrays (and the files of add_file) with their padding to a file object """
+        position = 0
+        for (offset, array) in self.arrays:
+            fobj.write(b"\0" * (offset - position))
+            if isinstance(array, str):
+                with open(array, "rb") as source:
+                    shutil.copyfileobj(source, fobj)
+                position = offset + os.path.getsize(array)
+            else:
+                fobj.write(array.data)
+                position = offset + array.nbytes
+        fobj.write(b"\0" * (self.size - position))
+
+def view_array(base, entry):
+    """ Read only view of an array entry into base (uint8 array) """
+    dtype = np.dtype(entry["dtype"])
+    start = entry["offset"]
+    array = base[start:start + entry["count"] * dtype.itemsize].view(dtype)
+    array.flags.writeable = False
+    return array
+
+def decode_values(base, entry):
+    """ The distinct values of a category column """
+    if entry["kind"] == "numeric":
+        return view_array(base, entry["array"])
+    offsets = view_array(base, entry["offsets"])
+    data = view_array(base, entry["data"]).tobytes()
+    return [data[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+
+def decode_column(base, entry):
+    """ Array or categorical of a column entry, the values / codes are views into base """
+    if entry["kind"] == "numeric":
+        return view_array(base, entry["array"])
+    dtype = pd.CategoricalDtype(decode_values(base, entry["categories"]), ordered=entry["ordered"])
+    return pd.Categorical.from_codes(view_array(base, entry["codes"]), dtype=dtype)
+
+def write_columnar(df, path, metadata=None):
+    """
+    Writes df (index is dropped) to a columnar file, metadata must be json serialisable and is
+    merged over df.attrs
+    """
+    layout = ColumnLayout()
+    columns = [layout.add_column(str(col), df[col]) for col in df.columns]
+    meta = dict(df.attrs)
+    meta.update(metadata or {})
+    _write_file(path, len(df), meta, columns, layout)
+
+def _write_file(path, rows, metadata, columns, layout):
+    """ Writes the header and the data of layout to path """
+    header = json.dumps({"version":FORMAT_VERSION, "rows":rows, "metadata":metadata,
+                         "columns":columns}).encode("utf-8")
+    data_start = aligned(PREAMBLE.size + len(header))
+    # Written next to the target and renamed, so readers never see a partial file
+    with open(path + ".tmp", "wb") as fobj:
+        fobj.write(PREAMBLE.pack(MAGIC, len(header)))
+        fobj.write(header)
+        fobj.write(b"\0" * (data_start - PREAMBLE.size - len(header)))
+        layout.write_stream(fobj)
+    os.replace(path + ".tmp", path)
+
+class ColumnarWriter:
+    """
+    Writes a columnar file chunk by chunk, e.g. from the rows of factools.merge.merge_runs
+    Every column has a fixed dtype and is spilled to a temporary file next to the target, close
+    assembles the file. Only the current chunk and the distinct values of the category columns
+    are held in memory, categories are numbered in the order they appear.
+
+    dtypes - dict column name -> numeric dtype or "category", in column order
+    metadata - json serialisable dict stored with the table
+    Used as context manager the file is written on exit, or discarded after an exception.
+    """
+    def __init__(self, path, dtypes, metadata=None):
+        self.path = path
+        self.dtypes = dict((name, dtype if dtype == "category" else np.dtype(dtype))
+                           for (name, dtype) in dtypes.items())
+        self.metadata = dict(metadata or {})
+        self.rows = 0
+        self._categories = dict((name, {}) for (name, dtype) in self.dtypes.items()
+                                if dtype == "category")
+        self._spill = dict((name, open("%s.%d.tmp" % (path, i), "wb"))
+                           for (i, name) in enumerate(self.dtypes))
+
+    def append(self, chunk):
+        """ Appends rows, chunk maps every column name to its values (a DataFrame or a dict) """
+        count = 0
+        for (name, dtype) in self.dtypes.items():
+            if dtype == "category":
+                categories = self._categories[name]
+                # Missing values (None / NaN) get the code -1
+                array = np.fromiter((-1 if value is None or value != value
+                                     else categories.setdefault(value, len(categories))
+                                     for value in chunk[name]), dtype=CODE_DTYPE)
+            else:
+                array = np.asarray(chunk[name], dtype=dtype)
+            array.tofile(self._spill[name])
+            count = len(array)
+        self.rows += count
+
+    def close(self):
+        """ Writes the file and removes the spill files """
+        layout = ColumnLayout()
+        columns = []
+        for (name, dtype) in self.dtypes.items():
+            spill = self._spill[name]
+            spill.close()
+            if dtype == "category":
+                categories = np.array(list(self._categories[name]), dtype=object)
+                columns.append({"name":name, "kind":"category", "ordered":False,
+                                "codes":layout.add_file(spill.name, CODE_DTYPE, self.rows),
+                                "categories":layout.add_values(categories)})
+            else:
+                columns.append({"name":name, "kind":"numeric",
+                                "array":layout.add_file(spill.name, dtype, self.rows)})
+        try:
+            _write_file(self.path, self.rows, self.metadata, columns, layout)
+        finally:
+            self.discard()
+
+    def discard(self):
+        """ Removes the spill files without writing the file """
+        for spill in self._spill.values():
+            spill.close()
+            if os.path.exists(spill.name):
+                os.remove(spill.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+class ColumnarFile:
+    """ A memory mapped columnar file, columns are only read when they are accessed """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fobj:
+            (magic, header_len) = PREAMBLE.unpack(fobj.read(PREAMBLE.size))
+            if magic != MAGIC:
+                raise ValueError("%s is not a columnar table file" % path)
+            self.header = json.loads(fobj.read(header_len).decode("utf-8"))
+        if self.header["version"] > FORMAT_VERSION:
+            raise ValueError("%s has format version %d, only %d is supported" %
+                             (path, self.header["version"], FORMAT_VERSION))
+        data_start = aligned(PREAMBLE.size + header_len)
+        if os.path.getsize(path) > data_start:
+            self._base = np.memmap(path, dtype=np.uint8, mode="r", offset=data_start)
+        else:
+            # np.memmap cannot map an empty range
+            self._base = np.zeros(0, dtype=np.uint8)
+        self._entries = {entry["name"]:entry for entry in self.header["columns"]}
+
+    @property
+    def metadata(self):
+        """ The metadata dict stored with the table """
+        return self.header["metadata"]
+
+    @property
+    def columns(self):
+        """ Column names in file order """
+        return [entry["name"] for entry in self.header["columns"]]
+
+    def __len__(self):
+        return self.header["rows"]
+
+    def column(self, name):
+        """ A column as read only memory mapped array (numeric) or categorical """
+        return decode_column(self._base, self._entries[name])
+
+    def frame(self, columns=None):
+        """ DataFrame of the given (default: all) columns, without copying the numeric data """
+        columns = self.columns if columns is None else columns
+        df = pd.DataFrame({name:self.column(name) for name in columns}, columns=columns,
+                          copy=False)
+        df.attrs.update(self.metadata)
+        return df
+
+def read_columnar(path, columns=None):
+    """ Returns (metadata, DataFrame) of a columnar file, see ColumnarFile.frame """
+    table = ColumnarFile(path)
+    return (table.metadata, table.frame(columns))
@@ -0,0 +1,161 @@
+"""
+A container for the FAC data of a single ion, which computes the derived products (reconstructed
+levels, name index, decay summaries, DR tables) on first use and keeps them for later analyses
+
+Usage:
+ds = DRDataset.from_files("cs/Cs_LMM-Li")
+trans = ds.transition_table()
+recomb = ds.recombination_table()   # reuses the transition table
+ds.invalidate("tr")                 # after modifying ds.tr, drops everything derived from it
+"""
+
+import numpy as np
+import pandas as pd
+
+import factools.dr as dr
+import factools.fileimport
+import factools.reconstruction
+
+TOTAL_AI_RATE = "TOTAL_AI_RATE"
+TOTAL_TR_RATE = "TOTAL_TR_RATE"
+FLUORESCENCE_YIELD = "FLUORESCENCE_YIELD"
+
+# Cached products and the inputs / products they are computed from
+DEPENDENCIES = {"levels":["lev"],
+                "level_index":["levels"],
+                "decay_summary":["ai", "tr"],
+                "classified_ai":["ai", "level_index"],
+                "transition_table":["classified_ai", "tr", "level_index"],
+                "recombination_table":["transition_table"]}
+INPUTS = ["lev", "ai", "tr"]
+
+class DRDataset:
+    """
+    The lev, ai and tr tables of one ion with lazily computed, cached intermediates
+
+    lev_df, ai_df, tr_df - dataframes as returned by the fileimport methods, lev_df may already be
+                           reconstructed (amend_level_dataframe)
+    filter_gs - only use ai transitions starting in the ground state (see dr_transition_table)
+
+    The inputs are available as the attributes lev, ai and tr. The cached products are not
+    updated automatically if these are changed or replaced, call invalidate afterwards.
+    """
+    def __init__(self, lev_df, ai_df, tr_df, filter_gs=True):
+        self.lev = lev_df
+        self.ai = ai_df
+        self.tr = tr_df
+        self.filter_gs = filter_gs
+        self._cache = {}
+
+    @classmethod
+    def from_files(cls, stub, compact=False, filter_gs=True):
+        """ Reads stub.lev, stub.ai and stub.tr """
+        (_, lev_df) = factools.fileimport.read_lev(stub + ".lev", compact=compact)
+        (_, ai_df) = factools.fileimport.read_ai(stub + ".ai", compact=compact)
+        (_, tr_df) = factools.fileimport.read_tr(stub + ".tr", compact=compact)
+        return cls(lev_df, ai_df, tr_df, filter_gs)
+
+    def _cached(self, name, compute):
+        """ Returns the cached product name, computes it first if necessary """
+        if name not in self._cache:
+            self._cache[name] = compute()
+        return self._cache[name]
+
+    def cached(self):
+        """ Names of the products that are currently cached """
+        return list(self._cache)
+
+    def invalidate(self, *names):
+        """
+        Drops cached products, together with everything computed from them
+        names - input (lev, ai, tr) or product names, all products are dropped if none are given
+        """
+        if not names:
+            self._cache.clear()
+            return
+        unknown = set(names) - set(INPUTS) - set(DEPENDENCIES)
+        if unknown:
+            raise KeyError("Unknown inputs / products: " + ", ".join(sorted(unknown)))
+        stale = set(names)
+        changed = True
+        while changed:
+            changed = False
+            for (product, deps) in DEPENDENCIES.items():
+                if product not in stale and stale.intersection(deps):
+                    stale.add(product)
+                    changed = True
+        for name in stale:
+            self._cache.pop(name, None)
+
+    @property
+    def levels(self):
+        """ Level table with the reconstructed configurations (categorical strings) """
+        def compute():
+            if dr.FULL_NAME in self.lev.columns:
+                return self.lev
+            return factools.reconstruction.amend_level_dataframe(self.lev, categorical=True)
+        return self._cached("levels", compute)
+
+    @property
+    def level_index(self):
+        """ (lookup, names) with the name of level ilev being names[lookup[ilev]] """
+        return self._cached("level_index", lambda: dr.level_name_codes(self.levels))
+
+    def level_names(self, ilevs):
+        """ Full names of the levels ilevs (array like) """
+        (lookup, names) = self.level_index
+        return np.asarray(names)[lookup[np.asarray(ilevs)]]
+
+    @property
+    def decay_summary(self):
+        """
+        Per (autoionising) level: total AI rate (all ai rows, independent of filter_gs), total
+        TR rate and fluorescence yield TR / (TR + AI), indexed by ILEV
+        """
+        def compute():
+            total_ai = self.ai[dr.AI_RATE].astype(np.float64).groupby(self.ai[dr.BOUND_ILEV]).sum()
+            total_tr = self.tr[dr.TR_RATE].astype(np.float64).groupby(self.tr[dr.UPPER_ILEV]).sum()
+            summary = pd.DataFrame({TOTAL_AI_RATE:total_ai, TOTAL_TR_RATE:total_tr}).fillna(0.0)
+            total = summary[TOTAL_AI_RATE] + summary[TOTAL_TR_RATE]
+            summary[FLUORESCENCE_YIELD] = summary[TOTAL_TR_RATE] / total.where(total > 0)
+            summary.index.name = "ILEV"
+            return summary
+        return self._cached("decay_summary", compute)
+
+    @property
+    def classified_ai(self):
+        """
+        The (ground state filtered) ai rows in transition table notation, with RECOMB_TYPE and
+        RECOMB_NAME
+        """
+        def compute():
+            ai_df = dr.filter_ground_state(self.ai) if self.filter_gs else self.ai
+            (lookup, names) = self.level_index
+            return dr.classify_recombination(dr.ai_table(ai_df, lookup), names)
+        return self._cached("classified_ai", compute)
+
+    def _transition_table(self):
+        """ Cached categorical transition table """
+        def compute():
+            (lookup, names) = self.level_index
+            dr_tab = dr.join_tr(self.classified_ai, dr.tr_table(self.tr))
+            dr_tab.sort_values([dr.DE_AI, dr.DE_TR], inplace=True, kind="mergesort")
+            return dr.finish_transition_table(dr_tab, lookup, names)
+        return self._cached("transition_table", compute)
+
+    def transition_table(self, categorical=False):
+        """
+        Same as dr.dr_transition_table for this ion
+        With categorical=True the cached table itself is returned, it must not be modified
+        """
+        dr_tab = self._transition_table()
+        return dr_tab if categorical else dr.decode_categoricals(dr_tab)
+
+    def recombination_table(self, categorical=False):
+        """
+        Same as dr.dr_recombination_table for this ion, computed from the cached transition table
+        With categorical=True the cached table itself is returned, it must not be modified
+        """
+        recomb = self._cached("recombination_table",
+                              lambda: dr.recombination_from_transitions(self._transition_table()))
+        return recomb if categorical else dr.decode_categoricals(recomb)
@@ -1,10 +1,17 @@
 """
 Contains Methods for extracting DR related data from FAC Results
+
+numpy and pandas are only imported when a table is built, so that recomb_info and the column
+names can be used in light processes without paying for their import (see factools.lazy).
 """
 
-import pandas as pd
+from factools import instrument
+from factools.lazy import lazy_import
 from factools.reconstruction import parse_name
 
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
 INIT_ILEV = "INITAL_ILEV"
 TRANS_ILEV = "TRANSIENT_ILEV"
 FINAL_ILEV = "FINAL_ILEV"
@@ -25,8 +32,22 @@ RECOMB_STRENGTH = "RECOMB_STRENGTH"
 TRANSITION_STRENGTH = "TRANSITION_STRENGTH"
 RECOMB_TYPE = "RECOMB_TYPE"
 RECOMB_NAME = "RECOMB_NAME"
+FULL_NAME = "FULL_NAME"
+
+# Bound for the relative deviation of TRANSITION_STRENGTH and RECOMB_STRENGTH computed from
+# compact (float32) tables: each of the TR rate, the total TR + AI rate and the DC strength
+# carries at most 2**-24 relative rounding error, plus one rounding of the result to float32
+COMPACT_RTOL = 5 * 2.0**-24
+
+# Columns of the transition and recombination tables
+TRANSITION_COLUMNS = [INIT_ILEV, INIT_NAME, TRANS_ILEV, TRANS_NAME, FINAL_ILEV, FINAL_NAME,
+                      RECOMB_TYPE, RECOMB_NAME, DE_AI, AI_RATE, DC_STRENGTH, DE_TR, TR_RATE,
+                      TRANSITION_STRENGTH]
+RECOMBINATION_COLUMNS = [DE_AI, RECOMB_STRENGTH, RECOMB_TYPE, RECOMB_NAME]
 
 RECOMB_TYPES = {2:"DR", 3:"TR", 4:"QR"}
+# df.attrs key of the fraction of the DC strength removed by max_order / min_strength pruning
+PRUNED_FRACTION = "pruned_strength_fraction"
 SHELL_NAMES = {1:"K", 2:"L", 3:"M", 4:"N", 5:"O", 6:"P", 7:"Q", 8:"R"}
 
 def recomb_info(inital_name, transient_name):
@@ -63,81 +84,392 @@ def recomb_info(inital_name, transient_name):
 
     return (re_type, re_name)
 
-def dr_recombination_table(lev_df, ai_df, tr_df, filter_gs=True, verbose=False):
+def recomb_order(re_type):
+    """ Number of electrons involved in a recombination type, e.g. 2 for DR, 5 for 5R """
+    for (order, name) in RECOMB_TYPES.items():
+        if name == re_type:
+            return order
+    return int(re_type[:-1])
+
+def dr_recombination_table(lev_df, ai_df, tr_df, filter_gs=True, verbose=False,
+                           categorical=False, workers=None, max_order=None, min_strength=None,
+                           min_rel_strength=None, transient_names=False):
     """
     Assembles a condensed table of di(multi)electronic recombinations
     where all optical transition information is omitted and purely the recombination matters
     I.e. electron energy, total recombination strength, recom type.
+
+    categorical - return RECOMB_TYPE and RECOMB_NAME as pandas categoricals
+    workers - number of processes used for the transition table, see dr_transition_table
+    max_order, min_strength, min_rel_strength - pruning, see dr_transition_table
+    transient_names - add the name of the transient level (TRANSIENT_NAME) as last column, which
+                      identifies the resonances when tables are compared (factools.tablediff)
     """
-    COL_ORDER = [DE_AI, RECOMB_STRENGTH, RECOMB_TYPE, RECOMB_NAME]
-    df = dr_transition_table(lev_df, ai_df, tr_df, filter_gs, verbose)
-    grp = df.groupby([INIT_ILEV, TRANS_ILEV, RECOMB_TYPE, RECOMB_NAME], as_index=False)
+    df = dr_transition_table(lev_df, ai_df, tr_df, filter_gs, verbose, categorical=True,
+                             workers=workers, max_order=max_order, min_strength=min_strength,
+                             min_rel_strength=min_rel_strength)
+    recomb = recombination_from_transitions(df, transient_names)
+    if not categorical:
+        recomb = decode_categoricals(recomb)
+    recomb.attrs[PRUNED_FRACTION] = df.attrs[PRUNED_FRACTION]
+    return recomb
 
-    recomb = grp.agg({TRANSITION_STRENGTH:"sum", DE_AI:"mean"})
-    recomb.rename(columns={TRANSITION_STRENGTH:RECOMB_STRENGTH}, inplace=True)
-    recomb.drop([INIT_ILEV, TRANS_ILEV], axis=1, inplace=True)
-    recomb.sort_values(DE_AI, inplace=True)
-    recomb.reset_index(drop=True, inplace=True)
-    recomb = recomb[COL_ORDER]
+def recombination_from_transitions(df, transient_names=False):
+    """
+    Condenses a (categorical) transition table into the (categorical) recombination table
+    This is the second half of dr_recombination_table, for callers that already hold the
+    transition table (e.g. factools.dataset.DRDataset)
+    transient_names - keep TRANSIENT_NAME, see dr_recombination_table
+    """
+    COL_ORDER = RECOMBINATION_COLUMNS + ([TRANS_NAME] if transient_names else [])
+    # The name is determined by the transient level, grouping by it does not change the groups
+    keys = [INIT_ILEV, TRANS_ILEV] + ([TRANS_NAME] if transient_names else [])
+    with instrument.stage("dr.recombination_table") as st:
+        # The recombination strengths are always accumulated in float64
+        df = df.assign(**{TRANSITION_STRENGTH:df[TRANSITION_STRENGTH].astype(np.float64)})
+        # The categorical labels make this a groupby on integer codes
+        grp = df.groupby(keys + [RECOMB_TYPE, RECOMB_NAME], as_index=False, observed=True)
+
+        recomb = grp.agg({TRANSITION_STRENGTH:"sum", DE_AI:"mean"})
+        recomb.rename(columns={TRANSITION_STRENGTH:RECOMB_STRENGTH}, inplace=True)
+        recomb.drop([INIT_ILEV, TRANS_ILEV], axis=1, inplace=True)
+        recomb.sort_values(DE_AI, inplace=True)
+        recomb.reset_index(drop=True, inplace=True)
+        recomb = recomb[COL_ORDER]
+        st.add_rows(len(recomb))
     return recomb
 
+def decode_categoricals(df):
+    """
+    Returns a copy of df where all categorical columns are converted back to plain strings
+    """
+    df = df.copy()
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(object)
+    return df
+
+def level_name_codes(lev_df, name=FULL_NAME):
+    """
+    Interns the level names of a (reconstructed) level dataframe
+    Returns a lookup array mapping ILEV to the code of its name and the array of unique names,
+    i.e. the name of level ilev is names[lookup[ilev]]
+    """
+    names = pd.Categorical(lev_df[name])
+    ilev = lev_df["ILEV"].values
+    lookup = np.full(ilev.max() + 1, -1, dtype=np.int32)
+    # Reverse assignment, so that for duplicate ILEVs the first entry wins
+    lookup[ilev[::-1]] = names.codes[::-1]
+    return lookup, names.categories
 
-def dr_transition_table(lev_df, ai_df, tr_df, filter_gs=True, verbose=False):
+def _recomb_info_codes(init_codes, trans_codes, names):
+    """
+    Applies recomb_info to pairs of name codes, every unique pair is only classified once
+    Returns categoricals for RECOMB_TYPE and RECOMB_NAME
+    """
+    pair_keys = init_codes.astype(np.int64) * len(names) + trans_codes
+    (unique_keys, inverse) = np.unique(pair_keys, return_inverse=True)
+    infos = [recomb_info(names[k // len(names)], names[k % len(names)]) for k in unique_keys]
+    re_types = _from_codes(inverse, [i[0] for i in infos])
+    re_names = _from_codes(inverse, [i[1] for i in infos])
+    return re_types, re_names
+
+def _from_codes(codes, categories):
+    """ Like pd.Categorical.from_codes but merges duplicate categories """
+    (uniques, inverse) = np.unique(np.asarray(categories, dtype=object), return_inverse=True)
+    return pd.Categorical.from_codes(inverse[codes], uniques)
+
+def dr_transition_table(lev_df, ai_df, tr_df, filter_gs=True, verbose=False, categorical=False,
+                        workers=None, max_order=None, min_strength=None, min_rel_strength=None):
     """
     Assembles a detailed table of (di) electronic recombinations based on the FAC files
 
     filter_gs - filter table  to contain only transitions starting in the ground state
+    categorical - return the level names and recombination labels as pandas categoricals,
+                  which share one interned string table per level dataframe
+    workers - number of processes the transient levels are distributed over (None or 1 for serial
+              processing), the result is identical to the serial one
+              The pool start and the transfer of the results cost more than the join saves on
+              small tables, measure with benchmarks/run_benchmarks.py --check-workers before
+              using it (one core: 1.9 s with 2 workers vs 1.0 s serial for 100k transitions)
+    max_order - drop resonances of higher order than this, e.g. 3 for DR and TR only (see
+                RECOMB_TYPES)
+    min_strength - drop resonances (ai rows) with a smaller DC strength than this
+    min_rel_strength - same relative to the total DC strength of the (filtered) ai rows
+    The pruning happens before the radiative decays are joined and the names are resolved, the
+    fraction of the total DC strength that was removed is stored in df.attrs[PRUNED_FRACTION].
+
+    The numeric columns keep the types of the input tables, i.e. compact (float32) input gives
+    a compact table. The total TR rates and the strengths are computed in float64 and rounded once,
+    so TRANSITION_STRENGTH deviates from the float64 result by at most COMPACT_RTOL (relative).
     """
+    with instrument.stage("dr.transition_table") as st_total:
+        if filter_gs:
+            ai_df = filter_ground_state(ai_df)
+
+        with instrument.stage("dr.name_lookup") as st:
+            (lookup, names) = level_name_codes(lev_df)
+            ai_tab = ai_table(ai_df, lookup)
+            st.add_rows(len(ai_df))
 
-    def get_name(ilev):
-        """ grabs the sname for ilev from the level dataframe """
-        row_ind = lev_df.index[lev_df["ILEV"] == ilev].tolist()[0]
-        return lev_df.at[row_ind, "FULL_NAME"]
+        (ai_tab, pruned_fraction) = _prune(ai_tab, names, max_order, min_strength,
+                                           min_rel_strength)
+        tr_tab = tr_table(tr_df)
 
-    COL_ORDER = [INIT_ILEV, INIT_NAME, TRANS_ILEV, TRANS_NAME, FINAL_ILEV, FINAL_NAME, RECOMB_TYPE,
-                 RECOMB_NAME, DE_AI, AI_RATE, DC_STRENGTH, DE_TR, TR_RATE, TRANSITION_STRENGTH]
+        if workers is not None and workers > 1 and len(ai_tab):
+            with instrument.stage("dr.parallel_join") as st:
+                ai_tab = ai_tab.drop(columns=[RECOMB_TYPE, RECOMB_NAME], errors="ignore")
+                dr_tab = _parallel_join(ai_tab, tr_tab, names, workers)
+                st.add_rows(len(dr_tab))
+        else:
+            if RECOMB_TYPE in ai_tab.columns:
+                # Already classified for the order pruning
+                dr_tab = join_tr(ai_tab, tr_tab)
+            else:
+                dr_tab = _join(ai_tab, tr_tab, names)
+            dr_tab.sort_values([DE_AI, DE_TR], inplace=True, kind="mergesort")
+
+        dr_tab = finish_transition_table(dr_tab, lookup, names)
+        if verbose:
+            _print_transitions(dr_tab)
+        if not categorical:
+            dr_tab = decode_categoricals(dr_tab)
+        dr_tab.attrs[PRUNED_FRACTION] = pruned_fraction
+        st_total.add_rows(len(dr_tab))
+    return dr_tab
+
+def _prune(ai_tab, names, max_order, min_strength, min_rel_strength):
+    """
+    Drops the ai rows below the strength thresholds or above the recombination order, the rows
+    are classified for the order pruning (only the remaining ones)
+    Returns the remaining rows and the fraction of the total DC strength that was removed
+    """
+    if max_order is None and min_strength is None and min_rel_strength is None:
+        return (ai_tab, 0.0)
+    with instrument.stage("dr.prune") as st:
+        strength = ai_tab[DC_STRENGTH].values.astype(np.float64)
+        total = strength.sum()
+        keep = np.ones(len(ai_tab), dtype=bool)
+        if min_strength is not None:
+            keep &= strength >= min_strength
+        if min_rel_strength is not None:
+            keep &= strength >= min_rel_strength * total
+        ai_tab = ai_tab.loc[keep]
+        if max_order is not None:
+            ai_tab = classify_recombination(ai_tab, names)
+            re_types = ai_tab[RECOMB_TYPE].values
+            orders = np.array([recomb_order(t) for t in re_types.categories], dtype=np.int64)
+            ai_tab = ai_tab.loc[orders[re_types.codes] <= max_order]
+        removed = total - ai_tab[DC_STRENGTH].values.astype(np.float64).sum()
+        st.add_rows(len(ai_tab))
+    return (ai_tab, removed / total if total > 0 else 0.0)
 
-    if filter_gs:
+def filter_ground_state(ai_df):
+    """ Returns the ai rows that start in the ground state (lowest FREE_ILEV) """
+    with instrument.stage("dr.filter_gs") as st:
         ai_df = ai_df.loc[ai_df[FREE_ILEV] == ai_df[FREE_ILEV].min()]
+        st.add_rows(len(ai_df))
+    return ai_df
+
+def ai_table(ai_df, lookup):
+    """
+    The ai columns needed for the transition table, with the codes of the level names
+    ai_df - (ground state filtered) output of fileimport.read_ai
+    lookup - ILEV -> name code array of level_name_codes
+    The building blocks of dr_transition_table are ai_table, tr_table, classify_recombination,
+    join_tr and finish_transition_table (after sorting by energy), see dr_transition_table
+    """
+    return pd.DataFrame({INIT_ILEV:ai_df[FREE_ILEV].values,
+                         TRANS_ILEV:ai_df[BOUND_ILEV].values,
+                         "_INIT_CODE":lookup[ai_df[FREE_ILEV].values],
+                         "_TRANS_CODE":lookup[ai_df[BOUND_ILEV].values],
+                         DE_AI:ai_df[DE].values,
+                         AI_RATE:ai_df[AI_RATE].values,
+                         DC_STRENGTH:ai_df[DC_STRENGTH].values})
 
-    dr_tab = []
-    for (_, ai_row) in ai_df.iterrows():
-        dr_row = {}
-        # Load Level IDs and snames
-        dr_row[INIT_ILEV] = ai_row[FREE_ILEV]
-        dr_row[TRANS_ILEV] = ai_row[BOUND_ILEV]
-        dr_row[INIT_NAME] = get_name(dr_row[INIT_ILEV])
-        dr_row[TRANS_NAME] = get_name(dr_row[TRANS_ILEV])
-        # Load AI Data
-        dr_row[DE_AI] = ai_row[DE]
-        dr_row[AI_RATE] = ai_row[AI_RATE]
-        dr_row[DC_STRENGTH] = ai_row[DC_STRENGTH]
-        re_type, re_name = recomb_info(dr_row[INIT_NAME], dr_row[TRANS_NAME])
-        dr_row[RECOMB_TYPE] = re_type
-        dr_row[RECOMB_NAME] = re_name
-        # Go thorugh all related radiative decays
-        filtered_tr = tr_df.loc[tr_df[UPPER_ILEV] == dr_row[TRANS_ILEV]]
-        total_tr_rate = filtered_tr["TR_RATE"].sum()
-        for (_, tr_row) in filtered_tr.iterrows():
-            # Load Final state ID and sname
-            dr_row[FINAL_ILEV] = int(tr_row[LOWER_ILEV])
-            dr_row[FINAL_NAME] = get_name(dr_row[FINAL_ILEV])
-            # Load TR Data
-            dr_row[DE_TR] = tr_row[DE]
-            dr_row[TR_RATE] = tr_row[TR_RATE]
-            # Compute recomb strength
-            rad_frac = dr_row[TR_RATE] / (total_tr_rate + dr_row[AI_RATE])
-            dr_row[TRANSITION_STRENGTH] = rad_frac * dr_row[DC_STRENGTH]
-            dr_tab.append(dr_row.copy())
-            if verbose:
-                print(dr_row[RECOMB_TYPE], "---", dr_row[RECOMB_NAME],
-                      "\n", dr_row[INIT_NAME],
-                      "\n-->", dr_row[TRANS_NAME],
-                      "\n-->", dr_row[FINAL_NAME],
-                      "\n--------------------------------------------")
-
-    dr_tab = pd.DataFrame(dr_tab)
+def tr_table(tr_df):
+    """ The tr columns needed for the transition table, tr_df is the output of read_tr """
+    return pd.DataFrame({TRANS_ILEV:tr_df[UPPER_ILEV].values,
+                         FINAL_ILEV:tr_df[LOWER_ILEV].values,
+                         DE_TR:tr_df[DE].values,
+                         TR_RATE:tr_df[TR_RATE].values})
+
+def finish_transition_table(dr_tab, lookup, names):
+    """
+    Adds the level names to a joined table (join_tr, sorted by energy) and brings the columns in
+    order, lookup and names are the output of level_name_codes
+    """
+    COL_ORDER = TRANSITION_COLUMNS
+    dr_tab[INIT_NAME] = _from_codes(dr_tab["_INIT_CODE"].values, names)
+    dr_tab[TRANS_NAME] = _from_codes(dr_tab["_TRANS_CODE"].values, names)
+    dr_tab[FINAL_NAME] = _from_codes(lookup[dr_tab[FINAL_ILEV].values], names)
     dr_tab = dr_tab[COL_ORDER]
-    dr_tab.sort_values([DE_AI, DE_TR], inplace=True)
     dr_tab.reset_index(drop=True, inplace=True)
     return dr_tab
+
+def _print_transitions(dr_tab):
+    """ Prints every transition of a transition table """
+    for row in dr_tab.itertuples(index=False):
+        print(row[6], "---", row[7],
+              "\n", row[1],
+              "\n-->", row[3],
+              "\n-->", row[5],
+              "\n--------------------------------------------")
+
+def _join(ai_tab, tr_tab, names):
+    """
+    Classifies the ai transitions and joins them with the radiative decays of their transient
+    levels, the work for different transient levels is independent
+    Returns the unsorted table with the name codes instead of the names
+    """
+    return join_tr(classify_recombination(ai_tab, names), tr_tab)
+
+def classify_recombination(ai_tab, names):
+    """
+    Adds the RECOMB_TYPE and RECOMB_NAME columns to an ai table (ai_table), names are the level
+    names of level_name_codes
+    """
+    with instrument.stage("dr.recomb_info") as st:
+        (re_types, re_names) = _recomb_info_codes(ai_tab["_INIT_CODE"].values,
+                                                  ai_tab["_TRANS_CODE"].values, names)
+        st.add_rows(len(re_types.categories))
+    return ai_tab.assign(**{RECOMB_TYPE:re_types, RECOMB_NAME:re_names})
+
+def join_tr(ai_tab, tr_tab):
+    """
+    Joins the (classified) ai table with the radiative decays of tr_tab (tr_table) and computes
+    the transition strengths, the result is unsorted and holds name codes instead of names
+    """
+    # Join all related radiative decays
+    with instrument.stage("dr.tr_filter") as st:
+        tr_tab = tr_tab.loc[tr_tab[TRANS_ILEV].isin(ai_tab[TRANS_ILEV].unique())]
+        # Sums are accumulated in float64, also for compact (float32) input
+        total_tr_rate = tr_tab[TR_RATE].astype(np.float64).groupby(tr_tab[TRANS_ILEV]).sum()
+        dr_tab = ai_tab.merge(tr_tab, on=TRANS_ILEV, how="inner", sort=False)
+        st.add_rows(len(tr_tab))
+
+    # Compute recomb strength
+    rad_frac = (dr_tab[TR_RATE].astype(np.float64)
+                / (dr_tab[TRANS_ILEV].map(total_tr_rate) + dr_tab[AI_RATE].astype(np.float64)))
+    strength = rad_frac * dr_tab[DC_STRENGTH].astype(np.float64)
+    dr_tab[TRANSITION_STRENGTH] = strength.astype(dr_tab[DC_STRENGTH].dtype)
+    return dr_tab
+
+# Tables of the parent process, set in the worker processes by _init_worker
+_WORKER_DATA = {}
+
+def _init_worker(ai_tab, tr_tab, names):
+    """
+    Pool initializer, stores the shared tables in the worker. With the fork start method the
+    arguments are inherited from the parent, otherwise they are pickled once per worker
+    """
+    _WORKER_DATA["ai"] = ai_tab
+    _WORKER_DATA["tr"] = tr_tab
+    _WORKER_DATA["names"] = names
+
+def _join_task(bounds):
+    """
+    Classifies and joins the row ranges (of the level sorted tables) of a set of transient levels
+    Only the labels of the ai rows and the row positions and strengths of the joined table are
+    sent back, the parent gathers the remaining columns itself
+    """
+    (ai_lo, ai_hi, tr_lo, tr_hi) = bounds
+    ai_tab = classify_recombination(_WORKER_DATA["ai"].iloc[ai_lo:ai_hi], _WORKER_DATA["names"])
+    dr_tab = join_tr(ai_tab[[TRANS_ILEV, "_AI_POS", AI_RATE, DC_STRENGTH]],
+                      _WORKER_DATA["tr"].iloc[tr_lo:tr_hi][[TRANS_ILEV, "_TR_POS", TR_RATE]])
+    return (ai_tab[RECOMB_TYPE].values, ai_tab[RECOMB_NAME].values, dr_tab["_AI_POS"].values,
+            dr_tab["_TR_POS"].values, dr_tab[TRANSITION_STRENGTH].values)
+
+def _parallel_join(ai_tab, tr_tab, names, workers, tasks_per_worker=4):
+    """
+    _join distributed over a process pool by transient level, including the final sorting
+    The rows come in exactly the order of the serial version: the serial merge orders the rows
+    by the first appearance of the transient level in ai_tab, then by ai row and tr row, which
+    is restored before the stable sort by energy
+    """
+    # Imported here, only needed with workers
+    import multiprocessing
+    from pandas.api.types import union_categoricals
+    ai_tab = ai_tab.assign(_AI_POS=np.arange(len(ai_tab)))
+    tr_tab = tr_tab.loc[tr_tab[TRANS_ILEV].isin(ai_tab[TRANS_ILEV].unique())]
+    tr_tab = tr_tab.assign(_TR_POS=np.arange(len(tr_tab)))
+    ai_tab = ai_tab.sort_values(TRANS_ILEV, kind="mergesort")
+    tr_tab = tr_tab.sort_values(TRANS_ILEV, kind="mergesort")
+
+    # Split the transient levels into contiguous groups of similar cost (number of output rows)
+    (levels, ai_start) = np.unique(ai_tab[TRANS_ILEV].values, return_index=True)
+    ai_bounds = np.append(ai_start, len(ai_tab))
+    tr_bounds = np.searchsorted(tr_tab[TRANS_ILEV].values, levels)
+    tr_bounds = np.append(tr_bounds, len(tr_tab))
+    cost = np.cumsum(np.diff(ai_bounds) * (np.diff(tr_bounds) + 1))
+    n_tasks = min(len(levels), workers * tasks_per_worker)
+    cuts = np.searchsorted(cost, cost[-1] * np.arange(1, n_tasks) / n_tasks, side="right")
+    cuts = np.unique(np.concatenate([[0], cuts, [len(levels)]]))
+    tasks = [(int(ai_bounds[lo]), int(ai_bounds[hi]), int(tr_bounds[lo]), int(tr_bounds[hi]))
+             for (lo, hi) in zip(cuts[:-1], cuts[1:])]
+
+    if "fork" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("fork")
+    else:
+        ctx = multiprocessing.get_context()
+    with ctx.Pool(workers, initializer=_init_worker, initargs=(ai_tab, tr_tab, names)) as pool:
+        results = pool.map(_join_task, tasks)
+
+    # The tasks cover ai_tab in order, the labels of the parts have different categories
+    for (col, k) in ((RECOMB_TYPE, 0), (RECOMB_NAME, 1)):
+        union = union_categoricals([res[k] for res in results])
+        ai_tab[col] = _from_codes(union.codes, union.categories)
+    ai_pos = np.concatenate([res[2] for res in results])
+    tr_pos = np.concatenate([res[3] for res in results])
+    strength = np.concatenate([res[4] for res in results])
+
+    # Rows of ai_tab / tr_tab (level sorted) by original position
+    ai_row = np.empty(len(ai_tab), dtype=np.int64)
+    ai_row[ai_tab["_AI_POS"].values] = np.arange(len(ai_tab))
+    tr_row = np.empty(len(tr_tab), dtype=np.int64)
+    tr_row[tr_tab["_TR_POS"].values] = np.arange(len(tr_tab))
+    ai_row = ai_row[ai_pos]
+    tr_row = tr_row[tr_pos]
+
+    # The parts are ordered by transient level, then ai row and tr row. Reordering the levels by
+    # their first appearance in the (unsorted) ai table gives the order of the serial merge
+    first = np.empty(len(levels), dtype=np.int64)
+    first[np.argsort(ai_tab["_AI_POS"].values[ai_start], kind="stable")] = np.arange(len(levels))
+    rank = first[np.searchsorted(levels, ai_tab[TRANS_ILEV].values[ai_row])]
+    order = np.argsort(rank, kind="stable")
+    (ai_row, tr_row, strength) = (ai_row[order], tr_row[order], strength[order])
+    order = _parallel_energy_sort(ai_tab[DE_AI].values[ai_row], tr_tab[DE_TR].values[tr_row],
+                                  workers)
+    (ai_row, tr_row) = (ai_row[order], tr_row[order])
+
+    dr_tab = ai_tab.iloc[ai_row].reset_index(drop=True)
+    for col in (FINAL_ILEV, DE_TR, TR_RATE):
+        dr_tab[col] = tr_tab[col].values[tr_row]
+    dr_tab[TRANSITION_STRENGTH] = strength[order]
+    return dr_tab
+
+def _parallel_energy_sort(de_ai, de_tr, workers):
+    """
+    Stable argsort by (de_ai, de_tr) using threads (numpy sorts release the GIL)
+    The rows are range partitioned by de_ai, so equal energies always end up in the same bucket
+    and the concatenated bucket orders equal the order of a global stable sort
+    """
+    if not len(de_ai):
+        # No radiative decay joined, there are no energies to take splitters from
+        return np.arange(0)
+    # Imported here, only needed with workers
+    from concurrent.futures import ThreadPoolExecutor
+    def stable_order(idx):
+        order = np.argsort(de_tr[idx], kind="stable")
+        order = order[np.argsort(de_ai[idx][order], kind="stable")]
+        return idx[order]
+
+    # Splitters from a sample of the energies
+    sample = de_ai[::max(1, len(de_ai) // (1000 * workers))]
+    splitters = np.unique(np.quantile(sample, np.arange(1, workers) / workers))
+    bucket = np.searchsorted(splitters, de_ai, side="right").astype(np.int16)
+    by_bucket = np.argsort(bucket, kind="stable")
+    bounds = np.searchsorted(bucket[by_bucket], np.arange(len(splitters) + 2))
+    chunks = [by_bucket[lo:hi] for (lo, hi) in zip(bounds[:-1], bounds[1:])]
+    with ThreadPoolExecutor(workers) as executor:
+        return np.concatenate(list(executor.map(stable_order, chunks)))
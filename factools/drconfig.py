@@ -0,0 +1,275 @@
+"""
+Generator for the configuration groups of a DR channel
+
+Derives the initial, transient and final configuration groups for any channel (KLL, KLM, LMM,
+LMN, ...) and isoelectronic sequence from the ground configuration of the initial ion, replacing
+the hand written group definitions in fac_dr. For a channel XYZ an electron of shell X is excited
+to shell Y while the free electron is captured into shell Z. The final group contains every
+configuration reached by moving one electron of the transient configurations into a vacancy of a
+lower shell of the channel.
+
+The initial group is the complex of the initial ion in the shells of the channel (e.g. "1*2 2*1"
+for KLL-Li), so it also holds the excited initial levels the transient levels can autoionise into.
+This matches the hand written KLL and KLM groups, the hand written LMM groups only list the ground
+configuration (fac_dr.check_dr_types compares both).
+
+With prune=True the groups are reduced to the configurations that matter for DR from the ground
+state: the initial group only holds the ground configuration, the transient group only keeps
+configurations that are formed from the ground configuration by a single dielectronic capture (one
+excitation plus capture, e.g. 1s1 2p3 cannot be reached from 1s2 2s1), and final configurations
+that cannot be reached from these by a single electron E1 jump (delta l = +-1) are dropped. This
+shrinks the work of FAC's AITable and TransitionTable. Note that fac_dr computes all multipoles, so
+this also drops the weak forbidden decay channels.
+
+Usage:
+channel = dr_channel("LMM", 19)
+channel.name                  # "LMM-K"
+channel.closed, channel.initial, channel.transient, channel.final
+# ("1s", ["2*8 3*8 4s1"], ["2*7 3*10 4s1"], ["2*8 3*9 4s1"])
+
+Only depends on the standard library and also runs under python 2.7 (inside pfac).
+"""
+
+import itertools
+
+ATOMICSYMBOL = ["", "H", "He", "Li", "Be", "B", "C", "N", "O", "F", "Ne", "Na", "Mg", "Al", "Si",
+                "P", "S", "Cl", "Ar", "K", "Ca", "Sc", "Ti", "V", "Cr", "Mn", "Fe", "Co", "Ni",
+                "Cu", "Zn", "Ga", "Ge", "As", "Se", "Br", "Kr", "Rb", "Sr", "Y", "Zr", "Nb", "Mo",
+                "Tc", "Ru", "Rh", "Pd", "Ag", "Cd", "In", "Sn", "Sb", "Te", "I", "Xe", "Cs", "Ba",
+                "La", "Ce", "Pr", "Nd", "Pm", "Sm", "Eu", "Gd", "Tb", "Dy", "Ho", "Er", "Tm", "Yb",
+                "Lu", "Hf", "Ta", "W", "Re", "Os", "Ir", "Pt", "Au", "Hg", "Tl", "Pb", "Bi", "Po",
+                "At", "Rn", "Fr", "Ra", "Ac", "Th", "Pa", "U", "Np", "Pu", "Am", "Cm", "Bk", "Cf",
+                "Es", "Fm"]
+SHELL_LETTERS = "KLMNOPQ"
+L_LETTERS = "spdfghi"
+# Subshell filling order (Madelung rule)
+FILLING_ORDER = [(1, 0), (2, 0), (2, 1), (3, 0), (3, 1), (4, 0), (3, 2), (4, 1), (5, 0), (4, 2),
+                 (5, 1), (6, 0), (4, 3), (5, 2), (6, 1), (7, 0), (5, 3), (6, 2), (7, 1)]
+
+def capacity(n, l=None):
+    """ Number of electrons that fit into shell n or subshell nl """
+    if l is None:
+        return 2 * n * n
+    return 2 * (2 * l + 1)
+
+def ground_configuration(nele):
+    """
+    Ground configuration of an ion with nele electrons as a dict {(n, l):occupation}, following
+    the Madelung rule (like the fac_dr definitions, e.g. 3d4 4s2 for Cr-like)
+    """
+    config = {}
+    remaining = nele
+    for (n, l) in FILLING_ORDER:
+        if remaining <= 0:
+            break
+        config[(n, l)] = min(remaining, capacity(n, l))
+        remaining -= config[(n, l)]
+    if remaining > 0:
+        raise ValueError("Too many electrons: %d" % nele)
+    return config
+
+def parse_configuration(text):
+    """ Parses a configuration in subshell notation, e.g. "1s2 2s2 2p1" """
+    config = {}
+    for orbital in text.split():
+        n = int(orbital[0])
+        l = L_LETTERS.index(orbital[1])
+        config[(n, l)] = config.get((n, l), 0) + int(orbital[2:] or 1)
+    return config
+
+def format_subshells(config):
+    """ Subshell notation of a configuration dict, empty subshells are left out """
+    return " ".join("%d%s%d" % (n, L_LETTERS[l], config[(n, l)]) for (n, l) in sorted(config)
+                    if config[(n, l)] > 0)
+
+def expand_configuration(text):
+    """
+    All subshell configurations (dicts) of a configuration in FAC notation, which may mix shell
+    complexes and subshells, e.g. "1*2 2*1" or "2*8 3s2 3p1"
+    """
+    shells = {}
+    subshells = {}
+    for token in text.split():
+        if "*" in token:
+            (n, k) = token.split("*")
+            shells[int(n)] = int(k)
+        else:
+            subshells.update(parse_configuration(token))
+    return _expand(shells, subshells)
+
+def _format_complex(shells, spectators):
+    """ FAC notation of shell occupations {n:k} (e.g. "1*1 2*3") followed by the spectators """
+    parts = ["%d*%d" % (n, shells[n]) for n in sorted(shells)]
+    spectator_text = format_subshells(spectators)
+    if spectator_text:
+        parts.append(spectator_text)
+    return " ".join(parts)
+
+def _expand(shells, spectators):
+    """ All subshell configurations (dicts) belonging to a complex """
+    per_shell = []
+    for n in sorted(shells):
+        options = []
+        caps = [capacity(n, l) for l in range(n)]
+        for occ in itertools.product(*[range(c + 1) for c in caps]):
+            if sum(occ) == shells[n]:
+                options.append(dict(((n, l), k) for (l, k) in enumerate(occ) if k > 0))
+        per_shell.append(options)
+    configs = []
+    for combination in itertools.product(*per_shell):
+        config = dict(spectators)
+        for part in combination:
+            config.update(part)
+        configs.append(config)
+    return configs
+
+def _captures(initial, n_hole, n_exc, n_cap):
+    """
+    All subshell configurations formed from initial by exciting an electron of shell n_hole to
+    shell n_exc and capturing a free electron into shell n_cap
+    """
+    configs = []
+    for hole in [key for key in initial if key[0] == n_hole and initial[key] > 0]:
+        for l_exc in range(n_exc):
+            for l_cap in range(n_cap):
+                config = dict(initial)
+                config[hole] -= 1
+                for key in [(n_exc, l_exc), (n_cap, l_cap)]:
+                    config[key] = config.get(key, 0) + 1
+                if any(k > capacity(*key) for (key, k) in config.items()):
+                    continue
+                config = dict((key, k) for (key, k) in config.items() if k > 0)
+                if config not in configs:
+                    configs.append(config)
+    return configs
+
+def _select(shells, spectators, keep, dropped):
+    """
+    Configurations of a complex that satisfy keep, as the complex itself if all of them do
+    The others are appended to dropped, returns (strings, kept subshell configurations)
+    """
+    expanded = _expand(shells, spectators)
+    kept = [config for config in expanded if keep(config)]
+    dropped.extend(format_subshells(config) for config in expanded if not keep(config))
+    if len(kept) == len(expanded):
+        return ([_format_complex(shells, spectators)], kept)
+    return ([format_subshells(config) for config in kept], kept)
+
+def _dipole_connected(upper, lower):
+    """ True if lower follows from upper by moving one electron with delta l = +-1 """
+    keys = set(upper) | set(lower)
+    diff = dict((key, lower.get(key, 0) - upper.get(key, 0)) for key in keys)
+    changed = [(key, d) for (key, d) in diff.items() if d != 0]
+    if sorted(d for (_, d) in changed) != [-1, 1]:
+        return False
+    ((key_a, _), (key_b, _)) = changed
+    return abs(key_a[1] - key_b[1]) == 1
+
+class DRChannel:
+    """
+    Configuration groups of a DR channel, the attributes hold the strings for fac.Closed and
+    fac.Config
+
+    name - type name like in fac_dr, e.g. "KLL-Li"
+    closed - closed subshells outside of the channel (fac.Closed), may be empty
+    initial, transient, final - lists of configurations (fac.Config) in FAC notation
+    pruned - dict group -> configurations (subshell notation) dropped by the pruning
+    """
+    def __init__(self, name, closed, initial, transient, final, pruned):
+        self.name = name
+        self.closed = closed
+        self.initial = initial
+        self.transient = transient
+        self.final = final
+        self.pruned = pruned
+
+    def __repr__(self):
+        return ("DRChannel(%r, closed=%r, initial=%r, transient=%r, final=%r)"
+                % (self.name, self.closed, self.initial, self.transient, self.final))
+
+    def groups(self):
+        """ Dict group name -> configurations """
+        return {"initial":self.initial, "transient":self.transient, "final":self.final}
+
+def dr_channel(channel, nele, ground=None, prune=False):
+    """
+    Derives the configuration groups of a DR channel
+
+    channel - three shell letters, e.g. "KLL", "KLM", "LMM", "LMN"
+    nele - number of electrons of the initial ion (isoelectronic sequence)
+    ground - initial ground configuration in subshell notation, defaults to the Madelung
+             configuration of nele electrons
+    prune - only keep the ground configuration in the initial group, the transient
+            configurations formed by dielectronic capture from it and the final configurations
+            reached from these by E1 decay
+    Returns a DRChannel, raises ValueError if the channel is not possible for this ion
+    """
+    channel = channel.upper()
+    if len(channel) != 3 or any(c not in SHELL_LETTERS for c in channel):
+        raise ValueError("Invalid channel: " + channel)
+    (n_hole, n_exc, n_cap) = [SHELL_LETTERS.index(c) + 1 for c in channel]
+    config = ground_configuration(nele) if ground is None else parse_configuration(ground)
+    if sum(config.values()) != nele:
+        raise ValueError("Ground configuration does not have %d electrons" % nele)
+    active = range(min(n_hole, n_exc, n_cap), max(n_hole, n_exc, n_cap) + 1)
+
+    # Subshells outside of the active shells are closed or kept as spectators
+    closed = sorted(key for (key, k) in config.items()
+                    if key[0] not in active and k == capacity(*key))
+    spectators = dict((key, k) for (key, k) in config.items()
+                      if key[0] not in active and key not in closed)
+    initial = dict((key, k) for (key, k) in config.items() if key not in closed)
+    shells = dict((n, 0) for n in active)
+    for ((n, _), k) in config.items():
+        if n in shells:
+            shells[n] += k
+
+    # Excitation of a hole electron and capture of the free electron
+    transient = dict(shells)
+    transient[n_hole] -= 1
+    transient[n_exc] += 1
+    transient[n_cap] += 1
+    if transient[n_hole] < 0:
+        raise ValueError("No electron in shell %s for channel %s" % (channel[0], channel))
+    for n in active:
+        if transient[n] > capacity(n):
+            raise ValueError("Shell %s is full in channel %s" % (SHELL_LETTERS[n - 1], channel))
+
+    # Radiative decays: one electron into a vacancy of a lower active shell
+    finals = []
+    for upper in active:
+        for lower in active:
+            if lower < upper and transient[upper] > 0 and transient[lower] < capacity(lower):
+                final = dict(transient)
+                final[upper] -= 1
+                final[lower] += 1
+                if final not in finals:
+                    finals.append(final)
+
+    pruned = {"transient":[], "final":[]}
+    if prune:
+        captured = _captures(initial, n_hole, n_exc, n_cap)
+        (transient_configs, transient_expanded) = _select(transient, spectators,
+                                                          lambda c: c in captured,
+                                                          pruned["transient"])
+        final_configs = []
+        for final in finals:
+            final_configs.extend(_select(final, spectators,
+                                         lambda f: any(_dipole_connected(t, f)
+                                                       for t in transient_expanded),
+                                         pruned["final"])[0])
+    else:
+        transient_configs = [_format_complex(transient, spectators)]
+        final_configs = [_format_complex(final, spectators) for final in finals]
+    if not final_configs:
+        raise ValueError("No final configurations for channel " + channel)
+
+    name = channel + "-" + ATOMICSYMBOL[nele]
+    closed_text = " ".join("%d%s" % (n, L_LETTERS[l]) for (n, l) in closed)
+    # The initial group is the whole complex (like the hand written KLL / KLM groups), so that
+    # the AI channels into excited initial levels and their mixing are included
+    if prune:
+        initial_configs = [format_subshells(initial)]
+    else:
+        initial_configs = [_format_complex(shells, spectators)]
+    return DRChannel(name, closed_text, initial_configs, transient_configs, final_configs, pruned)
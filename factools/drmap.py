@@ -0,0 +1,132 @@
+"""
+Methods for assembling two dimensional DR maps (photon energy against electron beam energy) as
+measured in EBITs from dr_transition_table results
+
+The maps are held as sparse matrices (rows: electron energy bins, columns: photon energy bins)
+and can be built by streaming over the transition tables of many ions.
+"""
+
+import copy
+
+import numpy as np
+import scipy.sparse as sps
+
+from factools.dr import DE_AI, DE_TR, TRANSITION_STRENGTH
+
+FWHM_TO_SIGMA = 1 / (2 * np.sqrt(2 * np.log(2)))
+KERNEL_SIGMA = 4 # gaussian smoothing kernels are truncated after this many sigmas
+
+def _gaussian_kernel_matrix(size, step, fwhm):
+    """
+    Returns a sparse banded matrix that convolves a binned axis of length size with a normalised
+    gaussian of the given fwhm
+    """
+    sigma = fwhm * FWHM_TO_SIGMA / step
+    width = min(int(np.ceil(KERNEL_SIGMA * sigma)), size - 1)
+    offsets = np.arange(-width, width + 1)
+    weights = np.exp(-0.5 * (offsets / sigma)**2)
+    weights /= weights.sum()
+    diagonals = [np.full(size - abs(o), w) for (o, w) in zip(offsets, weights)]
+    return sps.diags(diagonals, offsets, shape=(size, size), format="csr")
+
+class DRMap:
+    """
+    Sparse 2D histogram of DR transition strengths over electron energy (DELTA_E_AI) and
+    photon energy (DELTA_E_TR)
+
+    e_range, p_range - (min, max) of the electron and photon energy axes in eV
+    e_step, p_step - bin widths of the electron and photon energy axes in eV
+    """
+    def __init__(self, e_range, e_step, p_range, p_step):
+        self.e_min = float(e_range[0])
+        self.e_step = float(e_step)
+        self.n_e = int(np.ceil((e_range[1] - e_range[0]) / e_step))
+        self.p_min = float(p_range[0])
+        self.p_step = float(p_step)
+        self.n_p = int(np.ceil((p_range[1] - p_range[0]) / p_step))
+        self.matrix = sps.csr_matrix((self.n_e, self.n_p))
+
+    @property
+    def e_edges(self):
+        """ Bin edges of the electron energy axis """
+        return self.e_min + self.e_step * np.arange(self.n_e + 1)
+
+    @property
+    def p_edges(self):
+        """ Bin edges of the photon energy axis """
+        return self.p_min + self.p_step * np.arange(self.n_p + 1)
+
+    def add(self, e_energies, p_energies, weights):
+        """
+        Adds the given events to the map, events outside of the map are dropped
+        """
+        i = np.floor((np.asarray(e_energies, dtype=float) - self.e_min) / self.e_step)
+        j = np.floor((np.asarray(p_energies, dtype=float) - self.p_min) / self.p_step)
+        inside = (i >= 0) & (i < self.n_e) & (j >= 0) & (j < self.n_p)
+        weights = np.asarray(weights, dtype=float)[inside]
+        chunk = sps.coo_matrix((weights, (i[inside].astype(int), j[inside].astype(int))),
+                               shape=(self.n_e, self.n_p))
+        self.matrix = self.matrix + chunk.tocsr()
+        return self
+
+    def add_table(self, trans_df, weight=TRANSITION_STRENGTH):
+        """
+        Adds all rows of a dr_transition_table to the map
+        """
+        return self.add(trans_df[DE_AI].values, trans_df[DE_TR].values, trans_df[weight].values)
+
+    def smoothed(self, e_fwhm=None, p_fwhm=None):
+        """
+        Returns a new map that is smoothed by separable gaussians with the given FWHM (eV)
+        along the electron and / or photon energy axes
+        """
+        smooth = copy.copy(self)
+        matrix = self.matrix
+        if e_fwhm:
+            matrix = _gaussian_kernel_matrix(self.n_e, self.e_step, e_fwhm) @ matrix
+        if p_fwhm:
+            matrix = matrix @ _gaussian_kernel_matrix(self.n_p, self.p_step, p_fwhm).T
+        smooth.matrix = matrix.tocsr()
+        return smooth
+
+    def projection(self, axis="electron"):
+        """
+        Projects the map onto the electron ("electron") or the photon ("photon") energy axis
+        Returns the bin edges and the summed strengths
+        """
+        if axis == "electron":
+            return self.e_edges, np.asarray(self.matrix.sum(axis=1)).ravel()
+        if axis == "photon":
+            return self.p_edges, np.asarray(self.matrix.sum(axis=0)).ravel()
+        raise ValueError("axis has to be 'electron' or 'photon'")
+
+    def roi_sum(self, e_range=None, p_range=None):
+        """
+        Sums the strength of all bins whose centres lie inside the given electron and photon energy
+        ranges (None selects the full axis)
+        """
+        rows = self._bin_slice(e_range, self.e_min, self.e_step, self.n_e)
+        cols = self._bin_slice(p_range, self.p_min, self.p_step, self.n_p)
+        return self.matrix[rows, cols].sum()
+
+    @staticmethod
+    def _bin_slice(rng, start, step, size):
+        """ Converts an energy range into a slice of bin indices """
+        if rng is None:
+            return slice(0, size)
+        lo = int(np.clip(np.ceil((rng[0] - start) / step - 0.5), 0, size))
+        hi = int(np.clip(np.floor((rng[1] - start) / step - 0.5) + 1, lo, size))
+        return slice(lo, hi)
+
+def dr_map(trans_tables, e_range, e_step, p_range, p_step, e_fwhm=None, p_fwhm=None,
+           weight=TRANSITION_STRENGTH):
+    """
+    Builds a DRMap by streaming over an iterable of dr_transition_tables (e.g. a generator that
+    reads and processes one ion at a time), optionally smoothed along both axes
+    """
+    drm = DRMap(e_range, e_step, p_range, p_step)
+    for trans_df in trans_tables:
+        drm.add_table(trans_df, weight)
+    if e_fwhm or p_fwhm:
+        drm = drm.smoothed(e_fwhm, p_fwhm)
+    return drm
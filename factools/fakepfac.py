@@ -0,0 +1,67 @@
+"""
+Stand-in for the fac_dr module, used to test the pfac worker bridge without FAC
+
+compute_dr writes synthetic .lev, .tr and .ai files (see factools.synthetic) with the same file
+naming as fac_dr. The DR types are looked up by name like in fac_dr (kll_li, lmm_fe, ...).
+
+Environment variables:
+FAKEPFAC_DELAY - seconds every calculation takes (default 0)
+FAKEPFAC_FAIL - comma separated list of "<Z>:<dr_type>" jobs that raise an exception
+FAKEPFAC_CRASH - same for jobs that terminate the process (like a segfault in FAC)
+"""
+
+import os
+import time
+
+from factools import synthetic
+
+ATOMICSYMBOL = ["", "H", "He", "Li", "Be", "B", "C", "N", "O", "F", "Ne", "Na", "Mg", "Al", "Si",
+                "P", "S", "Cl", "Ar", "K", "Ca", "Sc", "Ti", "V", "Cr", "Mn", "Fe", "Co", "Ni",
+                "Cu", "Zn", "Ga", "Ge", "As", "Se", "Br", "Kr", "Rb", "Sr", "Y", "Zr", "Nb", "Mo",
+                "Tc", "Ru", "Rh", "Pd", "Ag", "Cd", "In", "Sn", "Sb", "Te", "I", "Xe", "Cs", "Ba",
+                "La", "Ce", "Pr", "Nd", "Pm", "Sm", "Eu", "Gd", "Tb", "Dy", "Ho", "Er", "Tm", "Yb",
+                "Lu", "Hf", "Ta", "W", "Re", "Os", "Ir", "Pt", "Au", "Hg", "Tl", "Pb", "Bi", "Po",
+                "At", "Rn", "Fr", "Ra", "Ac", "Th", "Pa", "U", "Np", "Pu", "Am", "Cm", "Bk", "Cf",
+                "Es", "Fm"]
+
+def _dr_type(name):
+    """ Creates a dr type function like the ones in fac_dr, e.g. kll_li -> "KLL-Li" """
+    (channel, ion) = name.split("_")
+    def dr_type():
+        return channel.upper() + "-" + ion.capitalize()
+    dr_type.__name__ = name
+    return dr_type
+
+def __getattr__(name):
+    """ Every <channel>_<ion> attribute is a dr type """
+    if "_" in name and not name.startswith("_"):
+        return _dr_type(name)
+    raise AttributeError(name)
+
+def compute_dr(z, dr_type, path="", outputs=None, select=None, potential_cache=None,
+               shared_potential=False):
+    """
+    Fake of fac_dr.compute_dr, writes synthetic files and returns the filename stub
+    Takes the same arguments as fac_dr.compute_dr, select, potential_cache and shared_potential
+    are accepted so that jobs using them run unchanged, the synthetic tables do not depend on them
+    """
+    elem = ATOMICSYMBOL[z]
+    type_name = dr_type()
+    key = "%d:%s" % (z, dr_type.__name__)
+    if key in os.environ.get("FAKEPFAC_CRASH", "").split(","):
+        os._exit(139)
+    if key in os.environ.get("FAKEPFAC_FAIL", "").split(","):
+        raise RuntimeError("Fake FAC failure for " + elem + " " + type_name)
+    time.sleep(float(os.environ.get("FAKEPFAC_DELAY", 0)))
+    f_stub = path + elem + "_" + type_name
+    if outputs is None:
+        outputs = {ext:f_stub + "." + ext for ext in ("lev", "tr", "ai")}
+    structure = dict(synthetic.SHELL_STRUCTURES["KLL-Li"], Element=elem, Z=z)
+    n_levels = {"final":10, "initial":3, "transient":40}
+    levels = synthetic.generate_levels(structure, n_levels, seed=z)
+    # Same order as FAC
+    synthetic.write_lev(outputs["lev"], structure, levels)
+    synthetic.write_tr(outputs["tr"], structure, levels, 100, seed=z + 2)
+    synthetic.write_ai(outputs["ai"], structure, levels, 50, seed=z + 1)
+    print("Element:" + elem + " DR: " + type_name + " done.")
+    return f_stub
@@ -1,25 +1,97 @@
 '''
 Functions for importing verbose FAC ASCII Output Files
+
+All readers accept compact=True, which stores the floating point columns as float32 and the
+level indices, angular momenta etc. as int32 / int16 and the repeated EGRID string as a
+categorical. This roughly halves the memory footprint of the tables. FAC prints 5 (ai) to 7 (tr,
+lev) significant digits, float32 resolves about 7 (relative rounding error <= 2**-24 = 6e-8),
+so the stored values deviate from the printed ones by at most 6e-8 relative.
+
+Instead of a filename, all readers also accept an open text file object (e.g. the contents of a
+file that was already read into a StringIO, see factools.prefetch). Files ending in .gz are
+decompressed on the fly.
 '''
 
+from contextlib import contextmanager
+import gzip
 try:
     from StringIO import StringIO
 except ImportError:
     from io import StringIO
+import numpy as np
 import pandas as pd
 
-def read_lev(filename):
+from factools import instrument
+
+# Column types used in compact mode, all other columns keep their default types
+COMPACT_TYPES = {"ILEV":np.int32, "IBASE":np.int32, "P":np.int8, "VNL":np.int16, "2J":np.int16,
+                 "ENERGY":np.float32, "BOUND_ILEV":np.int32, "BOUND_2J":np.int16,
+                 "FREE_ILEV":np.int32, "FREE_2J":np.int16, "UPPER_ILEV":np.int32,
+                 "UPPER_2J":np.int16, "LOWER_ILEV":np.int32, "LOWER_2J":np.int16,
+                 "DELTA_E":np.float32, "AI_RATE":np.float32, "DC_STRENGTH":np.float32,
+                 "GF":np.float32, "TR_RATE":np.float32, "MULTIPOLE":np.float32,
+                 "NELE":np.int16, "NLEV":np.int32, "NTRANS":np.int32, "NEGRID":np.int16,
+                 "EMIN":np.float32, "CHANNEL":np.int16, "MULTIP":np.int16, "GAUGE":np.int16,
+                 "MODE":np.int16, "BLOCK_INDEX":np.int16, "EGRID":"category"}
+
+# Transition columns of the ai and tr files
+AI_NAMES = ["BOUND_ILEV", "BOUND_2J", "FREE_ILEV", "FREE_2J", "DELTA_E", "AI_RATE", "DC_STRENGTH"]
+AI_TYPES = {"BOUND_ILEV":int, "BOUND_2J":int, "FREE_ILEV":int, "FREE_2J":int, "DELTA_E":float,
+            "AI_RATE":float, "DC_STRENGTH":float}
+TR_NAMES = ["UPPER_ILEV", "UPPER_2J", "LOWER_ILEV", "LOWER_2J", "DELTA_E", "GF", "TR_RATE",
+            "MULTIPOLE"]
+TR_TYPES = {"UPPER_ILEV":int, "UPPER_2J":int, "LOWER_ILEV":int, "LOWER_2J":int, "DELTA_E":float,
+            "GF":float, "TR_RATE":float, "MULTIPOLE":float}
+
+def _compact(df):
+    """ Downcasts the columns of a dataframe to the compact types """
+    types = {col:COMPACT_TYPES[col] for col in df.columns if col in COMPACT_TYPES}
+    return df.astype(types)
+
+@contextmanager
+def _open(filename):
+    """ Opens filename for reading, file objects are used as they are (and not closed) """
+    if hasattr(filename, "readline"):
+        yield filename
+    elif filename.endswith(".gz"):
+        with gzip.open(filename, "rt") as fobj:
+            yield fobj
+    else:
+        with open(filename) as fobj:
+            yield fobj
+
+def _read_blocks(filename, read_block, kind, compact):
+    """
+    Reads the header and all blocks of a FAC ASCII file with the given block reader
+    """
+    fname = filename if isinstance(filename, str) else getattr(filename, "name", None)
+    with instrument.stage("fileimport.read_" + kind, fname) as st:
+        blocks = []
+        with _open(filename) as fobj:
+            header = _read_fac_header(fobj)
+            for n in range(header["NBlocks"]):
+                block = read_block(fobj)
+                block["BLOCK_INDEX"] = n
+                if compact:
+                    block = _compact(block)
+                blocks.append(block)
+        if blocks:
+            data = pd.concat(blocks, ignore_index=True)
+        else:
+            data = pd.DataFrame()
+        if compact and "EGRID" in data.columns:
+            # concat does not keep categoricals with differing categories
+            data["EGRID"] = data["EGRID"].astype("category")
+        st.add_rows(len(data))
+    return header, data
+
+def read_lev(filename, compact=False):
     '''
     Method for Importing a FAC Output containing data on level structure
+
+    compact - use float32 / small integer column types (see module docstring)
     '''
-    data = pd.DataFrame()
-    with open(filename) as fobj:
-        header = _read_fac_header(fobj)
-        for n in range(header["NBlocks"]):
-            block = _read_lev_block(fobj)
-            block["BLOCK_INDEX"] = n
-            data = data.append(block, ignore_index=True)
-    return header, data
+    return _read_blocks(filename, _read_lev_block, "lev", compact)
 
 def _read_lev_block(fobj):
     '''
@@ -78,25 +150,43 @@ def _read_lev_block(fobj):
 
     return df
 
-def read_ai(filename):
+def read_ai(filename, compact=False):
     '''
     Method for Importing a FAC Output containing data on autoionising transitions
+
+    compact - use float32 / small integer column types (see module docstring)
     '''
-    data = pd.DataFrame()
-    with open(filename) as fobj:
-        header = _read_fac_header(fobj)
-        for n in range(header["NBlocks"]):
-            block = _read_ai_block(fobj)
-            block["BLOCK_INDEX"] = n
-            data = data.append(block, ignore_index=True)
-    return header, data
+    return _read_blocks(filename, _read_ai_block, "ai", compact)
 
 def _read_ai_block(fobj):
     '''
     Reads a block of an ai file and returns a dataframe with the content
     Expects Cursor at beginning of block and moves it past the final newline of this block
     '''
-    # Read Block Header
+    block_header = _read_ai_block_header(fobj)
+
+    # Read Block
+    df = _read_rows(fobj, block_header["NTRANS"], AI_NAMES, AI_TYPES)
+
+    # Read one more line to move cursor to next block/EOF
+    fobj.readline()
+
+    # Add header data
+    df["NELE"] = block_header["NELE"]
+    df["NTRANS"] = block_header["NTRANS"]
+    df["NEGRID"] = block_header["NEGRID"]
+    df["EMIN"] = block_header["EMIN"]
+    df["EGRID"] = ", ".join([str(e) for e in block_header["EGRID"]])
+    if block_header["CHANNEL"]:
+        df["CHANNEL"] = block_header["CHANNEL"]
+
+    return df
+
+def _read_ai_block_header(fobj):
+    '''
+    Reads the header of a block of an ai file and returns it as a dict
+    Expects Cursor at beginning of block and moves it to the first transition
+    '''
     NELE = int(fobj.readline().split("=")[-1])
     NTRANS = int(fobj.readline().split("=")[-1])
     line = fobj.readline()
@@ -110,109 +200,92 @@ def _read_ai_block(fobj):
     EGRID = []
     for _ in range(NEGRID):
         EGRID.append(float(fobj.readline()))
+    return {"NELE":NELE, "NTRANS":NTRANS, "CHANNEL":CHANNEL, "EMIN":EMIN, "NEGRID":NEGRID,
+            "EGRID":EGRID}
+
+def read_tr(filename, compact=False):
+    '''
+    Method for Importing a FAC Output containing data on radiative transitions
+
+    compact - use float32 / small integer column types (see module docstring)
+    '''
+    return _read_blocks(filename, _read_tr_block, "tr", compact)
+
+def _read_tr_block(fobj):
+    '''
+    Reads a block of an ai file and returns a dataframe with the content
+    Expects Cursor at beginning of block and moves it past the final newline of this block
+    '''
+    block_header = _read_tr_block_header(fobj)
 
     # Read Block
-    buffer = StringIO()
-    for _ in range(NTRANS):
-        buffer.write(fobj.readline())
+    df = _read_rows(fobj, block_header["NTRANS"], TR_NAMES, TR_TYPES)
 
     # Read one more line to move cursor to next block/EOF
     fobj.readline()
 
-    # Convert buffered data to pandas object
-    df_names = ["BOUND_ILEV",
-                "BOUND_2J",
-                "FREE_ILEV",
-                "FREE_2J",
-                "DELTA_E",
-                "AI_RATE",
-                "DC_STRENGTH"]
-    df_types = {"BOUND_ILEV":int,
-                "BOUND_2J":int,
-                "FREE_ILEV":int,
-                "FREE_2J":int,
-                "DELTA_E":float,
-                "AI_RATE":float,
-                "DC_STRENGTH":float}
-    buffer.seek(0)
-    df = pd.read_csv(buffer, delim_whitespace=True,
-                     names=df_names, dtype=df_types, index_col=False)
-    buffer.close()
-
     # Add header data
-    df["NELE"] = NELE
-    df["NTRANS"] = NTRANS
-    df["NEGRID"] = NEGRID
-    df["EMIN"] = EMIN
-    df["EGRID"] = ", ".join([str(e) for e in EGRID])
-    if CHANNEL:
-        df["CHANNEL"] = CHANNEL
+    for key in ["NELE", "NTRANS", "MULTIP", "GAUGE", "MODE"]:
+        df[key] = block_header[key]
 
     return df
 
-def read_tr(filename):
+def _read_tr_block_header(fobj):
     '''
-    Method for Importing a FAC Output containing data on radiative transitions
+    Reads the header of a block of a tr file and returns it as a dict
+    Expects Cursor at beginning of block and moves it to the first transition
     '''
-    data = pd.DataFrame()
-    with open(filename) as fobj:
-        header = _read_fac_header(fobj)
-        for n in range(header["NBlocks"]):
-            block = _read_tr_block(fobj)
-            block["BLOCK_INDEX"] = n
-            data = data.append(block, ignore_index=True)
-    return header, data
+    block_header = {}
+    for key in ["NELE", "NTRANS", "MULTIP", "GAUGE", "MODE"]:
+        block_header[key] = int(fobj.readline().split("=")[-1])
+    return block_header
 
-def _read_tr_block(fobj):
+def _read_rows(fobj, nrows, names, types):
     '''
-    Reads a block of an ai file and returns a dataframe with the content
-    Expects Cursor at beginning of block and moves it past the final newline of this block
+    Reads the next nrows whitespace separated lines of a block into a dataframe
     '''
-    # Read Block Header
-    NELE = int(fobj.readline().split("=")[-1])
-    NTRANS = int(fobj.readline().split("=")[-1])
-    MULTIP = int(fobj.readline().split("=")[-1])
-    GAUGE = int(fobj.readline().split("=")[-1])
-    MODE = int(fobj.readline().split("=")[-1])
-
-    # Read Block
     buffer = StringIO()
-    for _ in range(NTRANS):
+    for _ in range(nrows):
         buffer.write(fobj.readline())
-
-    # Read one more line to move cursor to next block/EOF
-    fobj.readline()
-
-    # Convert buffered data to pandas object
-    df_names = ["UPPER_ILEV",
-                "UPPER_2J",
-                "LOWER_ILEV",
-                "LOWER_2J",
-                "DELTA_E",
-                "GF",
-                "TR_RATE",
-                "MULTIPOLE"]
-    df_types = {"UPPER_ILEV":int,
-                "UPPER_2J":int,
-                "LOWER_ILEV":int,
-                "LOWER_2J":int,
-                "DELTA_E":float,
-                "GF":float,
-                "TR_RATE":float,
-                "MULTIPOLE":float}
     buffer.seek(0)
     df = pd.read_csv(buffer, delim_whitespace=True,
-                     names=df_names, dtype=df_types, index_col=False)
+                     names=names, dtype=types, index_col=False)
     buffer.close()
+    return df
 
-    # Add header data
-    df["NELE"] = NELE
-    df["NTRANS"] = NTRANS
-    df["MULTIP"] = MULTIP
-    df["GAUGE"] = GAUGE
-    df["MODE"] = MODE
+def iter_ai(filename, chunk_rows=100000, compact=False):
+    '''
+    Generator reading the transitions of an ai file in chunks of at most chunk_rows rows,
+    so that files larger than the memory can be processed
+    Yields (block_index, block_header, df), df only has the transition columns (see AI_NAMES)
+    '''
+    return _iter_chunks(filename, _read_ai_block_header, AI_NAMES, AI_TYPES, chunk_rows, compact)
 
-    return df
+def iter_tr(filename, chunk_rows=100000, compact=False):
+    '''
+    Generator reading the transitions of a tr file in chunks of at most chunk_rows rows,
+    see iter_ai
+    '''
+    return _iter_chunks(filename, _read_tr_block_header, TR_NAMES, TR_TYPES, chunk_rows, compact)
+
+def _iter_chunks(filename, read_block_header, names, types, chunk_rows, compact):
+    '''
+    Generator behind iter_ai and iter_tr
+    '''
+    with _open(filename) as fobj:
+        header = _read_fac_header(fobj)
+        for n in range(header["NBlocks"]):
+            block_header = read_block_header(fobj)
+            remaining = block_header["NTRANS"]
+            while remaining > 0:
+                nrows = min(chunk_rows, remaining)
+                df = _read_rows(fobj, nrows, names, types)
+                remaining -= nrows
+                if compact:
+                    df = _compact(df)
+                yield (n, block_header, df)
+            # Move cursor past the empty line at the end of the block
+            fobj.readline()
 
 def _read_fac_header(fobj):
     '''
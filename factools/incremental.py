@@ -0,0 +1,102 @@
+"""
+Bookkeeping for incremental rebuilds of the element recombination tables
+
+A manifest next to every output file records, for each filename stub, the size, modification time
+and hash of its input files, the factools version that processed them and where the processed
+(sorted) per stub table was persisted. Only stubs whose inputs changed need to be reprocessed,
+the element table can be re-merged from the persisted per stub tables.
+"""
+
+import hashlib
+import json
+import os
+
+import factools
+
+HASH_BLOCKSIZE = 1 << 20
+
+def file_hash(path):
+    """ sha256 hex digest of a file """
+    sha = hashlib.sha256()
+    with open(path, "rb") as fobj:
+        for block in iter(lambda: fobj.read(HASH_BLOCKSIZE), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def file_signature(path, with_hash=True):
+    """ Returns a dict with size, mtime and (optionally) sha256 of a file """
+    stat = os.stat(path)
+    sig = {"size":stat.st_size, "mtime":stat.st_mtime}
+    if with_hash:
+        sig["sha256"] = file_hash(path)
+    return sig
+
+class Manifest:
+    """
+    Dependency manifest of one output file, use Manifest.load to read an existing one
+    """
+    def __init__(self, path, data=None):
+        self.path = path
+        if data is None or data.get("factools_version") != factools.__version__:
+            # Results of other factools versions are not reused
+            data = {"factools_version":factools.__version__, "stubs":{}}
+        self.data = data
+
+    @classmethod
+    def load(cls, path):
+        """ Reads the manifest at path, returns an empty manifest if there is none """
+        if not os.path.exists(path):
+            return cls(path)
+        with open(path) as fobj:
+            return cls(path, json.load(fobj))
+
+    def save(self):
+        """ Writes the manifest atomically """
+        with open(self.path + ".tmp", "w") as fobj:
+            json.dump(self.data, fobj, indent=1, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
+
+    @property
+    def stubs(self):
+        """ Names of all stubs recorded in the manifest """
+        return list(self.data["stubs"].keys())
+
+    def result(self, stub):
+        """ Path of the persisted per stub result or None """
+        entry = self.data["stubs"].get(stub)
+        return entry["result"] if entry else None
+
+    def is_current(self, stub, input_files):
+        """
+        Checks whether the recorded inputs of a stub match the given files and its result still
+        exists. Files with unchanged size and mtime are trusted without hashing, files with a
+        changed mtime but identical content (e.g. touched or copied) count as unchanged
+        """
+        entry = self.data["stubs"].get(stub)
+        if entry is None or not os.path.exists(entry["result"]):
+            return False
+        if sorted(entry["inputs"].keys()) != sorted(input_files):
+            return False
+        for path in input_files:
+            if not os.path.exists(path):
+                return False
+            recorded = entry["inputs"][path]
+            sig = file_signature(path, with_hash=False)
+            if sig["size"] != recorded["size"]:
+                return False
+            if sig["mtime"] != recorded["mtime"]:
+                if file_hash(path) != recorded["sha256"]:
+                    return False
+                recorded["mtime"] = sig["mtime"]
+        return True
+
+    def update(self, stub, input_files, result):
+        """ Records the inputs and the persisted result of a (re)processed stub """
+        inputs = {path:file_signature(path) for path in input_files}
+        self.data["stubs"][stub] = {"inputs":inputs, "result":result}
+
+    def remove(self, stub):
+        """ Forgets a stub and deletes its persisted result """
+        entry = self.data["stubs"].pop(stub, None)
+        if entry is not None and os.path.exists(entry["result"]):
+            os.remove(entry["result"])
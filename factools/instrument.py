@@ -0,0 +1,235 @@
+"""
+Lightweight instrumentation of the processing pipeline
+
+When enabled, the instrumented functions in fileimport, reconstruction and dr record the wall time,
+the number of rows processed and the memory of each stage (per file where the file is known), as
+well as hit / miss counters of the memoisation caches. When disabled (the default) the only cost is
+a check of the ENABLED flag.
+
+Memory: peak_rss_mb is the peak RSS while the stage ran and rss_increase_mb its increase over the
+RSS at the start of the stage (largest over all calls). On Linux the peak is measured by resetting
+the high-water mark of the process (/proc/self/clear_refs) at the stage boundaries, nested stages
+are folded into their parents. Elsewhere only the process lifetime high-water mark is available:
+peak_rss_mb then is that mark at the end of the stage and rss_increase_mb only counts stages that
+raised it. Stages running concurrently in threads share the one high-water mark of the process.
+Where neither is available (no /proc and no resource module, e.g. on Windows) the memory fields
+are None.
+
+Usage:
+factools.instrument.enable()
+... run pipeline ...
+factools.instrument.summary()   # or write_summary(filename)
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+ENABLED = False
+_STAGES = {}
+_COUNTERS = {}
+_CONTEXT = {"file":None}
+_LOCAL = threading.local() # stack of the peaks of the open stages of this thread
+_PROCESS = {"peak_rss_mb":None}
+
+def enable():
+    """ Switches instrumentation on """
+    global ENABLED
+    ENABLED = True
+
+def disable():
+    """ Switches instrumentation off, recorded data is kept """
+    global ENABLED
+    ENABLED = False
+
+def reset():
+    """ Clears all recorded data """
+    _STAGES.clear()
+    _COUNTERS.clear()
+
+def _maxrss_mb():
+    """ Lifetime peak RSS of the process in MB from getrusage, None if not available """
+    try:
+        import resource # Unix only
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _max(a, b):
+    """ max of two memory values, either of which may be None (not measured) """
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+def peak_rss_mb():
+    """ Peak resident set size of the process so far in MB, None if it cannot be measured """
+    return _max(_PROCESS["peak_rss_mb"], _maxrss_mb())
+
+def _proc_rss_mb():
+    """ Current and peak (since the last reset) RSS in MB from /proc, None if not available """
+    values = {}
+    try:
+        with open("/proc/self/status") as fobj:
+            for line in fobj:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    values[line[:5]] = int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    if len(values) != 2:
+        return None
+    return (values["VmRSS"], values["VmHWM"])
+
+def _reset_hwm():
+    """ Resets the RSS high-water mark of the process, returns False if that is not supported """
+    try:
+        with open("/proc/self/clear_refs", "w") as fobj:
+            fobj.write("5")
+    except OSError:
+        return False
+    return True
+
+def _enter_memory():
+    """ Starts the memory measurement of a stage, returns the RSS at its start """
+    proc = _proc_rss_mb()
+    if proc is None:
+        return _maxrss_mb()
+    stack = getattr(_LOCAL, "stack", None)
+    if stack is None:
+        stack = _LOCAL.stack = []
+    # The peak so far belongs to the enclosing stage
+    if stack:
+        stack[-1] = max(stack[-1], proc[1])
+    _PROCESS["peak_rss_mb"] = _max(_PROCESS["peak_rss_mb"], proc[1])
+    # Without a reset only the lifetime high-water mark is available, as in the fallback
+    start = proc[0] if _reset_hwm() else proc[1]
+    stack.append(start)
+    return start
+
+def _exit_memory(start_rss):
+    """ Ends the memory measurement of a stage, returns (peak RSS, increase), None if unknown """
+    proc = _proc_rss_mb()
+    if proc is None:
+        peak = _maxrss_mb()
+        if peak is None or start_rss is None:
+            return (None, None)
+        return (peak, peak - start_rss)
+    stack = _LOCAL.stack
+    peak = max(stack.pop(), proc[1])
+    if stack:
+        stack[-1] = max(stack[-1], peak)
+    _PROCESS["peak_rss_mb"] = _max(_PROCESS["peak_rss_mb"], peak)
+    _reset_hwm()
+    return (peak, peak - start_rss)
+
+class _Stage:
+    """ Handle returned by stage(), used to report the number of processed rows """
+    __slots__ = ["rows"]
+
+    def __init__(self):
+        self.rows = 0
+
+    def add_rows(self, n):
+        """ Adds n to the number of rows processed in this stage """
+        self.rows += n
+
+class _NullContext:
+    """ Reusable do-nothing context manager handed out while instrumentation is disabled """
+    __slots__ = []
+
+    def __enter__(self):
+        return _NULL_STAGE
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_STAGE = _Stage()
+_NULL_CONTEXT = _NullContext()
+
+@contextmanager
+def _recording_stage(name, fname):
+    """ Times the enclosed block and records it under name and file """
+    handle = _Stage()
+    start_rss = _enter_memory()
+    start = time.perf_counter()
+    try:
+        yield handle
+    finally:
+        elapsed = time.perf_counter() - start
+        (peak, increase) = _exit_memory(start_rss)
+        key = (name, fname if fname is not None else _CONTEXT["file"])
+        rec = _STAGES.get(key)
+        if rec is None:
+            rec = _STAGES[key] = {"calls":0, "time":0.0, "rows":0, "peak_rss_mb":None,
+                                  "rss_increase_mb":None}
+        rec["calls"] += 1
+        rec["time"] += elapsed
+        rec["rows"] += handle.rows
+        if peak is not None:
+            rec["peak_rss_mb"] = max(rec["peak_rss_mb"] or 0.0, peak)
+            rec["rss_increase_mb"] = max(rec["rss_increase_mb"] or 0.0, increase)
+
+def stage(name, fname=None):
+    """
+    Context manager measuring a pipeline stage
+    with stage("dr.tr_join") as st:
+        ...
+        st.add_rows(len(df))
+    fname - file the stage works on, defaults to the file set with current_file
+    """
+    if not ENABLED:
+        return _NULL_CONTEXT
+    return _recording_stage(name, fname)
+
+@contextmanager
+def current_file(fname):
+    """ Attributes all stages inside the block to fname (e.g. a filename stub) """
+    previous = _CONTEXT["file"]
+    _CONTEXT["file"] = fname
+    try:
+        yield
+    finally:
+        _CONTEXT["file"] = previous
+
+def count(name, hit):
+    """ Records a cache hit (hit=True) or miss for the cache called name """
+    rec = _COUNTERS.get(name)
+    if rec is None:
+        rec = _COUNTERS[name] = {"hits":0, "misses":0}
+    if hit:
+        rec["hits"] += 1
+    else:
+        rec["misses"] += 1
+
+def summary():
+    """
+    Returns the recorded data as a dict:
+    stages - per stage totals, per_file - per stage and file, caches - hits, misses and hit rate
+    """
+    stages = {}
+    per_file = []
+    for ((name, fname), rec) in sorted(_STAGES.items(), key=lambda item: (item[0][0],
+                                                                          str(item[0][1]))):
+        tot = stages.setdefault(name, {"calls":0, "time":0.0, "rows":0, "peak_rss_mb":None,
+                                       "rss_increase_mb":None})
+        tot["calls"] += rec["calls"]
+        tot["time"] += rec["time"]
+        tot["rows"] += rec["rows"]
+        tot["peak_rss_mb"] = _max(tot["peak_rss_mb"], rec["peak_rss_mb"])
+        tot["rss_increase_mb"] = _max(tot["rss_increase_mb"], rec["rss_increase_mb"])
+        entry = {"stage":name, "file":fname}
+        entry.update(rec)
+        per_file.append(entry)
+    caches = {}
+    for (name, rec) in _COUNTERS.items():
+        total = rec["hits"] + rec["misses"]
+        caches[name] = {"hits":rec["hits"], "misses":rec["misses"],
+                        "hit_rate":rec["hits"] / total if total else None}
+    return {"stages":stages, "per_file":per_file, "caches":caches, "peak_rss_mb":peak_rss_mb()}
+
+def write_summary(filename):
+    """ Writes the summary as json """
+    with open(filename, "w") as fobj:
+        json.dump(summary(), fobj, indent=1)
@@ -0,0 +1,35 @@
+"""
+Deferred imports of heavy dependencies
+
+numpy and pandas take several hundred milliseconds to import, which is a noticeable part of short
+lived worker processes that only need the pure python parts of a module (e.g. recomb_info or the
+name reconstruction). Modules bind them with lazy_import instead, the real import happens on the
+first attribute access:
+
+np = lazy_import("numpy")
+np.zeros(3)   # numpy is imported here
+"""
+
+import importlib
+
+class LazyModule:
+    """ Stand-in for a module that is imported on first attribute access """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        value = getattr(self._module, attr)
+        # Later accesses of this attribute do not go through __getattr__ anymore
+        setattr(self, attr, value)
+        return value
+
+    def __repr__(self):
+        state = "imported" if self._module is not None else "not imported yet"
+        return "<lazy module %r (%s)>" % (self._name, state)
+
+def lazy_import(name):
+    """ Returns a LazyModule for the module name """
+    return LazyModule(name)
@@ -0,0 +1,154 @@
+"""
+Methods for merging many sorted tables into a single sorted csv file without holding all of them
+in memory at the same time
+
+Each table is first written to a "run" (csv text in memory or in a temporary file), the runs are
+then combined by a streaming k-way merge straight into the output file. If there are too many runs
+to open at once, reduce_runs first merges groups of them into fewer, longer runs.
+"""
+
+import csv
+import heapq
+import os
+import tempfile
+from io import StringIO
+
+CHUNK_ROWS = 10000 # Rows handed to the sinks of merge_runs at once
+
+class Run:
+    """
+    A table sorted by a set of key columns, stored as csv text in memory or in a file
+    """
+    def __init__(self, columns, path=None, buffer=None):
+        self.columns = list(columns)
+        self.path = path
+        self.buffer = buffer
+
+    @classmethod
+    def from_file(cls, path):
+        """ Creates a run from an existing (sorted) csv file """
+        with open(path, newline="") as fobj:
+            columns = next(csv.reader(fobj))
+        return cls(columns, path=path)
+
+    def open(self):
+        """ Returns a file object positioned at the start of the csv text """
+        if self.path is not None:
+            return open(self.path, newline="")
+        return StringIO(self.buffer)
+
+    def discard(self):
+        """ Frees the memory or removes the temporary file of this run """
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+        self.buffer = None
+
+def write_run(df, keys, spill_dir=None, path=None):
+    """
+    Turns a dataframe into a run sorted by the key columns, the dataframe is only sorted if it is
+    not sorted already
+    spill_dir - if given the run is written to a temporary file in this directory, otherwise it is
+                kept in memory
+    path - if given the run is written to this file (e.g. to persist it)
+    """
+    if not _is_sorted(df, keys):
+        df = df.sort_values(keys, kind="mergesort")
+    if path is not None:
+        fobj = open(path, "w", newline="")
+    elif spill_dir is not None:
+        (fd, path) = tempfile.mkstemp(suffix=".csv", dir=spill_dir)
+        fobj = os.fdopen(fd, "w", newline="")
+    else:
+        return Run(df.columns, buffer=df.to_csv(index=False))
+    with fobj:
+        df.to_csv(fobj, index=False)
+    return Run(df.columns, path=path)
+
+def _is_sorted(df, keys):
+    """ Checks whether a dataframe is lexicographically sorted by the key columns """
+    if len(keys) == 1:
+        return df[keys[0]].is_monotonic_increasing
+    return df.set_index(keys).index.is_monotonic_increasing
+
+def _rows(run, key_pos, key_types):
+    """ Generator yielding (key, row) for all rows of a run """
+    with run.open() as fobj:
+        reader = csv.reader(fobj)
+        next(reader) # skip header
+        for row in reader:
+            yield (tuple(t(row[p]) for (p, t) in zip(key_pos, key_types)), row)
+
+def merge_runs(runs, out_file, keys, key_types, discard=True, sinks=()):
+    """
+    Merges sorted runs with identical columns into a single csv file sorted by the key columns
+    Rows with equal keys keep the order of the runs they come from
+
+    key_types - callables converting the csv fields of the key columns for comparison,
+                e.g. (int, float)
+    discard - free / delete the runs once they have been merged
+    sinks - callables that get the merged rows in output order, in chunks of CHUNK_ROWS rows as
+            dict column -> list of csv fields (strings, None for empty fields), to build further
+            outputs in the same pass
+    Returns the number of rows written
+    """
+    if not runs:
+        return 0
+    columns = runs[0].columns
+    for run in runs:
+        if run.columns != columns:
+            raise ValueError("All runs need to have the same columns")
+    key_pos = [columns.index(k) for k in keys]
+
+    def flush(chunk):
+        data = {name:[field if field != "" else None for field in values]
+                for (name, values) in zip(columns, zip(*chunk))}
+        for sink in sinks:
+            sink(data)
+
+    count = 0
+    chunk = []
+    with open(out_file, "w", newline="") as fobj:
+        writer = csv.writer(fobj, lineterminator="\n")
+        writer.writerow(columns)
+        streams = [_rows(run, key_pos, key_types) for run in runs]
+        for (_, row) in heapq.merge(*streams, key=lambda item: item[0]):
+            writer.writerow(row)
+            count += 1
+            if sinks:
+                chunk.append(row)
+                if len(chunk) == CHUNK_ROWS:
+                    flush(chunk)
+                    chunk = []
+        if chunk:
+            flush(chunk)
+
+    if discard:
+        for run in runs:
+            run.discard()
+    return count
+
+def reduce_runs(runs, keys, key_types, fan_in, spill_dir=None):
+    """
+    Merges groups of at most fan_in consecutive runs into temporary files until at most fan_in
+    runs are left, so the final merge_runs never has more than fan_in runs open at the same time
+    Every pass reads and writes all rows once. The merged runs are discarded, ties keep the order
+    of the runs as in merge_runs.
+    spill_dir - directory of the merged runs, defaults to the system temp directory
+    Returns the list of remaining runs
+    """
+    if fan_in < 2:
+        raise ValueError("fan_in needs to be at least 2")
+    runs = list(runs)
+    while len(runs) > fan_in:
+        merged = []
+        for i in range(0, len(runs), fan_in):
+            group = runs[i:i + fan_in]
+            if len(group) == 1:
+                merged.append(group[0])
+                continue
+            (fd, path) = tempfile.mkstemp(suffix=".csv", dir=spill_dir)
+            os.close(fd)
+            merge_runs(group, path, keys, key_types)
+            merged.append(Run(group[0].columns, path=path))
+        runs = merged
+    return runs
@@ -0,0 +1,280 @@
+"""
+Out-of-core assembly of the DR tables for ai / tr files that do not fit into memory
+
+The ai and tr files are streamed in chunks and their rows are hash partitioned by the transient
+level (BOUND_ILEV / UPPER_ILEV) into binary spill files. All transitions of a transient level end up
+in the same partition, so each partition can be joined and aggregated on its own with the in-memory
+methods of factools.dr. The (sorted) partition results are written to csv runs and combined into the
+output file by the k-way merge of factools.merge, at most MERGE_FAN_IN runs at a time.
+
+Memory is bounded by memory_budget (MB): the number of partitions is chosen from the input file
+sizes, partitions that still turn out too large are split again, and the transient levels of a
+partition are joined in batches whose output fits the budget. The level table is kept in memory,
+it is small compared to the transition files. The only data that cannot be split is a single
+transient level with all of its ai and tr rows.
+
+The bounded memory is paid for in time: every row goes through the spill files and the csv runs,
+and small budgets mean many partitions and merge passes. On the 100k synthetic benchmark set with a
+budget of 5 MB, dr_transition_table_ooc takes about 14 s against 0.5 s for dr_transition_table
+(dr_recombination_table_ooc: 1.4 s against 0.6 s), so only use it for files that do not fit into
+memory otherwise.
+
+Usage:
+n = dr_transition_table_ooc(lev_df, "Fe.ai", "Fe.tr", "Fe_trans.csv", memory_budget=2000)
+"""
+
+import math
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from factools import dr
+from factools import fileimport
+from factools import instrument
+from factools import merge
+
+MEMORY_BUDGET = 1024 # MB
+# Peak memory of joining a partition relative to the size of its spill files
+JOIN_OVERHEAD = 4.0
+# Memory per row of a joined partition (all columns incl. names and intermediate copies), bytes
+OUTPUT_ROW_BYTES = 400
+# Maximum number of spill files written at the same time (open file handles)
+MAX_PARTITIONS = 256
+# Maximum number of sorted runs merged at the same time (open file handles), more runs are first
+# merged in groups of this size, each extra pass reads and writes the whole table once more
+MERGE_FAN_IN = 64
+MAX_DEPTH = 4
+
+AI_COLUMNS = [dr.FREE_ILEV, dr.BOUND_ILEV, dr.DE, dr.AI_RATE, dr.DC_STRENGTH]
+TR_COLUMNS = [dr.UPPER_ILEV, dr.LOWER_ILEV, dr.DE, dr.TR_RATE]
+
+def _records(df, columns):
+    """ Converts the required columns of a chunk into a structured array for spilling """
+    dtype = [(col, df[col].dtype.str) for col in columns]
+    rec = np.empty(len(df), dtype=dtype)
+    for col in columns:
+        rec[col] = df[col].values
+    return rec
+
+def _split(rec, key, divisor, n, handles):
+    """ Appends the rows of rec to the spill files of their partition (key // divisor) % n """
+    part = (rec[key] // divisor) % n
+    order = np.argsort(part, kind="stable")
+    bounds = np.searchsorted(part[order], np.arange(n + 1))
+    rec = rec[order]
+    for i in range(n):
+        if bounds[i + 1] > bounds[i]:
+            rec[bounds[i]:bounds[i + 1]].tofile(handles[i])
+
+def _spill(chunks, key, divisor, n, prefix):
+    """
+    Writes a stream of structured arrays into n partition files prefix.<i>.bin
+    Returns the list of files and the dtype of the records (None if the stream was empty)
+    """
+    files = ["%s.%d.bin" % (prefix, i) for i in range(n)]
+    handles = [open(f, "wb") for f in files]
+    dtype = None
+    try:
+        for rec in chunks:
+            dtype = rec.dtype
+            _split(rec, key, divisor, n, handles)
+    finally:
+        for handle in handles:
+            handle.close()
+    return files, dtype
+
+def _read_spill(filename, dtype, chunk_rows=None):
+    """ Generator reading a spill file in chunks of chunk_rows records (all at once if None) """
+    with open(filename, "rb") as fobj:
+        while True:
+            rec = np.fromfile(fobj, dtype=dtype, count=-1 if chunk_rows is None else chunk_rows)
+            if len(rec) == 0:
+                return
+            yield rec
+            if chunk_rows is None:
+                return
+
+class _Partition:
+    """ A pair of ai / tr spill files holding all rows of a subset of the transient levels """
+    __slots__ = ["ai_file", "tr_file", "divisor", "depth"]
+
+    def __init__(self, ai_file, tr_file, divisor, depth):
+        self.ai_file = ai_file
+        self.tr_file = tr_file
+        self.divisor = divisor
+        self.depth = depth
+
+    def nbytes(self):
+        """ Size of the spill files """
+        return os.path.getsize(self.ai_file) + os.path.getsize(self.tr_file)
+
+    def discard(self):
+        """ Removes the spill files """
+        for f in (self.ai_file, self.tr_file):
+            if os.path.exists(f):
+                os.remove(f)
+
+def _num_partitions(nbytes, budget_bytes):
+    """ Number of partitions needed so that each of them can be joined within the budget """
+    return int(min(MAX_PARTITIONS, max(1, math.ceil(JOIN_OVERHEAD * nbytes / budget_bytes))))
+
+def _subdivide(part, dtypes, budget_bytes, chunk_rows, spill_dir):
+    """
+    Generator yielding partitions that fit into the budget, partitions that are too large are
+    split again by the next digit (in base n) of the transient level
+    """
+    if JOIN_OVERHEAD * part.nbytes() <= budget_bytes or part.depth >= MAX_DEPTH:
+        yield part
+        return
+    n = _num_partitions(part.nbytes(), budget_bytes)
+    divisor = part.divisor
+    prefix = os.path.join(spill_dir, "%s.%d" % (os.path.basename(part.ai_file), n))
+    (ai_files, _) = _spill(_read_spill(part.ai_file, dtypes[0], chunk_rows), dr.BOUND_ILEV,
+                           divisor, n, prefix + ".ai")
+    (tr_files, _) = _spill(_read_spill(part.tr_file, dtypes[1], chunk_rows), dr.UPPER_ILEV,
+                           divisor, n, prefix + ".tr")
+    parts = [_Partition(a, t, divisor * n, part.depth + 1) for (a, t) in zip(ai_files, tr_files)]
+    sizes = [p.nbytes() for p in parts]
+    part.discard()
+    if max(sizes) == sum(sizes):
+        # No progress, most likely all rows belong to a single transient level
+        for p in parts:
+            if p.nbytes():
+                yield p
+            else:
+                p.discard()
+        return
+    for p in parts:
+        yield from _subdivide(p, dtypes, budget_bytes, chunk_rows, spill_dir)
+
+def _level_batches(ai_levels, tr_levels, budget_bytes):
+    """
+    Groups the transient levels of a partition into batches whose joined output fits the budget
+    Returns a list of arrays of transient levels
+    """
+    (levels, n_ai) = np.unique(ai_levels, return_counts=True)
+    n_tr = np.zeros(len(levels), dtype=np.int64)
+    (tr_lev, tr_counts) = np.unique(tr_levels, return_counts=True)
+    pos = np.searchsorted(levels, tr_lev)
+    found = (pos < len(levels)) & (levels[np.minimum(pos, len(levels) - 1)] == tr_lev)
+    n_tr[pos[found]] = tr_counts[found]
+    cost = np.cumsum(n_ai * n_tr * OUTPUT_ROW_BYTES)
+    if len(cost) == 0 or cost[-1] <= budget_bytes:
+        return [levels]
+    batch_id = cost // budget_bytes
+    bounds = np.flatnonzero(np.diff(batch_id)) + 1
+    return np.split(levels, bounds)
+
+def _partition_tables(lev_df, ai_file, tr_file, filter_gs, memory_budget, compact, spill_dir,
+                      table):
+    """
+    Generator behind the out-of-core methods, partitions the input files and yields the table
+    (dr_transition_table or dr_recombination_table) of every batch of transient levels
+    """
+    budget_bytes = memory_budget * 1024**2
+    # A chunk of the ascii file needs about the same amount of memory as its text
+    chunk_rows = max(1000, int(budget_bytes / 4 / 100))
+    nbytes = os.path.getsize(ai_file) + os.path.getsize(tr_file)
+    n = _num_partitions(nbytes, budget_bytes)
+    min_free = [None]
+
+    def ai_records():
+        for (_, _, df) in fileimport.iter_ai(ai_file, chunk_rows, compact):
+            if len(df):
+                low = df[dr.FREE_ILEV].min()
+                min_free[0] = low if min_free[0] is None else min(min_free[0], low)
+            yield _records(df, AI_COLUMNS)
+
+    def tr_records():
+        for (_, _, df) in fileimport.iter_tr(tr_file, chunk_rows, compact):
+            yield _records(df, TR_COLUMNS)
+
+    with instrument.stage("outofcore.partition", ai_file) as st:
+        prefix = os.path.join(spill_dir, "p")
+        (ai_files, ai_dtype) = _spill(ai_records(), dr.BOUND_ILEV, 1, n, prefix + ".ai")
+        (tr_files, tr_dtype) = _spill(tr_records(), dr.UPPER_ILEV, 1, n, prefix + ".tr")
+        parts = [_Partition(a, t, n, 1) for (a, t) in zip(ai_files, tr_files)]
+        st.add_rows(n)
+    if ai_dtype is None or tr_dtype is None:
+        for part in parts:
+            part.discard()
+        return
+
+    for top in parts:
+        for part in _subdivide(top, (ai_dtype, tr_dtype), budget_bytes, chunk_rows, spill_dir):
+            ai_rec = np.concatenate(list(_read_spill(part.ai_file, ai_dtype)) or
+                                    [np.empty(0, ai_dtype)])
+            tr_rec = np.concatenate(list(_read_spill(part.tr_file, tr_dtype)) or
+                                    [np.empty(0, tr_dtype)])
+            part.discard()
+            if filter_gs:
+                ai_rec = ai_rec[ai_rec[dr.FREE_ILEV] == min_free[0]]
+            if len(ai_rec) == 0 or len(tr_rec) == 0:
+                continue
+            for levels in _level_batches(ai_rec[dr.BOUND_ILEV], tr_rec[dr.UPPER_ILEV],
+                                         budget_bytes):
+                with instrument.stage("outofcore.join", ai_file) as st:
+                    ai_df = pd.DataFrame(ai_rec[np.isin(ai_rec[dr.BOUND_ILEV], levels)])
+                    tr_df = pd.DataFrame(tr_rec[np.isin(tr_rec[dr.UPPER_ILEV], levels)])
+                    df = table(lev_df, ai_df, tr_df, filter_gs=False)
+                    st.add_rows(len(df))
+                yield df
+
+def _assemble(lev_df, ai_file, tr_file, out_file, filter_gs, memory_budget, compact, spill_dir,
+              table, keys, columns):
+    """ Streams the partition tables into sorted runs and merges them into out_file """
+    tmp_dir = tempfile.mkdtemp(prefix="factools_ooc_", dir=spill_dir)
+    try:
+        runs = []
+        for df in _partition_tables(lev_df, ai_file, tr_file, filter_gs, memory_budget, compact,
+                                    tmp_dir, table):
+            if len(df):
+                runs.append(merge.write_run(df, keys, spill_dir=tmp_dir))
+        if not runs:
+            pd.DataFrame(columns=columns).to_csv(out_file, index=False)
+            return 0
+        with instrument.stage("outofcore.merge", out_file) as st:
+            key_types = [float] * len(keys)
+            runs = merge.reduce_runs(runs, keys, key_types, MERGE_FAN_IN, spill_dir=tmp_dir)
+            count = merge.merge_runs(runs, out_file, keys, key_types)
+            st.add_rows(count)
+        return count
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def dr_transition_table_ooc(lev_df, ai_file, tr_file, out_file, filter_gs=True,
+                            memory_budget=MEMORY_BUDGET, compact=False, spill_dir=None):
+    """
+    Out-of-core version of dr.dr_transition_table, reads the ai and tr files itself and writes the
+    table as csv (sorted by DELTA_E_AI, DELTA_E_TR) to out_file
+
+    lev_df - (reconstructed) level dataframe
+    memory_budget - memory in MB the method may use (roughly, on top of lev_df)
+    compact - read the files in compact mode (see fileimport)
+    spill_dir - directory for the temporary spill files, defaults to the system temp directory
+    Returns the number of rows written
+    The rows are those of dr_transition_table, only rows with identical energies may come in a
+    different order
+    """
+    return _assemble(lev_df, ai_file, tr_file, out_file, filter_gs, memory_budget, compact,
+                     spill_dir, dr.dr_transition_table, [dr.DE_AI, dr.DE_TR],
+                     dr.TRANSITION_COLUMNS)
+
+def dr_recombination_table_ooc(lev_df, ai_file, tr_file, out_file, filter_gs=True,
+                               memory_budget=MEMORY_BUDGET, compact=False, spill_dir=None,
+                               transient_names=False):
+    """
+    Out-of-core version of dr.dr_recombination_table, writes the table as csv (sorted by
+    DELTA_E_AI) to out_file, see dr_transition_table_ooc for the arguments
+    transient_names - add the TRANSIENT_NAME column, see dr.dr_recombination_table
+    Returns the number of rows written
+    """
+    columns = dr.RECOMBINATION_COLUMNS + ([dr.TRANS_NAME] if transient_names else [])
+    def table(lev_df, ai_df, tr_df, filter_gs):
+        return dr.dr_recombination_table(lev_df, ai_df, tr_df, filter_gs,
+                                         transient_names=transient_names)
+    return _assemble(lev_df, ai_file, tr_file, out_file, filter_gs, memory_budget, compact,
+                     spill_dir, table, [dr.DE_AI], columns)
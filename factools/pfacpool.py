@@ -0,0 +1,228 @@
+"""
+Pool of persistent pfac worker processes (pfac_worker.py), driven from Python 3
+
+pfac only runs under python 2.7, so the FAC calculations run in separate interpreters that
+stay alive between jobs. Jobs and events are exchanged as json lines over the workers'
+stdin / stdout (see pfac_worker.py for the protocol). The events of finished jobs are handed out
+as soon as they arrive, so the results of finished ions can be processed while the others are
+still being computed.
+
+Usage:
+with PfacPool(workers=4, cwd="./") as pool:
+    for z in range(11, 31):
+        pool.submit(z, "kll_li", path="./facoutput/KLL/")
+    for event in pool.events():
+        if event["event"] == "done":
+            ... process event["stub"] ...
+
+For testing without FAC the fake backend can be used:
+PfacPool(python=sys.executable, backend="factools.fakepfac")
+"""
+
+import collections
+import itertools
+import json
+import os
+import queue
+import subprocess
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKER_SCRIPT = os.path.join(ROOT, "pfac_worker.py")
+PYTHON2 = "python2.7"
+
+class WorkerError(Exception):
+    """ Raised if the workers cannot be started or stop responding """
+
+class _Worker:
+    """ A worker process, its stdout is read by a thread that forwards the events """
+    def __init__(self, cmd, cwd, env, events):
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=cwd,
+                                     env=env, universal_newlines=True, bufsize=1)
+        self.ready = False
+        self.job = None
+        self._events = events
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        """ Forwards every event line to the queue, None signals the end of the process """
+        for line in self.proc.stdout:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                event = json.loads(line)
+            except ValueError:
+                event = {"event":"invalid", "line":line}
+            self._events.put((self, event))
+        self._events.put((self, None))
+
+    def send(self, request):
+        """ Sends a request line """
+        self.proc.stdin.write(json.dumps(request) + "\n")
+        self.proc.stdin.flush()
+
+    def stop(self, timeout):
+        """ Asks the worker to shut down, kills it if it does not exit in time """
+        if self.proc.poll() is None:
+            try:
+                self.send({"cmd":"shutdown"})
+                self.proc.stdin.close()
+                self.proc.wait(timeout)
+            except (OSError, ValueError, subprocess.TimeoutExpired):
+                self.proc.kill()
+                self.proc.wait()
+
+class PfacPool:
+    """
+    Manages a number of pfac worker processes and distributes compute_dr jobs among them
+
+    workers - number of worker processes
+    python - interpreter for the workers (needs pfac for the fac_dr backend)
+    backend - module providing compute_dr and the dr types, fac_dr or factools.fakepfac
+    cwd - working directory of the workers (fac_dr must be importable there), defaults to the
+          repository root
+    env - environment of the workers, defaults to the current one with the repository root in
+          PYTHONPATH
+    restart - replace workers that die after they started up (the job they were running fails
+              in any case)
+    """
+    def __init__(self, workers=2, python=PYTHON2, backend="fac_dr", worker_script=WORKER_SCRIPT,
+                 cwd=None, env=None, restart=True):
+        self.n_workers = workers
+        self.python = python
+        self.backend = backend
+        self.worker_script = worker_script
+        self.cwd = cwd if cwd is not None else ROOT
+        if env is None:
+            env = dict(os.environ)
+            env["PYTHONPATH"] = os.pathsep.join([ROOT] + [p for p in
+                                                          [env.get("PYTHONPATH")] if p])
+        self.env = env
+        self.restart = restart
+        self._events = queue.Queue()
+        self._workers = []
+        self._pending = collections.deque()
+        self._running = {}
+        self._ids = itertools.count()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _spawn(self):
+        """ Starts a new worker process """
+        cmd = [self.python, "-u", self.worker_script, "--backend", self.backend]
+        try:
+            worker = _Worker(cmd, self.cwd, self.env, self._events)
+        except OSError as e:
+            raise WorkerError("Cannot start worker %s: %s" % (" ".join(cmd), e))
+        self._workers.append(worker)
+        return worker
+
+    def start(self):
+        """ Starts the worker processes (they report ready asynchronously) """
+        while len(self._workers) < self.n_workers:
+            self._spawn()
+
+    def close(self, timeout=10):
+        """ Shuts all workers down, jobs that are still queued are dropped """
+        self._pending.clear()
+        for worker in self._workers:
+            worker.stop(timeout)
+        self._workers = []
+
+    def submit(self, z, dr_type, path="", job_id=None, **options):
+        """
+        Queues a compute_dr job (same arguments as fac_dr.compute_dr, dr_type by name) and
+        returns its id
+        options - optional compute_dr arguments (outputs, select, potential_cache,
+                  shared_potential)
+        """
+        if job_id is None:
+            job_id = next(self._ids)
+        job = {"id":job_id, "cmd":"compute_dr", "z":int(z), "dr_type":dr_type, "path":path}
+        job.update((key, value) for (key, value) in options.items() if value is not None)
+        self._pending.append(job)
+        self._dispatch()
+        return job_id
+
+    def outstanding(self):
+        """ Number of queued and running jobs """
+        return len(self._pending) + len(self._running)
+
+    def _dispatch(self):
+        """ Hands queued jobs to idle workers """
+        for worker in self._workers:
+            if not self._pending:
+                return
+            if worker.ready and worker.job is None and worker.proc.poll() is None:
+                job = self._pending.popleft()
+                worker.job = job
+                self._running[job["id"]] = job
+                try:
+                    worker.send(job)
+                except OSError:
+                    # The worker died, the end of its output will report the job as failed
+                    pass
+
+    def _handle(self, worker, event):
+        """ Updates the pool state for an event, returns the event to hand out or None """
+        if event is None:
+            # Worker process ended
+            self._workers.remove(worker)
+            job = worker.job
+            # Workers that die before they are ready (e.g. missing pfac) are not replaced
+            if self.restart and worker.ready:
+                self._spawn()
+            elif not self._workers:
+                raise WorkerError("All workers exited (last exit code %s), %d jobs left"
+                                  % (worker.proc.wait(), self.outstanding()))
+            if job is None:
+                return None
+            del self._running[job["id"]]
+            return {"id":job["id"], "event":"error", "error":"WorkerExit", "job":job,
+                    "message":"Worker exited with code %s" % worker.proc.wait(),
+                    "traceback":""}
+        kind = event.get("event")
+        if kind == "ready":
+            worker.ready = True
+        elif kind in ("done", "error") and worker.job is not None:
+            job = worker.job
+            worker.job = None
+            del self._running[job["id"]]
+            event["job"] = job
+            return event
+        return None
+
+    def events(self, timeout=None):
+        """
+        Generator yielding the done / error events of the submitted jobs in the order they finish,
+        until no jobs are outstanding. Jobs may also be submitted while iterating.
+        timeout - seconds to wait for the next event before WorkerError is raised
+        """
+        if len(self._workers) < self.n_workers:
+            self.start()
+        while self.outstanding():
+            self._dispatch()
+            try:
+                (worker, event) = self._events.get(timeout=timeout)
+            except queue.Empty:
+                raise WorkerError("No event from the workers within %s s" % timeout)
+            result = self._handle(worker, event)
+            self._dispatch()
+            if result is not None:
+                yield result
+
+    def map(self, jobs, timeout=None):
+        """
+        Runs (z, dr_type, path) jobs and returns their events in the order of the jobs
+        """
+        ids = [self.submit(*job) for job in jobs]
+        results = {event["id"]:event for event in self.events(timeout)}
+        return [results[i] for i in ids]
@@ -0,0 +1,152 @@
+"""
+End-to-end mode turning FAC jobs into recombination tables without intermediate ASCII files
+
+The pfac workers (see factools.pfacpool) print their tables into named pipes instead of files.
+For every job one thread per table reads its pipe while FAC is writing it, so all tables are in
+memory when the job finishes and the recombination table is computed right away. Optionally the
+raw ASCII is kept gzip compressed (stub.lev.gz, stub.tr.gz, stub.ai.gz), which the fileimport
+functions read directly.
+
+Usage:
+with PfacPool(workers=4) as pool:
+    pipeline = TablePipeline(pool, keep_ascii=True)
+    for z in range(11, 31):
+        pipeline.submit(z, "kll_li", path="./facoutput/KLL/")
+    for event in pipeline.results():
+        if event["event"] == "done":
+            ... event["table"] is the recombination table of event["stub"] ...
+
+Named pipes need a POSIX system, the workers have to run on the same machine.
+"""
+
+import errno
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+from io import StringIO
+
+import factools.dr
+import factools.fileimport
+import factools.reconstruction
+
+TABLES = ["lev", "tr", "ai"]
+
+def recombination_table(lev_df, ai_df, tr_df):
+    """ Default processing of the tables of a job """
+    lev_df = factools.reconstruction.amend_level_dataframe(lev_df, categorical=True)
+    return factools.dr.dr_recombination_table(lev_df, ai_df, tr_df)
+
+class _PipeReader(threading.Thread):
+    """ Reads a named pipe completely into memory """
+    def __init__(self, fifo):
+        super().__init__(daemon=True)
+        self.fifo = fifo
+        self.opened = False
+        self.text = None
+        self.start()
+
+    def run(self):
+        # Blocks until the writer opens the pipe
+        with open(self.fifo) as fobj:
+            self.opened = True
+            self.text = fobj.read()
+
+    def finish(self):
+        """
+        Waits for the end of the data, a pipe the writer never opened (failed job) is opened for
+        writing here to release the reader
+        """
+        while self.is_alive() and not self.opened:
+            try:
+                fd = os.open(self.fifo, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                # ENXIO: the reader is not waiting on the pipe yet
+                if e.errno != errno.ENXIO:
+                    raise
+                time.sleep(0.01)
+                continue
+            os.close(fd)
+            break
+        self.join()
+        return self.text
+
+class TablePipeline:
+    """
+    Submits compute_dr jobs to a PfacPool with named pipes as outputs and processes the tables
+    of every job as soon as it is done
+
+    pool - a factools.pfacpool.PfacPool
+    keep_ascii - also save the tables gzip compressed next to the filename stub
+    process - function (lev_df, ai_df, tr_df) -> result, defaults to recombination_table
+    compact - read the tables in compact mode (see fileimport)
+    """
+    def __init__(self, pool, keep_ascii=False, process=None, compact=False):
+        self.pool = pool
+        self.keep_ascii = keep_ascii
+        self.process = process if process is not None else recombination_table
+        self.compact = compact
+        self._jobs = {}
+
+    def submit(self, z, dr_type, path=""):
+        """
+        Queues a job like PfacPool.submit, path is only used for FAC's temporary binary files and
+        the kept ASCII files
+        """
+        pipe_dir = tempfile.mkdtemp(prefix="facpipes")
+        outputs = {}
+        for kind in TABLES:
+            outputs[kind] = os.path.join(pipe_dir, kind)
+            os.mkfifo(outputs[kind])
+        readers = {kind:_PipeReader(outputs[kind]) for kind in TABLES}
+        job_id = self.pool.submit(z, dr_type, path, outputs=outputs)
+        self._jobs[job_id] = (pipe_dir, readers)
+        return job_id
+
+    def _collect(self, event):
+        """ Reads the tables of a finished job and adds the result to its event """
+        (pipe_dir, readers) = self._jobs.pop(event["id"])
+        try:
+            texts = {kind:readers[kind].finish() for kind in TABLES}
+        finally:
+            shutil.rmtree(pipe_dir)
+        if event["event"] != "done":
+            return event
+        try:
+            if self.keep_ascii:
+                stub = os.path.join(self.pool.cwd, event["stub"])
+                for kind in TABLES:
+                    with gzip.open(stub + "." + kind + ".gz", "wt") as fobj:
+                        fobj.write(texts[kind])
+            read = {"lev":factools.fileimport.read_lev, "tr":factools.fileimport.read_tr,
+                    "ai":factools.fileimport.read_ai}
+            tables = {kind:read[kind](StringIO(texts[kind]), compact=self.compact)[1]
+                      for kind in TABLES}
+            del texts
+            event["table"] = self.process(tables["lev"], tables["ai"], tables["tr"])
+        except Exception as e:
+            return {"id":event["id"], "event":"error", "error":type(e).__name__,
+                    "message":str(e), "traceback":traceback.format_exc(), "job":event["job"]}
+        return event
+
+    def results(self, timeout=None):
+        """
+        Generator yielding the done / error events of the pool like PfacPool.events, the done
+        events of jobs submitted here carry the processed tables as "table"
+        Failures while reading or processing the tables turn the event into an error event
+        """
+        for event in self.pool.events(timeout):
+            if event["id"] in self._jobs:
+                event = self._collect(event)
+            yield event
+
+    def close(self):
+        """ Releases the pipes of jobs that did not finish (e.g. after a WorkerError) """
+        for (pipe_dir, readers) in self._jobs.values():
+            for reader in readers.values():
+                reader.finish()
+            shutil.rmtree(pipe_dir)
+        self._jobs = {}
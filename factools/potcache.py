@@ -0,0 +1,127 @@
+"""
+Cache of optimized radial potentials for compute_dr
+
+The potential of a FAC calculation only depends on the FAC version, the element and the
+configurations (including the closed shells) of the group it is optimized on. There are two kinds
+of keys:
+cache_key   - the "final" group of a dr_type, which differs between channels (even KLL and KLM of
+              the same ion), so only reruns of the same DR type share the potential
+ground_key  - the ground configuration of the recombined ion, which is the same for every channel
+              of an ion, so KLL, KLM, LMM, ... share one potential (fac_dr shared_potential)
+The keys are hashes over exactly these inputs, so only compatible potentials are reused. The number
+of electrons is part of the file name.
+
+compare_levels checks a calculation with a restored potential against one without reuse (see
+fac_dr.validate_potential_cache).
+
+Only depends on the standard library and also runs under python 2.7 (inside pfac).
+"""
+
+import hashlib
+import json
+import os
+
+from factools.drconfig import L_LETTERS, capacity, format_subshells, ground_configuration
+
+# Bump if the key layout or the meaning of the cached files changes
+CACHE_VERSION = 1
+
+def count_electrons(config):
+    """ Number of electrons of a configuration in FAC notation ("1*2 2*1" or "1s2 2s1 2p1") """
+    total = 0
+    for token in config.split():
+        if "*" in token:
+            total += int(token.split("*")[1])
+        else:
+            total += int(token[2:] or 1)
+    return total
+
+def cache_key(z, calls, group, fac_version):
+    """
+    Key of the potential optimized on group
+    calls - recorded (function name, args, kwargs) of the fac.Closed / fac.Config calls
+    fac_version - version string of the FAC build, potentials of different builds are not shared
+    Returns (number of electrons, hex key)
+    """
+    if not fac_version:
+        raise ValueError("The FAC version is needed for the cache key")
+    relevant = [call for call in calls
+                if call[0] == "Closed" or call[2].get("group") in (group, None)]
+    text = json.dumps({"version":CACHE_VERSION, "fac":fac_version, "z":z, "group":group,
+                       "calls":[[name, list(args), sorted(kwargs.items())]
+                                for (name, args, kwargs) in relevant]}, sort_keys=True)
+    return (group_electrons(calls, group), hashlib.sha1(text.encode("utf-8")).hexdigest())
+
+def ground_key(z, nele, fac_version):
+    """
+    Key of the potential optimized on the ground configuration of the ion with nele electrons,
+    independent of how a dr_type splits it into closed shells and configurations
+    Returns the hex key
+    """
+    if not fac_version:
+        raise ValueError("The FAC version is needed for the cache key")
+    text = json.dumps({"version":CACHE_VERSION, "fac":fac_version, "z":z,
+                       "ground":format_subshells(ground_configuration(nele))}, sort_keys=True)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def closed_subshells(calls):
+    """ The (n, l) subshells closed by the recorded fac.Closed calls """
+    return set((int(shell[0]), L_LETTERS.index(shell[1]))
+               for (name, args, kwargs) in calls if name == "Closed"
+               for arg in args for shell in arg.split())
+
+def group_electrons(calls, group):
+    """ Number of electrons of the configurations of group (closed shells included) """
+    nele = sum(capacity(n, l) for (n, l) in closed_subshells(calls))
+    configs = [args for (name, args, kwargs) in calls
+               if name == "Config" and kwargs.get("group") == group]
+    if configs and configs[0]:
+        nele += count_electrons(configs[0][0])
+    return nele
+
+def open_subshells(config, closed):
+    """
+    The part of config ({(n, l):occupation}) outside the closed subshells in subshell notation,
+    None if a closed subshell is not full in config
+    """
+    if any(config.get(subshell, 0) != capacity(*subshell) for subshell in closed):
+        return None
+    return format_subshells(dict((subshell, occupation) for (subshell, occupation)
+                                 in config.items() if subshell not in closed))
+
+def potential_file(cache_dir, z, nele, key):
+    """ Path of the cached potential """
+    return os.path.join(cache_dir, "Z%03d_N%03d_%s.pot" % (z, nele, key[:16]))
+
+def level_energies(lev_file):
+    """ Absolute level energies (E0 + ENERGY) of a FAC ASCII lev file, dict ILEV -> energy """
+    e0 = 0.0
+    energies = {}
+    with open(lev_file) as fobj:
+        for line in fobj:
+            if line.startswith("E0"):
+                e0 = float(line.split(",")[-1])
+                continue
+            fields = line.split()
+            if len(fields) > 6 and "=" not in line and fields[0].isdigit():
+                energies[int(fields[0])] = float(fields[2])
+    return dict((ilev, e0 + energy) for (ilev, energy) in energies.items())
+
+def compare_levels(lev_file, reference_file):
+    """
+    Compares the level energies of two calculations of the same ion
+    Returns a dict with the number of levels, whether the level lists agree and the largest
+    deviations of the absolute and of the excitation energies (eV)
+    """
+    levels = level_energies(lev_file)
+    reference = level_energies(reference_file)
+    common = sorted(set(levels) & set(reference))
+    result = {"levels":len(common), "same_levels":set(levels) == set(reference),
+              "max_abs_dev":0.0, "max_excitation_dev":0.0}
+    if common:
+        ground = common[0]
+        result["max_abs_dev"] = max(abs(levels[i] - reference[i]) for i in common)
+        result["max_excitation_dev"] = max(abs((levels[i] - levels[ground])
+                                               - (reference[i] - reference[ground]))
+                                           for i in common)
+    return result
@@ -0,0 +1,57 @@
+"""
+Background prefetching for batch processing
+
+While the current item is processed, the next items are already loaded by a small thread pool,
+so that I/O (e.g. reading from a network filesystem) and computation overlap. File reads release
+the GIL, so the threads do not slow down the processing in the main thread. The number of items
+loaded ahead is bounded, which caps the memory held by prefetched data.
+
+Usage:
+for (stub, future) in prefetch(stubs, read_stub_files, depth=2):
+    data = future.result()   # raises the exception of the load, if any
+    ... process data ...
+"""
+
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+
+from factools import instrument
+
+def prefetch(items, load, depth=2, workers=None):
+    """
+    Generator yielding (item, future) in the order of items, where future.result() is load(item)
+    Up to depth items are loaded ahead of the one currently handed out
+    workers - number of loader threads, defaults to depth
+    """
+    if depth < 1:
+        raise ValueError("depth needs to be at least 1")
+    items = iter(items)
+    in_flight = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers or depth) as executor:
+        def submit_next():
+            for item in items:
+                in_flight.append((item, executor.submit(load, item)))
+                return
+
+        for _ in range(depth + 1):
+            submit_next()
+        while in_flight:
+            (item, future) = in_flight.popleft()
+            if instrument.ENABLED:
+                # Time spent waiting for I/O that was not hidden behind the processing
+                with instrument.stage("prefetch.wait"):
+                    future.exception()
+            yield (item, future)
+            submit_next()
+
+def read_text_files(paths):
+    """
+    Loader reading text files completely into memory
+    Returns a dict path -> StringIO, which the fileimport readers accept in place of the path
+    """
+    files = {}
+    for path in paths:
+        with open(path) as fobj:
+            files[path] = StringIO(fobj.read())
+    return files
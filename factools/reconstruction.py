@@ -10,6 +10,8 @@ extended, but I don't need more right now
 import re
 from itertools import chain, combinations
 
+from factools import instrument
+
 # MAX_NELE_N = {1:2, 2:8, 3:18, 4:32, 5:50, 6:72, 7:98, 8:128, 9:162, 10:200}
 MAX_NELE_L = {"s":2, "p":6, "d":10, "f":14, "g":18, "h":22, "i":26, "k":30, "l":34, "m":38}
 L_ORDER = ["s", "p", "d", "f", "g", "h", "i", "k", "l", "m"]
@@ -199,6 +201,8 @@ def reconstruct_full_sname(compl, sname):
     This function is a memoising wrapper around the actual routine
     """
     key = (compl, sname)
+    if instrument.ENABLED:
+        instrument.count("reconstruction.sname_memo", key in _sname_memo)
     if key not in _sname_memo:
         _sname_memo[key] = _f_reconstruct_full_sname(compl, sname)
     return _sname_memo[key]
@@ -269,6 +273,8 @@ def reconstruct_full_name(sname, name):
     This function is a memoising wrapper around the actual routine
     """
     key = (sname, name)
+    if instrument.ENABLED:
+        instrument.count("reconstruction.name_memo", key in _name_memo)
     if key not in _name_memo:
         _name_memo[key] = _f_reconstruct_full_name(sname, name)
     return _name_memo[key]
@@ -289,15 +295,30 @@ def reconstruct_full_config(compl, sname, name, verbose=False):
     return (full_sname, full_name)
 
 def amend_level_dataframe(df, compl="COMPLEX", sname="SNAME", name="NAME", full_sname="FULL_SNAME",
-                          full_name="FULL_NAME", verbose=False):
+                          full_name="FULL_NAME", verbose=False, categorical=False):
     """
     automatically add columns to a data frame, that contain the reconstructed configurations
+
+    categorical - store all configuration strings (given and reconstructed) as pandas
+                  categoricals, so that every distinct configuration is only held once
     """
-    df = df.copy()
-    fnc_sname = lambda row: reconstruct_full_config(row[compl], row[sname], row[name], verbose)[0]
-    fnc_name = lambda row: reconstruct_full_config(row[compl], row[sname], row[name], False)[1]
-    df.loc[:, full_sname] = df.apply(fnc_sname, axis=1)
-    df.loc[:, full_name] = df.apply(fnc_name, axis=1)
+    with instrument.stage("reconstruction.amend_level_dataframe") as st:
+        df = df.copy()
+        keys = list(zip(df[compl], df[sname], df[name]))
+        if verbose:
+            full = [reconstruct_full_config(c, s, n, True) for (c, s, n) in keys]
+        else:
+            # Every distinct configuration only needs to be reconstructed once
+            unique = dict.fromkeys(keys)
+            for key in unique:
+                unique[key] = reconstruct_full_config(*key)
+            full = [unique[key] for key in keys]
+        df[full_sname] = [f[0] for f in full]
+        df[full_name] = [f[1] for f in full]
+        if categorical:
+            for col in [compl, sname, name, full_sname, full_name]:
+                df[col] = df[col].astype("category")
+        st.add_rows(len(df))
     return df
 # compl = "1*1 2*3 3*8"
 # sname = "1s1 2s1 2p2"
@@ -0,0 +1,173 @@
+"""
+Level and transition tables in shared memory, for worker processes that analyse the same ion
+
+The owner publishes a table once into a single shared memory block, workers attach to it with the
+(small, json serialisable) descriptor and get a DataFrame whose columns are read only views into
+the shared block instead of private copies, so the memory does not grow with the number of workers.
+Numeric columns are stored as they are, string and categorical columns (e.g. the reconstructed
+names of amend_level_dataframe) as categorical codes plus a utf-8 table of the distinct values,
+with the column encoding of factools.columnar. Only the distinct values are decoded in every
+worker, the codes are shared as well.
+
+Lifetime: the block exists until the owner calls release() (or leaves the with block), workers
+only close their mapping. Attached processes do not register the block with their resource tracker,
+which would otherwise destroy it as soon as the first worker exits. The column arrays keep the
+mapping alive, closing a table whose frames are still in use only unmaps it once the last of them
+is gone. shared_frame keeps one attachment per block and process for repeated tasks.
+
+Usage:
+with SharedTable.publish(lev_df) as shared:        # owner, unlinks the block on exit
+    pool.map(work, [(shared.descriptor, threshold) for threshold in thresholds])
+
+def work(args):                                     # worker
+    (descriptor, threshold) = args
+    lev_df = shared_frame(descriptor)
+"""
+
+import ctypes
+import sys
+import threading
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import pandas as pd
+
+from factools.columnar import ColumnLayout, decode_column
+
+_ATTACHED = {} # block name -> SharedTable attached by shared_frame in this process
+_TRACKER_LOCK = threading.Lock()
+
+def _open_untracked(name):
+    """
+    Attaches to an existing block without registering it with the resource tracker of this
+    process, which would unlink it when this process ends (python < 3.13 registers attached blocks
+    just like created ones)
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    with _TRACKER_LOCK:
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+class _Mapping:
+    """
+    Base object of all array views into a block, which closes the block once the last of them is
+    gone
+    numpy does not keep the buffer of the block exported, views created from it directly would
+    outlive an explicit close. The views refer to this object instead (through the array interface),
+    the ctypes array over the block keeps it from being unmapped before.
+    """
+    def __init__(self, shm):
+        self._shm = shm
+        self._block = (ctypes.c_char * shm.size).from_buffer(shm.buf)
+        self.__array_interface__ = {"version":3, "shape":(shm.size,), "typestr":"|u1",
+                                    "data":(ctypes.addressof(self._block), False)}
+
+    def __del__(self):
+        self._block = None
+        self._shm.close()
+
+class SharedTable:
+    """
+    A DataFrame in a shared memory block, use publish to create one and attach (or shared_frame)
+    to access it from other processes
+    """
+    def __init__(self, shm, descriptor, owner):
+        self._shm = shm
+        self._base = np.asarray(_Mapping(shm))
+        self.descriptor = descriptor
+        self.owner = owner
+        self._frame = None
+
+    @classmethod
+    def publish(cls, df, name=None):
+        """
+        Copies df into a new shared memory block (name: block name, None picks a free one)
+        The index is only kept if it is numeric, df.attrs have to be json serialisable
+        """
+        layout = ColumnLayout()
+        columns = [layout.add_column(col, df[col]) for col in df.columns]
+        index = None
+        default_index = (isinstance(df.index, pd.RangeIndex) and df.index.start == 0
+                         and df.index.step == 1 and df.index.name is None)
+        if not default_index:
+            index = layout.add_column(df.index.name, df.index.to_series())
+        shm = shared_memory.SharedMemory(name=name, create=True, size=max(layout.size, 1))
+        descriptor = {"name":shm.name, "rows":len(df), "columns":columns, "index":index,
+                      "attrs":dict(df.attrs)}
+        table = cls(shm, descriptor, owner=True)
+        layout.write_to(table._base)
+        return table
+
+    @classmethod
+    def attach(cls, descriptor):
+        """ Attaches to the block of a published table """
+        return cls(_open_untracked(descriptor["name"]), descriptor, owner=False)
+
+    def frame(self):
+        """
+        The table as a DataFrame with read only columns in the shared block
+        Columns can be replaced or added, but the shared values cannot be modified in place
+        """
+        if self._base is None:
+            raise ValueError("Shared table %s is closed" % self.descriptor["name"])
+        if self._frame is None:
+            desc = self.descriptor
+            index = None
+            if desc["index"] is not None:
+                index = pd.Index(decode_column(self._base, desc["index"]),
+                                 name=desc["index"]["name"])
+            df = pd.DataFrame({entry["name"]:decode_column(self._base, entry)
+                               for entry in desc["columns"]}, index=index, copy=False)
+            df.attrs.update(desc["attrs"])
+            self._frame = df
+        # A shallow copy, so that callers adding columns do not change the cached frame
+        return self._frame.copy(deep=False)
+
+    @property
+    def nbytes(self):
+        """ Size of the shared block """
+        return self._shm.size if self._shm is not None else 0
+
+    def close(self):
+        """
+        Closes the mapping of this process, right away or, if frames taken from it are still in
+        use, as soon as the last of them is gone
+        """
+        if self._shm is None:
+            return
+        # The mapping itself is closed by _Mapping with the last view
+        (self._shm, self._base, self._frame) = (None, None, None)
+
+    def release(self):
+        """ Owner only: destroys the block (attached processes keep their mappings until closed) """
+        if not self.owner:
+            raise ValueError("Only the owner can release a shared table")
+        if self._shm is not None:
+            self._shm.unlink()
+            self.owner = False
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.owner:
+            self.release()
+        else:
+            self.close()
+
+def shared_frame(descriptor):
+    """
+    The DataFrame of a published table, for worker processes
+    The attachment is kept for the whole process, so that repeated tasks on the same table do not
+    map and decode it again.
+    """
+    name = descriptor["name"]
+    if name not in _ATTACHED:
+        _ATTACHED[name] = SharedTable.attach(descriptor)
+    return _ATTACHED[name].frame()
@@ -0,0 +1,176 @@
+"""
+Methods for turning DR resonance strengths into continuous cross section curves on an electron
+energy grid, as needed for comparisons with EBIT scans
+
+Each resonance is broadened by a Gaussian (electron beam energy spread) and a Lorentzian (natural
+width of the transient level). Narrow resonances are binned onto the grid, sorted into a few
+classes of similar natural width and convolved with the Voigt profile of their class by FFT, the few
+broad ones are evaluated exactly.
+Strengths are expected in the units of FAC's DC_STRENGTH (10^-20 cm^2 eV), the resulting curves
+are in 10^-20 cm^2.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.special import wofz
+
+from factools.dr import (INIT_ILEV, TRANS_ILEV, DE_AI, AI_RATE, TR_RATE, TRANSITION_STRENGTH,
+                         RECOMB_STRENGTH)
+
+NATURAL_WIDTH = "NATURAL_WIDTH"
+HBAR = 6.582119569e-16 # reduced Planck constant in eV s
+FWHM_TO_SIGMA = 1 / (2 * np.sqrt(2 * np.log(2)))
+PAD_SIGMA = 8 # the binned spectrum is zero padded by this many gaussian sigmas on each side
+
+def resonance_widths(trans_df, total_ai_rate=None):
+    """
+    Condenses a dr_transition_table into one row per resonance (initial and transient level)
+    with the resonance energy, the total recombination strength and the natural (lorentzian) width
+    in eV, which is computed from the total AI rate and the sum of the TR rates of the transient
+    level
+    total_ai_rate - total AI rate of every transient level (series indexed by TRANS_ILEV, e.g.
+                    DRDataset.decay_summary[TOTAL_AI_RATE]). The transition table itself only
+                    contains the AI channel back into the initial level, without this series the
+                    widths of levels with further AI channels are underestimated
+    """
+    grp = trans_df.groupby([INIT_ILEV, TRANS_ILEV], as_index=False, sort=False)
+    res = grp.agg({DE_AI:"mean", TRANSITION_STRENGTH:"sum", AI_RATE:"first", TR_RATE:"sum"})
+    res.rename(columns={TRANSITION_STRENGTH:RECOMB_STRENGTH}, inplace=True)
+    ai_rate = res[AI_RATE].astype(float)
+    if total_ai_rate is not None:
+        total = res[TRANS_ILEV].map(pd.Series(total_ai_rate, dtype=float))
+        ai_rate = total.fillna(ai_rate)
+    res[NATURAL_WIDTH] = HBAR * (ai_rate + res[TR_RATE].astype(float))
+    res.sort_values(DE_AI, inplace=True, kind="mergesort")
+    res.reset_index(drop=True, inplace=True)
+    return res[[DE_AI, RECOMB_STRENGTH, NATURAL_WIDTH]]
+
+def voigt_profile(x, sigma, gamma):
+    """
+    Area normalised Voigt profile with gaussian standard deviation sigma and lorentzian half width
+    at half maximum gamma, evaluated at the offsets x
+    """
+    z = (np.asarray(x) + 1j * gamma) / (sigma * np.sqrt(2))
+    return wofz(z).real / (sigma * np.sqrt(2 * np.pi))
+
+def _check_grid(grid):
+    """ Returns the step of a uniform grid or raises a ValueError """
+    grid = np.asarray(grid, dtype=float)
+    if grid.ndim != 1 or grid.size < 2:
+        raise ValueError("The energy grid needs to be one dimensional with at least two points")
+    step = (grid[-1] - grid[0]) / (grid.size - 1)
+    if step <= 0 or not np.allclose(np.diff(grid), step, rtol=1e-6, atol=0):
+        raise ValueError("The energy grid needs to be uniformly spaced and increasing")
+    return step
+
+def _bin_strengths(energies, strengths, start, step, size):
+    """
+    Distributes the strengths onto a uniform grid by linear interpolation, which conserves the
+    total strength and the centroid of each resonance, returns a density (per eV)
+    """
+    pos = (energies - start) / step
+    inside = (pos >= 0) & (pos < size - 1)
+    pos = pos[inside]
+    strengths = strengths[inside]
+    ind = np.floor(pos).astype(int)
+    frac = pos - ind
+    density = np.bincount(ind, strengths * (1 - frac), minlength=size)
+    density += np.bincount(ind + 1, strengths * frac, minlength=size)
+    return density / step
+
+def _width_classes(widths, strengths, n_classes):
+    """
+    Sorts the natural widths into n_classes logarithmically spaced classes, returns the class of
+    each width and the strength weighted mean width of each class
+    """
+    if widths.size == 0:
+        return np.zeros(0, dtype=int), np.zeros(0)
+    logw = np.log(np.maximum(widths, np.finfo(float).tiny))
+    edges = np.linspace(logw.min(), logw.max(), n_classes + 1)[1:-1]
+    classes = np.searchsorted(edges, logw)
+    weight = np.abs(strengths) + np.finfo(float).tiny
+    mean = (np.bincount(classes, weight * widths, minlength=n_classes)
+            / np.maximum(np.bincount(classes, weight, minlength=n_classes), np.finfo(float).tiny))
+    return classes, mean
+
+def synthesize_spectrum(grid, energies, strengths, fwhm, natural_widths=None, voigt_threshold=0.5,
+                        n_width_classes=16):
+    """
+    Computes the cross section curve of a set of resonances on a uniform energy grid
+
+    grid - uniformly spaced electron energies (eV)
+    energies, strengths - resonance energies (eV) and strengths (10^-20 cm^2 eV)
+    fwhm - gaussian FWHM of the electron beam (eV), scalar or sequence of widths
+    natural_widths - lorentzian FWHM of each resonance (eV), if None all resonances are gaussian
+    voigt_threshold - resonances with a natural width above this fraction of the smallest fwhm
+                      are evaluated as exact Voigt profiles
+    n_width_classes - number of natural width classes used for the remaining resonances on the
+                      FFT path, each class is broadened with its mean natural width
+
+    Returns an array of shape (len(grid),) for a scalar fwhm or (len(fwhm), len(grid)) otherwise
+    """
+    grid = np.asarray(grid, dtype=float)
+    step = _check_grid(grid)
+    scalar = np.ndim(fwhm) == 0
+    fwhm = np.atleast_1d(np.asarray(fwhm, dtype=float))
+    if np.any(fwhm <= 0):
+        raise ValueError("All beam widths need to be positive")
+    sigma = fwhm * FWHM_TO_SIGMA
+    energies = np.asarray(energies, dtype=float)
+    strengths = np.asarray(strengths, dtype=float)
+
+    if natural_widths is None:
+        natural_widths = np.zeros(energies.shape)
+    else:
+        natural_widths = np.asarray(natural_widths, dtype=float)
+    broad = natural_widths > voigt_threshold * fwhm.min()
+    narrow = ~broad
+
+    # FFT path for the narrow resonances, the grid is padded to suppress wrap around
+    pad = int(np.ceil(PAD_SIGMA * sigma.max() / step))
+    size = grid.size + 2 * pad
+    start = grid[0] - pad * step
+    freq = np.fft.rfftfreq(size, step)
+    gauss = np.exp(-2 * (np.pi * sigma[:, None] * freq[None, :])**2)
+    classes, class_widths = _width_classes(natural_widths[narrow], strengths[narrow],
+                                           n_width_classes)
+    spectral = np.zeros(freq.size, dtype=complex)
+    for (c, width) in enumerate(class_widths):
+        members = classes == c
+        if not np.any(members):
+            continue
+        density = _bin_strengths(energies[narrow][members], strengths[narrow][members], start,
+                                 step, size)
+        spectral += np.fft.rfft(density) * np.exp(-np.pi * width * freq)
+    spectrum = np.fft.irfft(spectral[None, :] * gauss, size)
+    spectrum = spectrum[:, pad:pad + grid.size]
+
+    # Exact path for the broad resonances
+    if np.any(broad):
+        for (e, s, w) in zip(energies[broad], strengths[broad], natural_widths[broad]):
+            for (k, sig) in enumerate(sigma):
+                spectrum[k] += s * voigt_profile(grid - e, sig, w / 2)
+
+    if scalar:
+        return spectrum[0]
+    return spectrum
+
+def transition_table_spectrum(trans_df, grid, fwhm, voigt_threshold=0.5, n_width_classes=16,
+                              total_ai_rate=None):
+    """
+    Convenience wrapper that synthesizes the cross section curve of a dr_transition_table
+    including the natural widths of the resonances (see resonance_widths for total_ai_rate)
+    """
+    res = resonance_widths(trans_df, total_ai_rate)
+    return synthesize_spectrum(grid, res[DE_AI].values, res[RECOMB_STRENGTH].values, fwhm,
+                               natural_widths=res[NATURAL_WIDTH].values,
+                               voigt_threshold=voigt_threshold,
+                               n_width_classes=n_width_classes)
+
+def recombination_table_spectrum(recomb_df, grid, fwhm):
+    """
+    Convenience wrapper that synthesizes the cross section curve of a dr_recombination_table
+    (or an element table), which carries no width information, i.e. all profiles are gaussian
+    """
+    return synthesize_spectrum(grid, recomb_df[DE_AI].values, recomb_df[RECOMB_STRENGTH].values,
+                               fwhm)
@@ -0,0 +1,169 @@
+"""
+A simple file based store for recombination tables, partitioned by channel, element (Z) and
+charge state
+
+Every partition is a directory holding one .npy file per column, sorted by DELTA_E_AI, so that
+energy range queries can binary search the memory mapped energy column and only load the matching
+slices of the other columns. A json catalog in the root directory keeps the per partition min/max
+statistics, which are used to skip partitions without touching them.
+
+Layout:
+root/catalog.json
+root/<CHANNEL>/Z<Z>/Q<CHARGE_STATE>/<COLUMN>.npy
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from factools.dr import DE_AI
+
+CHANNEL = "CHANNEL"
+Z = "Z"
+CHARGE_STATE = "CHARGE_STATE"
+CATALOG = "catalog.json"
+
+def _in_range(rng, lo, hi):
+    """
+    Checks whether the interval [lo, hi] intersects with the query range rng, which can be None
+    (no restriction), a single value or a (min, max) tuple where either bound may be None
+    """
+    if rng is None:
+        return True
+    if not isinstance(rng, (tuple, list)):
+        rng = (rng, rng)
+    if rng[0] is not None and hi < rng[0]:
+        return False
+    if rng[1] is not None and lo > rng[1]:
+        return False
+    return True
+
+class RecombinationStore:
+    """
+    Partitioned on-disk store for recombination tables (dr_recombination_table output)
+
+    root - directory holding the store, is created if it does not exist
+    """
+    def __init__(self, root):
+        self.root = root
+        if not os.path.exists(root):
+            os.makedirs(root)
+        catalog_file = os.path.join(root, CATALOG)
+        if os.path.exists(catalog_file):
+            with open(catalog_file) as fobj:
+                self.catalog = json.load(fobj)
+        else:
+            self.catalog = {"partitions":[]}
+
+    def _save_catalog(self):
+        """ Writes the catalog atomically """
+        catalog_file = os.path.join(self.root, CATALOG)
+        with open(catalog_file + ".tmp", "w") as fobj:
+            json.dump(self.catalog, fobj, indent=1)
+        os.replace(catalog_file + ".tmp", catalog_file)
+
+    def append(self, df, channel, z, charge_state=None):
+        """
+        Adds a recombination table to the store
+        If charge_state is None the table needs a CHARGE_STATE column and is split accordingly
+        Only the partitions of the given (channel, z, charge_state) are written, existing
+        partitions with the same key are replaced
+        """
+        if charge_state is None:
+            for (q, sub) in df.groupby(CHARGE_STATE, sort=False):
+                self._write_partition(sub.drop(CHARGE_STATE, axis=1), channel, z, q)
+        else:
+            df = df.drop(CHARGE_STATE, axis=1, errors="ignore")
+            self._write_partition(df, channel, z, charge_state)
+        self._save_catalog()
+
+    def _write_partition(self, df, channel, z, charge_state):
+        """ Writes a single partition and updates its catalog entry """
+        (z, charge_state) = (int(z), int(charge_state))
+        rel_path = os.path.join(str(channel), "Z" + str(z), "Q" + str(charge_state))
+        path = os.path.join(self.root, rel_path)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+
+        df = df.sort_values(DE_AI, kind="mergesort")
+        stats_min = {}
+        stats_max = {}
+        for col in df.columns:
+            if not pd.api.types.is_numeric_dtype(df[col]):
+                # Strings (also categoricals) are stored as fixed width unicode
+                values = np.asarray(df[col], dtype=object).astype(str)
+            else:
+                values = df[col].values
+            if values.dtype.kind != "U" and len(values):
+                stats_min[col] = float(values.min())
+                stats_max[col] = float(values.max())
+            np.save(os.path.join(path, col + ".npy"), values)
+
+        self.catalog["partitions"] = [p for p in self.catalog["partitions"]
+                                      if p["path"] != rel_path]
+        self.catalog["partitions"].append({"path":rel_path, CHANNEL:str(channel), Z:z,
+                                           CHARGE_STATE:charge_state, "columns":list(df.columns),
+                                           "rows":len(df), "min":stats_min, "max":stats_max})
+
+    def partitions(self, channel=None, z=None, charge_state=None, energy=None):
+        """
+        Returns the catalog entries of all partitions that may contain rows matching the query
+        channel - channel name or list of channel names
+        z, charge_state, energy - a single value or a (min, max) tuple, bounds may be None
+        """
+        if isinstance(channel, str):
+            channel = [channel]
+        selected = []
+        for part in self.catalog["partitions"]:
+            if channel is not None and part[CHANNEL] not in channel:
+                continue
+            if not _in_range(z, part[Z], part[Z]):
+                continue
+            if not _in_range(charge_state, part[CHARGE_STATE], part[CHARGE_STATE]):
+                continue
+            if energy is not None:
+                if part["rows"] == 0:
+                    continue
+                if not _in_range(energy, part["min"][DE_AI], part["max"][DE_AI]):
+                    continue
+            selected.append(part)
+        return selected
+
+    def _read_partition(self, part, energy=None):
+        """ Loads the rows of a partition inside the energy range by binary search """
+        path = os.path.join(self.root, part["path"])
+        energies = np.load(os.path.join(path, DE_AI + ".npy"), mmap_mode="r")
+        (start, stop) = (0, len(energies))
+        if energy is not None:
+            if not isinstance(energy, (tuple, list)):
+                energy = (energy, energy)
+            if energy[0] is not None:
+                start = int(np.searchsorted(energies, energy[0], side="left"))
+            if energy[1] is not None:
+                stop = int(np.searchsorted(energies, energy[1], side="right"))
+        data = {}
+        for col in part["columns"]:
+            values = np.load(os.path.join(path, col + ".npy"), mmap_mode="r")
+            data[col] = np.array(values[start:stop])
+        df = pd.DataFrame(data, columns=part["columns"])
+        df[CHANNEL] = part[CHANNEL]
+        df[Z] = part[Z]
+        df[CHARGE_STATE] = part[CHARGE_STATE]
+        return df
+
+    def query(self, channel=None, z=None, charge_state=None, energy=None):
+        """
+        Returns all rows matching the query as a single dataframe with additional CHANNEL, Z and
+        CHARGE_STATE columns, see partitions for the query arguments
+        Example: store.query("KLL", z=(19, 30), charge_state=(14, None), energy=(2400, 2700))
+        """
+        parts = self.partitions(channel, z, charge_state, energy)
+        frames = [self._read_partition(part, energy) for part in parts]
+        frames = [f for f in frames if len(f)]
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
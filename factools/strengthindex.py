@@ -0,0 +1,139 @@
+"""
+Cumulative strength index for fast queries of the total recombination strength inside electron
+energy windows
+
+For every charge state and recombination type the resonance energies are kept sorted together with
+the prefix sums of RECOMB_STRENGTH, so the strength in [E1, E2] is the difference of two prefix
+sums found by binary search. Queries are vectorised over arrays of windows.
+"""
+
+import numpy as np
+
+from factools.dr import DE_AI, RECOMB_STRENGTH, RECOMB_TYPE
+
+CHARGE_STATE = "CHARGE_STATE"
+NO_CHARGE_STATE = -1 # Placeholder key for tables without a CHARGE_STATE column
+
+class StrengthIndex:
+    """
+    Index over the recombination strength of a recombination table, use from_table to build it
+    from a dr_recombination_table or an element table with a CHARGE_STATE column
+    """
+    def __init__(self, charge_states, recomb_types, offsets, energies, cumulative):
+        self.charge_states = np.asarray(charge_states, dtype=int)
+        self.recomb_types = np.asarray(recomb_types, dtype=str)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.energies = np.asarray(energies, dtype=float)
+        self.cumulative = np.asarray(cumulative, dtype=float)
+
+    @classmethod
+    def from_table(cls, df):
+        """
+        Builds the index from a recombination table
+        """
+        builder = IndexBuilder()
+        builder.append(df)
+        return builder.build()
+
+    @classmethod
+    def from_arrays(cls, charge, rtype, energy, strength):
+        """
+        Builds the index from the columns of a recombination table given as arrays of charge
+        states, recombination types, resonance energies and strengths
+        """
+        charge = np.asarray(charge, dtype=int)
+        rtype = np.asarray(rtype, dtype=str)
+        energy = np.asarray(energy, dtype=float)
+        strength = np.asarray(strength, dtype=float)
+
+        order = np.lexsort((energy, rtype, charge))
+        (charge, rtype, energy, strength) = (charge[order], rtype[order], energy[order],
+                                             strength[order])
+        new_group = np.ones(len(charge), dtype=bool)
+        new_group[1:] = (charge[1:] != charge[:-1]) | (rtype[1:] != rtype[:-1])
+        starts = np.flatnonzero(new_group)
+        offsets = np.append(starts, len(charge))
+
+        # Each group gets a leading zero in the prefix sums, i.e. group g occupies
+        # cumulative[offsets[g] + g : offsets[g + 1] + g + 1]
+        cumulative = np.zeros(len(charge) + len(starts))
+        for (g, (lo, hi)) in enumerate(zip(offsets[:-1], offsets[1:])):
+            cumulative[lo + g + 1:hi + g + 1] = np.cumsum(strength[lo:hi])
+        return cls(charge[starts], rtype[starts], offsets, energy, cumulative)
+
+    def groups(self):
+        """ Returns a list of the (charge state, recomb type) keys in the index """
+        return list(zip(self.charge_states.tolist(), self.recomb_types.tolist()))
+
+    def _select(self, charge_state, recomb_type):
+        """ Returns the indices of the groups matching the selection """
+        mask = np.ones(len(self.charge_states), dtype=bool)
+        if charge_state is not None:
+            mask &= np.isin(self.charge_states, np.atleast_1d(charge_state))
+        if recomb_type is not None:
+            mask &= np.isin(self.recomb_types, np.atleast_1d(recomb_type).astype(str))
+        return np.flatnonzero(mask)
+
+    def window_strength(self, e_lo, e_hi, charge_state=None, recomb_type=None):
+        """
+        Total recombination strength of the resonances with e_lo <= DELTA_E_AI <= e_hi
+
+        e_lo, e_hi - window bounds, scalars or arrays of the same shape
+        charge_state, recomb_type - restrict the sum to a single value or a list of values,
+                                    None sums over all of them
+        Returns a scalar or an array with the shape of the windows
+        """
+        e_lo = np.asarray(e_lo, dtype=float)
+        e_hi = np.asarray(e_hi, dtype=float)
+        total = np.zeros(np.broadcast(e_lo, e_hi).shape)
+        for g in self._select(charge_state, recomb_type):
+            (lo, hi) = (self.offsets[g], self.offsets[g + 1])
+            energies = self.energies[lo:hi]
+            cumulative = self.cumulative[lo + g:hi + g + 1]
+            i_lo = np.searchsorted(energies, e_lo, side="left")
+            i_hi = np.searchsorted(energies, e_hi, side="right")
+            total += np.where(i_hi > i_lo, cumulative[i_hi] - cumulative[np.minimum(i_lo, i_hi)],
+                              0.0)
+        if total.ndim == 0:
+            return float(total)
+        return total
+
+    def save(self, filename):
+        """ Saves the index as a numpy .npz file """
+        np.savez(filename, charge_states=self.charge_states, recomb_types=self.recomb_types,
+                 offsets=self.offsets, energies=self.energies, cumulative=self.cumulative)
+
+    @classmethod
+    def load(cls, filename):
+        """ Loads an index that was saved with save """
+        with np.load(filename) as data:
+            return cls(data["charge_states"], data["recomb_types"], data["offsets"],
+                       data["energies"], data["cumulative"])
+
+class IndexBuilder:
+    """
+    Collects the indexed columns of a recombination table chunk by chunk, e.g. as a sink of
+    merge.merge_runs, so the index can be built without holding or re-reading the whole table
+
+        builder = IndexBuilder()
+        builder.append(chunk) # as often as needed
+        index = builder.build()
+    """
+    def __init__(self):
+        self._chunks = []
+
+    def append(self, chunk):
+        """ Appends rows, chunk maps every column name to its values (a DataFrame or a dict) """
+        energy = np.asarray(chunk[DE_AI], dtype=float)
+        if CHARGE_STATE in chunk:
+            charge = np.asarray(chunk[CHARGE_STATE], dtype=int)
+        else:
+            charge = np.full(len(energy), NO_CHARGE_STATE)
+        self._chunks.append((charge, np.asarray(chunk[RECOMB_TYPE]).astype(str), energy,
+                             np.asarray(chunk[RECOMB_STRENGTH], dtype=float)))
+
+    def build(self):
+        """ Returns the StrengthIndex over all appended rows """
+        if not self._chunks:
+            return StrengthIndex.from_arrays([], [], [], [])
+        return StrengthIndex.from_arrays(*(np.concatenate(c) for c in zip(*self._chunks)))
@@ -0,0 +1,227 @@
+"""
+Generator for synthetic FAC 1.1.x ASCII output files (.lev, .ai, .tr) of arbitrary size
+
+The files follow the layout of FAC's PrintTable output, so they can be read by the fileimport
+methods and processed by the reconstruction and dr modules. Level names are drawn from shell
+structures (configuration templates per level group), energies and rates are random but
+physically ordered, i.e. transient levels autoionise into initial levels and decay radiatively
+into final levels. Useful for benchmarks and for testing without running FAC.
+"""
+
+import random
+
+FAC_VERSION = "FAC 1.1.4"
+
+# Templates per level group: NELE, energy range (eV) and (COMPLEX, SNAME, NAME, P, 2J) tuples
+SHELL_STRUCTURES = {
+    "KLL-Li":{
+        "Element":"K", "Z":19,
+        "final":{"NELE":4, "ENERGY":(0.0, 120.0), "LEVELS":[
+            ("1*2 2*2", "2s2", "2s+2(0)0", 0, 0),
+            ("1*2 2*2", "2s1 2p1", "2s+1(1)1 2p-1(1)0", 1, 0),
+            ("1*2 2*2", "2s1 2p1", "2s+1(1)1 2p-1(1)2", 1, 2),
+            ("1*2 2*2", "2s1 2p1", "2s+1(1)1 2p+1(3)4", 1, 4),
+            ("1*2 2*2", "2s1 2p1", "2s+1(1)1 2p+1(3)2", 1, 2),
+            ("1*2 2*2", "2p2", "2p-2(0)0", 0, 0),
+            ("1*2 2*2", "2p2", "2p-1(1)1 2p+1(3)2", 0, 2),
+            ("1*2 2*2", "2p2", "2p-1(1)1 2p+1(3)4", 0, 4),
+            ("1*2 2*2", "2p2", "2p+2(4)4", 0, 4),
+            ("1*2 2*2", "2p2", "2p+2(0)0", 0, 0)]},
+        "initial":{"NELE":3, "ENERGY":(960.0, 1010.0), "LEVELS":[
+            ("1*2 2*1", "2s1", "2s+1(1)1", 0, 1),
+            ("1*2 2*1", "2p1", "2p-1(1)1", 1, 1),
+            ("1*2 2*1", "2p1", "2p+1(3)3", 1, 3)]},
+        "transient":{"NELE":4, "ENERGY":(3440.0, 3600.0), "LEVELS":[
+            ("1*1 2*3", "1s1 2p1", "1s+1(1)1 2p-1(1)0", 1, 0),
+            ("1*1 2*3", "1s1 2p1", "1s+1(1)1 2p-1(1)2", 1, 2),
+            ("1*1 2*3", "1s1 2p1", "1s+1(1)1 2p+1(3)4", 1, 4),
+            ("1*1 2*3", "1s1 2s1 2p2", "1s+1(1)1 2s+1(1)2", 0, 2),
+            ("1*1 2*3", "1s1 2s1 2p2", "1s+1(1)1 2s+1(1)2 2p-1(1)1 2p+1(3)4", 0, 4),
+            ("1*1 2*3", "1s1 2s1 2p2", "1s+1(1)1 2s+1(1)2 2p+2(4)6", 0, 6),
+            ("1*1 2*3", "1s1 2s1 2p2", "1s+1(1)1 2s+1(1)0 2p+2(0)0", 0, 0),
+            ("1*1 2*3", "1s1 2p3", "1s+1(1)1 2p-1(1)0 2p+2(0)0", 1, 0),
+            ("1*1 2*3", "1s1 2p3", "1s+1(1)1 2p-1(1)2 2p+2(4)4", 1, 4),
+            ("1*1 2*3", "1s1 2p3", "1s+1(1)1 2p+3(3)2", 1, 2)]}},
+    "KLL-He":{
+        "Element":"Fe", "Z":26,
+        "final":{"NELE":3, "ENERGY":(0.0, 60.0), "LEVELS":[
+            ("1*2 2*1", "2s1", "2s+1(1)1", 0, 1),
+            ("1*2 2*1", "2p1", "2p-1(1)1", 1, 1),
+            ("1*2 2*1", "2p1", "2p+1(3)3", 1, 3)]},
+        "initial":{"NELE":2, "ENERGY":(1900.0, 1900.0), "LEVELS":[
+            ("1*2", "1s2", "1s+2(0)0", 0, 0)]},
+        "transient":{"NELE":3, "ENERGY":(6500.0, 6700.0), "LEVELS":[
+            ("1*1 2*2", "1s1 2s2", "1s+1(1)1", 0, 1),
+            ("1*1 2*2", "1s1 2s1 2p1", "1s+1(1)1 2s+1(1)0 2p-1(1)1", 1, 1),
+            ("1*1 2*2", "1s1 2s1 2p1", "1s+1(1)1 2s+1(1)2 2p-1(1)3", 1, 3),
+            ("1*1 2*2", "1s1 2s1 2p1", "1s+1(1)1 2s+1(1)2 2p+1(3)5", 1, 5),
+            ("1*1 2*2", "1s1 2p2", "1s+1(1)1 2p-2(0)0", 0, 1),
+            ("1*1 2*2", "1s1 2p2", "1s+1(1)1 2p-1(1)1 2p+1(3)4", 0, 3),
+            ("1*1 2*2", "1s1 2p2", "1s+1(1)1 2p+2(4)4", 0, 5)]}},
+}
+
+GROUPS = ["final", "initial", "transient"]
+
+def _log_uniform(rng, lo, hi):
+    """ Random number distributed uniformly in log space """
+    return 10**rng.uniform(lo, hi)
+
+def _split(n, parts):
+    """ Splits n items into parts non empty chunks of (nearly) equal size """
+    parts = max(1, min(parts, n))
+    return [n // parts + (1 if i < n % parts else 0) for i in range(parts)]
+
+def _pairs(rng, n, n_upper, n_lower):
+    """
+    Draws n distinct (upper, lower) index pairs without replacement, in random order, FAC lists
+    every transition between two levels only once
+    """
+    if n > n_upper * n_lower:
+        raise ValueError("%d transitions need more than %d upper and %d lower levels"
+                         % (n, n_upper, n_lower))
+    return [divmod(k, n_lower) for k in rng.sample(range(n_upper * n_lower), n)]
+
+def _write_header(fobj, structure, ftype, nblocks, extra=()):
+    """ Writes the common file header """
+    fobj.write(FAC_VERSION + "\n")
+    fobj.write("Endian\t= 0\n")
+    fobj.write("TSess\t= 1505748962\n")
+    fobj.write("Type\t= %d\n" % ftype)
+    fobj.write("Verbose\t= 1\n")
+    fobj.write("%s Z\t=  %.1f\n" % (structure["Element"], structure["Z"]))
+    fobj.write("NBlocks\t= %d\n" % nblocks)
+    for line in extra:
+        fobj.write(line + "\n")
+    fobj.write("\n")
+
+def generate_levels(structure, n_levels, seed=0):
+    """
+    Creates the level list for a shell structure
+    n_levels - dict with the number of levels per group (final, initial, transient)
+    Returns a dict group -> list of (ILEV, ENERGY, COMPLEX, SNAME, NAME, P, 2J)
+    The first initial level is the ground state of the recombining ion
+    """
+    rng = random.Random(seed)
+    levels = {}
+    ilev = 0
+    for group in GROUPS:
+        spec = structure[group]
+        (e_lo, e_hi) = spec["ENERGY"]
+        energies = sorted(rng.uniform(e_lo, e_hi) for _ in range(n_levels[group]))
+        if group == "initial":
+            energies[0] = e_lo
+        group_levels = []
+        for (k, energy) in enumerate(energies):
+            (compl, sname, name, parity, j2) = spec["LEVELS"][k % len(spec["LEVELS"])]
+            group_levels.append((ilev, energy, compl, sname, name, parity, j2))
+            ilev += 1
+        levels[group] = group_levels
+    return levels
+
+def write_lev(filename, structure, levels, nblocks=1):
+    """ Writes the levels in FAC's lev format, every group is split into nblocks blocks """
+    blocks = []
+    for group in GROUPS:
+        group_levels = levels[group]
+        start = 0
+        for size in _split(len(group_levels), nblocks):
+            blocks.append((structure[group]["NELE"], group_levels[start:start + size]))
+            start += size
+    e0 = levels["final"][0][0]
+    with open(filename, "w") as fobj:
+        _write_header(fobj, structure, 1, len(blocks), ["E0\t= %d, -1.15456034E+04" % e0])
+        for (nele, block) in blocks:
+            fobj.write("NELE\t= %d\n" % nele)
+            fobj.write("NLEV\t= %d\n" % len(block))
+            fobj.write("  ILEV  IBASE    ENERGY       P   VNL   2J\n")
+            for (ilev, energy, compl, sname, name, parity, j2) in block:
+                fobj.write("%6d %6d %15.8E %1d %5d %4d %-20s %-20s %s \n"
+                           % (ilev, -1, energy, parity, 201, j2, compl, sname, name))
+            fobj.write("\n")
+
+def write_ai(filename, structure, levels, n_trans, nblocks=1, seed=1):
+    """
+    Writes n_trans random autoionisation transitions (transient -> initial) in FAC's ai format
+    About half of the transitions, but at most one per transient level, lead to the ground state of
+    the initial ion, no pair of levels occurs twice
+    """
+    rng = random.Random(seed)
+    transient = levels["transient"]
+    initial = levels["initial"]
+    n_ground = min(sum(rng.random() < 0.5 for _ in range(n_trans)), len(transient))
+    pairs = [(i, 0) for i in rng.sample(range(len(transient)), n_ground)]
+    pairs += [(i, j + 1) for (i, j) in _pairs(rng, n_trans - n_ground, len(transient),
+                                               len(initial) - 1)]
+    rng.shuffle(pairs)
+    with open(filename, "w") as fobj:
+        _write_header(fobj, structure, 5, min(nblocks, max(n_trans, 1)))
+        start = 0
+        for size in _split(n_trans, nblocks):
+            fobj.write("NELE\t= %d\n" % structure["transient"]["NELE"])
+            fobj.write("NTRANS\t= %d\n" % size)
+            fobj.write("EMIN\t=  0.00000000E+00\n")
+            fobj.write("NEGRID\t= 2\n")
+            fobj.write("\t  %.8E\n\t  %.8E\n" % (transient[0][1] - initial[-1][1],
+                                                 transient[-1][1] - initial[0][1]))
+            rows = []
+            for (i, j) in pairs[start:start + size]:
+                (upper, lower) = (transient[i], initial[j])
+                rows.append((upper[0], upper[6], lower[0], lower[6], upper[1] - lower[1],
+                             _log_uniform(rng, 10, 14), _log_uniform(rng, -4, 1)))
+            rows.sort()
+            for row in rows:
+                fobj.write("%6d %2d %6d %2d %11.4E %11.4E %11.4E\n" % row)
+            fobj.write("\n")
+            start += size
+
+def write_tr(filename, structure, levels, n_trans, nblocks=1, seed=2):
+    """
+    Writes n_trans random radiative transitions (transient -> final) in FAC's tr format, no pair
+    of levels occurs twice
+    """
+    rng = random.Random(seed)
+    transient = levels["transient"]
+    final = levels["final"]
+    pairs = _pairs(rng, n_trans, len(transient), len(final))
+    with open(filename, "w") as fobj:
+        _write_header(fobj, structure, 2, min(nblocks, max(n_trans, 1)))
+        start = 0
+        for size in _split(n_trans, nblocks):
+            fobj.write("NELE\t= %d\n" % structure["transient"]["NELE"])
+            fobj.write("NTRANS\t= %d\n" % size)
+            fobj.write("MULTIP\t= 0\nGAUGE\t= 2\nMODE\t= 1\n")
+            rows = []
+            for (i, j) in pairs[start:start + size]:
+                (upper, lower) = (transient[i], final[j])
+                gf = _log_uniform(rng, -7, 0)
+                rows.append((upper[0], upper[6], lower[0], lower[6], upper[1] - lower[1], gf,
+                             gf * _log_uniform(rng, 13.5, 14.5), gf))
+            rows.sort()
+            for row in rows:
+                fobj.write("%6d %2d %6d %2d %13.6E %13.6E %13.6E %13.6E\n" % row)
+            fobj.write("\n")
+            start += size
+
+def generate_fac_files(stub, n_ai, n_tr, n_levels=None, structure="KLL-Li", nblocks=1, seed=0):
+    """
+    Writes a complete synthetic set of stub.lev, stub.ai and stub.tr files
+
+    n_ai, n_tr - number of autoionisation and radiative transitions
+    n_levels - dict with the number of levels per group, defaults to a size that grows with the
+               number of transitions, there must be enough levels for distinct level pairs
+    structure - name of an entry in SHELL_STRUCTURES or a structure dict of the same layout
+    nblocks - number of blocks every file (and level group) is split into
+    Returns the three filenames
+    """
+    if isinstance(structure, str):
+        structure = SHELL_STRUCTURES[structure]
+    if n_levels is None:
+        transient = max(10, max(n_ai, n_tr) // 20)
+        # Twice the levels needed for distinct pairs, so the pairs stay a sparse random subset
+        n_levels = {"final":max(10, n_tr // 100, -(-2 * n_tr // transient)),
+                    "initial":max(3, -(-2 * n_ai // transient)), "transient":transient}
+    levels = generate_levels(structure, n_levels, seed)
+    write_lev(stub + ".lev", structure, levels, nblocks)
+    write_ai(stub + ".ai", structure, levels, n_ai, nblocks, seed + 1)
+    write_tr(stub + ".tr", structure, levels, n_tr, nblocks, seed + 2)
+    return (stub + ".lev", stub + ".ai", stub + ".tr")
@@ -0,0 +1,232 @@
+"""
+Structural diff of DR tables, e.g. between FAC versions or configuration choices
+
+Resonances are matched by their key columns (charge state, transient level name, recombination
+type and name, as far as present in both tables). The median energy shift between the tables is
+removed first, then the resonances of each key are aligned in energy order: the most pairs within
+the tolerance that do not cross, so a systematic shift or a missing resonance does not pair
+neighbours with each other. Matched resonances report their energy shift and strength ratio, the
+others are reported as appeared or vanished.
+
+The transient level name (TRANSIENT_NAME) is only used if both tables have it, i.e. they were
+written with dr_recombination_table(transient_names=True) (TRANSIENT_NAMES in
+assemble-recomb-tables.py), and usually leaves a single resonance per key. Tables without it fall
+back to matching by energy order within charge state and recombination type / name only:
+resonances closer than the changes between the tables can then be paired with the wrong partner,
+e.g. if two of them swap their order, and the diff should be read as statistics rather than per
+resonance.
+
+Usage:
+diff = diff_tables(old_df, new_df, tolerance=1.0)
+diffs, summary = diff_directories("./KLL/out_fac114/", "./KLL/out_fac120/", workers=4)
+"""
+
+import glob
+import multiprocessing
+import os
+
+import numpy as np
+import pandas as pd
+
+from factools.dr import (DE_AI, RECOMB_STRENGTH, TRANSITION_STRENGTH, TRANS_NAME, FINAL_NAME,
+                         RECOMB_TYPE, RECOMB_NAME)
+
+CHARGE_STATE = "CHARGE_STATE"
+KEY_COLUMNS = [CHARGE_STATE, TRANS_NAME, FINAL_NAME, RECOMB_TYPE, RECOMB_NAME]
+SHIFT = "SHIFT"
+STRENGTH_RATIO = "STRENGTH_RATIO"
+STATUS = "STATUS"
+MATCHED = "matched"
+APPEARED = "appeared"
+VANISHED = "vanished"
+OLD = "_OLD"
+NEW = "_NEW"
+
+def _strength_column(df):
+    """ Strength column of a recombination or transition table """
+    return RECOMB_STRENGTH if RECOMB_STRENGTH in df.columns else TRANSITION_STRENGTH
+
+def _key_groups(df, keys):
+    """ Positions of the rows of df per key (a tuple of the key values), sorted by energy """
+    order = np.argsort(df[DE_AI].values, kind="mergesort")
+    if not keys:
+        return {(): order}
+    frame = pd.DataFrame({key:np.asarray(df[key], dtype=object)[order] for key in keys})
+    return {(key if isinstance(key, tuple) else (key,)):order[pos]
+            for (key, pos) in frame.groupby(keys, sort=False, dropna=False).indices.items()}
+
+def _nearest_shift(old, new, keys):
+    """
+    Median of the energy differences between every old row and the nearest new row with the same
+    keys, the first estimate of a systematic shift
+    """
+    left = pd.DataFrame({"_E":old[DE_AI].values.astype(np.float64)})
+    right = pd.DataFrame({"_E":new[DE_AI].values.astype(np.float64)})
+    for key in keys:
+        left[key] = np.asarray(old[key], dtype=object)
+        right[key] = np.asarray(new[key], dtype=object)
+    right["_E_NEW"] = right["_E"]
+    merged = pd.merge_asof(left.sort_values("_E", kind="mergesort"),
+                           right.sort_values("_E", kind="mergesort"), on="_E", by=keys or None,
+                           direction="nearest")
+    shift = (merged["_E_NEW"] - merged["_E"]).median()
+    return 0.0 if np.isnan(shift) else float(shift)
+
+def _align(old_e, new_e, tolerance):
+    """
+    Order preserving one to one matching of two sorted energy arrays: the largest number of pairs
+    closer than tolerance that do not cross, of these the one with the smallest sum of distances
+    Dynamic programming over the candidate pairs, with a Fenwick tree of the best chain ending
+    before each new position
+    Returns the matched (old index, new index) arrays
+    """
+    lower = np.searchsorted(new_e, old_e - tolerance, "left")
+    upper = np.searchsorted(new_e, old_e + tolerance, "right")
+    size = len(new_e)
+    empty = (0, 0.0, -1) # (pairs, -sum of distances, last pair)
+    tree = [empty] * (size + 1)
+    pairs = [] # (old index, new index, previous pair)
+    for i in range(len(old_e)):
+        # Chains of row i may only extend chains of earlier rows, the tree is updated afterwards
+        updates = []
+        for j in range(lower[i], upper[i]):
+            best = empty
+            k = j
+            while k > 0:
+                best = max(best, tree[k])
+                k -= k & -k
+            updates.append((j + 1, (best[0] + 1, best[1] - abs(new_e[j] - old_e[i]), len(pairs))))
+            pairs.append((i, j, best[2]))
+        for (k, score) in updates:
+            while k <= size:
+                tree[k] = max(tree[k], score)
+                k += k & -k
+    last = max(tree)[2] if size else -1
+    matched = []
+    while last >= 0:
+        (i, j, last) = pairs[last]
+        matched.append((i, j))
+    matched = np.array(matched[::-1], dtype=np.int64).reshape(-1, 2)
+    return (matched[:, 0], matched[:, 1])
+
+def _match(old, new, keys, tolerance):
+    """
+    One to one matching of the rows of old and new with equal keys, after removing the median
+    energy shift
+    Within each key the resonances are aligned in energy order (see _align), so a systematic
+    shift or missing resonances do not pair neighbours crosswise. The shift is estimated from
+    the nearest neighbours and refined once from the matched pairs.
+    Returns the matched (old position, new position) arrays
+    """
+    old_e = old[DE_AI].values.astype(np.float64)
+    new_e = new[DE_AI].values.astype(np.float64)
+    old_groups = _key_groups(old, keys)
+    new_groups = _key_groups(new, keys)
+    common = [key for key in old_groups if key in new_groups]
+
+    def match_shifted(shift):
+        old_pos = [np.zeros(0, dtype=np.int64)]
+        new_pos = [np.zeros(0, dtype=np.int64)]
+        for key in common:
+            (o, n) = (old_groups[key], new_groups[key])
+            (i, j) = _align(old_e[o] + shift, new_e[n], tolerance)
+            old_pos.append(o[i])
+            new_pos.append(n[j])
+        return (np.concatenate(old_pos), np.concatenate(new_pos))
+
+    shift = _nearest_shift(old, new, keys) if len(old) and len(new) else 0.0
+    (old_pos, new_pos) = match_shifted(shift)
+    if len(old_pos):
+        refined = float(np.median(new_e[new_pos] - old_e[old_pos]))
+        if refined != shift:
+            (old_pos, new_pos) = match_shifted(refined)
+    return (old_pos, new_pos)
+
+def diff_tables(old_df, new_df, tolerance=1.0, keys=None):
+    """
+    Diffs two recombination (or transition) tables
+
+    tolerance - largest deviation (eV) from the median shift for which two resonances are still
+                matched
+    keys - columns that have to agree, defaults to those of KEY_COLUMNS present in both tables
+    Returns a table with the keys, the energies (DELTA_E_AI_OLD / _NEW), SHIFT (new - old), the
+    strengths (..._OLD / _NEW), STRENGTH_RATIO (new / old) and STATUS (matched, appeared,
+    vanished), sorted by keys and energy
+    """
+    if keys is None:
+        keys = [k for k in KEY_COLUMNS if k in old_df.columns and k in new_df.columns]
+    strength = _strength_column(old_df)
+    (old_pos, new_pos) = _match(old_df, new_df, keys, tolerance)
+
+    def side(df, pos, suffix):
+        part = pd.DataFrame({key:np.asarray(df[key], dtype=object)[pos] for key in keys})
+        part[DE_AI + suffix] = df[DE_AI].values[pos].astype(np.float64)
+        part[strength + suffix] = df[_strength_column(df)].values[pos].astype(np.float64)
+        return part
+
+    matched = side(old_df, old_pos, OLD)
+    new_part = side(new_df, new_pos, NEW)
+    for col in (DE_AI + NEW, strength + NEW):
+        matched[col] = new_part[col].values
+    matched[STATUS] = MATCHED
+    vanished = side(old_df, np.setdiff1d(np.arange(len(old_df)), old_pos), OLD)
+    vanished[STATUS] = VANISHED
+    appeared = side(new_df, np.setdiff1d(np.arange(len(new_df)), new_pos), NEW)
+    appeared[STATUS] = APPEARED
+
+    diff = pd.concat([matched, vanished, appeared], ignore_index=True)
+    diff[SHIFT] = diff[DE_AI + NEW] - diff[DE_AI + OLD]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        diff[STRENGTH_RATIO] = diff[strength + NEW] / diff[strength + OLD]
+    diff["_E"] = diff[DE_AI + OLD].fillna(diff[DE_AI + NEW])
+    diff.sort_values(keys + ["_E"], inplace=True, kind="mergesort")
+    diff.drop(columns="_E", inplace=True)
+    diff.reset_index(drop=True, inplace=True)
+    return diff[keys + [DE_AI + OLD, DE_AI + NEW, SHIFT, strength + OLD, strength + NEW,
+                        STRENGTH_RATIO, STATUS]]
+
+def summarize(diff):
+    """ Counts and shift / strength ratio statistics of a diff """
+    matched = diff.loc[diff[STATUS] == MATCHED]
+    ratio = matched[STRENGTH_RATIO].replace([np.inf, -np.inf], np.nan)
+    return {MATCHED:len(matched),
+            APPEARED:int((diff[STATUS] == APPEARED).sum()),
+            VANISHED:int((diff[STATUS] == VANISHED).sum()),
+            "median_shift":matched[SHIFT].median(),
+            "max_abs_shift":matched[SHIFT].abs().max(),
+            "median_strength_ratio":ratio.median()}
+
+def _diff_files(args):
+    """ Pool task: reads and diffs one pair of tables """
+    (name, old_file, new_file, tolerance, keys) = args
+    diff = diff_tables(pd.read_csv(old_file), pd.read_csv(new_file), tolerance, keys)
+    return (name, diff)
+
+def diff_directories(old_dir, new_dir, tolerance=1.0, keys=None, pattern="*.csv", workers=None):
+    """
+    Diffs all tables with the same file name in two output directories, the pairs are processed
+    by a pool of workers processes (None: number of cores, 1: serial)
+    Returns a dict file name -> diff and a summary table with one row per file name, files that
+    only exist in one directory are listed with their status
+    """
+    old_files = {os.path.basename(f):f for f in glob.glob(os.path.join(old_dir, pattern))}
+    new_files = {os.path.basename(f):f for f in glob.glob(os.path.join(new_dir, pattern))}
+    tasks = [(name, old_files[name], new_files[name], tolerance, keys)
+             for name in sorted(set(old_files) & set(new_files))]
+    if workers == 1 or len(tasks) <= 1:
+        results = [_diff_files(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(_diff_files, tasks)
+    diffs = dict(results)
+
+    rows = []
+    for name in sorted(set(old_files) | set(new_files)):
+        if name in diffs:
+            rows.append(dict(summarize(diffs[name]), file=name, status="compared"))
+        else:
+            rows.append({"file":name, "status":"only old" if name in old_files else "only new"})
+    summary = pd.DataFrame(rows, columns=["file", "status", MATCHED, APPEARED, VANISHED,
+                                          "median_shift", "max_abs_shift",
+                                          "median_strength_ratio"])
+    return (diffs, summary)
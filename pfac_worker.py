@@ -0,0 +1,105 @@
+"""
+Persistent worker process running FAC calculations for the Python 3 pipeline (factools.pfacpool)
+
+Runs under python 2.7 with the fac_dr backend (pfac), the protocol itself has no further
+dependencies. Jobs are read from stdin, events are written to stdout, both as one json object per
+line. Everything printed by the backend (FAC, fac_dr) is redirected to stderr.
+
+Requests:
+{"id":<job id>, "cmd":"compute_dr", "z":26, "dr_type":"kll_li", "path":"./facoutput/KLL/"}
+    optionally with "outputs":{"lev":<target>, "tr":<target>, "ai":<target>} to print the tables
+    somewhere else than the default files, e.g. into named pipes, "select":<threshold> for
+    the AI-first level selection, "potential_cache":<folder> and "shared_potential":true
+    (see compute_dr)
+{"cmd":"ping"}
+{"cmd":"shutdown"}
+
+Events:
+{"event":"ready", "pid":<pid>, "backend":<module>}          once after start
+{"id":<job id>, "event":"started"}
+{"id":<job id>, "event":"done", "stub":<filename stub>, "files":[lev, tr, ai targets], "time":<s>}
+{"id":<job id>, "event":"error", "error":<exception type>, "message":<text>, "traceback":<text>}
+{"event":"pong"}
+
+Usage:
+python2.7 pfac_worker.py [--backend fac_dr]
+"""
+import importlib
+import json
+import os
+import sys
+import time
+import traceback
+
+def _send(out, event):
+    """ Writes one event line and flushes it immediately """
+    out.write(json.dumps(event) + "\n")
+    out.flush()
+
+def compute_dr(backend, job):
+    """ Runs backend.compute_dr for a job and returns the done event """
+    dr_type = getattr(backend, job["dr_type"])
+    # Optional arguments are only passed on if set, so backends without them keep working
+    options = dict((key, job[key])
+                   for key in ("outputs", "select", "potential_cache", "shared_potential")
+                   if job.get(key) is not None)
+    start = time.time()
+    stub = backend.compute_dr(int(job["z"]), dr_type, path=job.get("path", ""), **options)
+    if "outputs" in options:
+        files = [options["outputs"][kind] for kind in ("lev", "tr", "ai")]
+    else:
+        files = [stub + ext for ext in (".lev", ".tr", ".ai")]
+        missing = [f for f in files if not os.path.exists(f)]
+        if missing:
+            raise IOError("Missing output files: " + ", ".join(missing))
+    return {"id":job.get("id"), "event":"done", "stub":stub, "files":files,
+            "time":time.time() - start}
+
+COMMANDS = {"compute_dr":compute_dr}
+
+def serve(backend, stdin, out):
+    """ Processes requests from stdin until shutdown or end of input """
+    _send(out, {"event":"ready", "pid":os.getpid(), "backend":backend.__name__})
+    while True:
+        line = stdin.readline()
+        if not line:
+            break
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job = json.loads(line)
+        except ValueError as e:
+            _send(out, {"id":None, "event":"error", "error":"ValueError",
+                        "message":"Invalid request: " + str(e), "traceback":""})
+            continue
+        cmd = job.get("cmd")
+        if cmd == "shutdown":
+            break
+        if cmd == "ping":
+            _send(out, {"event":"pong"})
+            continue
+        if cmd not in COMMANDS:
+            _send(out, {"id":job.get("id"), "event":"error", "error":"KeyError",
+                        "message":"Unknown command: " + str(cmd), "traceback":""})
+            continue
+        _send(out, {"id":job.get("id"), "event":"started"})
+        try:
+            _send(out, COMMANDS[cmd](backend, job))
+        except Exception as e:
+            _send(out, {"id":job.get("id"), "event":"error", "error":type(e).__name__,
+                        "message":str(e), "traceback":traceback.format_exc()})
+
+def main():
+    """ Command line entry point """
+    backend_name = "fac_dr"
+    if "--backend" in sys.argv:
+        backend_name = sys.argv[sys.argv.index("--backend") + 1]
+    # Only the protocol may go to stdout
+    out = sys.stdout
+    sys.stdout = sys.stderr
+    backend = importlib.import_module(backend_name)
+    serve(backend, sys.stdin, out)
+
+if __name__ == "__main__":
+    main()